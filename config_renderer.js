@@ -13,11 +13,15 @@ const removeShortCheckbox = document.getElementById('remove_short');
 const combineCheckbox = document.getElementById('combine');
 const removeSlpsCheckbox = document.getElementById('remove_slps');
 
+// Keys without a field here (e.g. cache settings) are kept as loaded
+let currentConfig = {};
+
 // Request current config data
 ipcRenderer.send('get-config');
 
 // Populate fields with current config data
 ipcRenderer.on('config-data', (event, config) => {
+    currentConfig = config;
     meleeIsoInput.value = config.melee_iso || '';
     dolphinDirInput.value = config.dolphin_dir || '';
     ffmpegInput.value = config.ffmpeg || '';
@@ -34,6 +38,7 @@ ipcRenderer.on('config-data', (event, config) => {
 // Save button click handler
 document.getElementById('saveBtn').addEventListener('click', () => {
     const newConfig = {
+        ...currentConfig,
         melee_iso: meleeIsoInput.value,
         dolphin_dir: dolphinDirInput.value,
         ffmpeg: ffmpegInput.value,
@@ -1,11 +1,14 @@
 const { app, BrowserWindow, ipcMain, dialog } = require('electron');
 const path = require('path');
-const { execFile, spawn } = require('child_process');
+const { spawn } = require('child_process');
 const fs = require('fs');
 
 let mainWindow;
 let configWindow;
 
+// Lines of the log shown when a conversion fails
+const LOG_TAIL_LINES = 20;
+
 // Determine the path to the config file and Python executable
 let configPath, pythonExecutablePath;
 if (app.isPackaged) {
@@ -79,7 +82,9 @@ ipcMain.on('select-output-directory', async (event) => {
 ipcMain.on('start-conversion', (event, { inputDirectory, outputDirectory, youtubeOptions }) => {
   event.reply('conversion-started');
 
+  // Progress comes back as JSON lines on stdout (see slp2mp4/events.py)
   const args = [
+    '--progress-format', 'jsonl',
     'run',
     '-o',
     outputDirectory,
@@ -95,18 +100,38 @@ ipcMain.on('start-conversion', (event, { inputDirectory, outputDirectory, youtub
   }
 
   const pythonProcess = app.isPackaged
-    ? execFile(pythonExecutablePath, args)
+    // spawn streams output; execFile would buffer it and kill long runs at maxBuffer
+    ? spawn(pythonExecutablePath, args)
     : spawn('python', [path.join(__dirname, 'slp2mp4', 'slp2mp4.py'), ...args]);
 
+  let pending = '';
   pythonProcess.stdout.on('data', (data) => {
-    event.reply('conversion-progress', data.toString());
+    const lines = (pending + data.toString()).split('\n');
+    // The last piece is a partial line until the next chunk
+    pending = lines.pop();
+    for (const line of lines) {
+      if (line.trim() === '') {
+        continue;
+      }
+      try {
+        event.reply('conversion-event', JSON.parse(line));
+      } catch (err) {
+        console.error('Bad progress event:', line);
+      }
+    }
   });
 
+  // Everything else slp2mp4, Dolphin and ffmpeg print; only shown if the run fails
+  let log = [];
   pythonProcess.stderr.on('data', (data) => {
-    event.reply('conversion-error', data.toString());
+    log.push(...data.toString().split('\n'));
+    log = log.slice(-LOG_TAIL_LINES);
   });
 
   pythonProcess.on('close', (code) => {
+    if (code !== 0) {
+      event.reply('conversion-error', log.join('\n'));
+    }
     event.reply('conversion-complete', code);
   });
 });
@@ -7,6 +7,8 @@ let openConfigBtn = document.getElementById('openConfigBtn');
 let inputPath = document.getElementById('inputPath');
 let outputPath = document.getElementById('outputPath');
 let progressArea = document.getElementById('progressArea');
+let batchStatus = document.getElementById('batchStatus');
+let batchProgress = document.getElementById('batchProgress');
 
 let enableYoutubeCheckbox = document.getElementById('enableYoutube');
 let youtubeSettings = document.getElementById('youtubeSettings');
@@ -57,12 +59,44 @@ startConversionBtn.addEventListener('click', () => {
     ipcRenderer.send('start-conversion', { inputDirectory, outputDirectory, youtubeOptions });
 });
 
+function formatSeconds(seconds) {
+    seconds = Math.round(seconds);
+    let minutes = Math.floor(seconds / 60);
+    return `${minutes}:${String(seconds % 60).padStart(2, '0')}`;
+}
+
 ipcRenderer.on('conversion-started', () => {
     progressArea.textContent = 'Conversion in progress...';
+    batchStatus.textContent = 'Starting...';
+    batchProgress.value = 0;
+    batchProgress.style.display = 'block';
 });
 
-ipcRenderer.on('conversion-progress', (event, message) => {
-    progressArea.textContent += '\n' + message;
+// Typed progress events; see slp2mp4/events.py for what each one carries
+ipcRenderer.on('conversion-event', (event, ev) => {
+    switch (ev.event) {
+    case 'batch_started':
+        batchStatus.textContent = `Rendering ${ev.games} games on ${ev.workers} workers`;
+        break;
+    case 'batch':
+        if (ev.frames_total > 0) {
+            batchProgress.value = Math.min(1, ev.frames_done / ev.frames_total);
+        }
+        batchStatus.textContent = `${Math.floor(batchProgress.value * 100)}% `
+            + (ev.eta === null ? '' : `- ${formatSeconds(ev.eta)} left `)
+            + `(${ev.fps.toFixed(0)} fps)`;
+        break;
+    case 'output_ready':
+        progressArea.textContent += '\nCreated ' + ev.path;
+        break;
+    case 'error':
+        progressArea.textContent += '\nError: ' + ev.message;
+        break;
+    case 'batch_finished':
+        batchProgress.value = 1;
+        batchStatus.textContent = `Rendered ${ev.games} games in ${formatSeconds(ev.seconds)}`;
+        break;
+    }
 });
 
 ipcRenderer.on('conversion-error', (event, message) => {
@@ -0,0 +1,204 @@
+import os
+import time
+import asyncio
+import functools
+
+import psutil
+
+import events
+from dolphinrunner import CommFile, DolphinStallError
+from ffmpegrunner import atomic_output, write_concat_file
+from placement import environment, apply as apply_placement
+from progress import RenderProgress
+from scheduler import JobResult
+
+# Longest a render goes between progress checks when nothing changes on disk
+PROGRESS_INTERVAL = 1.0
+
+_END = object()
+
+async def to_thread(func, *args):
+    """
+    Runs blocking work (file copies, ffprobe) without holding up the other games
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+async def wait_for_change(watcher, timeout):
+    """
+    DirWatcher.wait for the event loop: the inotify fd is watched by the loop instead of select()
+    """
+    if not watcher.uses_inotify:
+        await asyncio.sleep(min(timeout, watcher.poll_interval))
+        return
+    loop = asyncio.get_running_loop()
+    changed = loop.create_future()
+    loop.add_reader(watcher.fd, lambda: changed.done() or changed.set_result(None))
+    try:
+        await asyncio.wait_for(changed, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(watcher.fd)
+    # Drains the events that woke us
+    watcher.wait(0)
+
+async def terminate_process_tree(proc, timeout=5):
+    """
+    dolphinrunner.kill_process_tree for an asyncio subprocess
+
+    The direct child is left for asyncio to reap; psutil only waits on what it started.
+    """
+    try:
+        children = psutil.Process(proc.pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        children = []
+    for p in children:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    try:
+        proc.terminate()
+    except ProcessLookupError:
+        pass
+
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        print("Warning: timed out waiting for Dolphin to terminate")
+        proc.kill()
+        await proc.wait()
+    _, alive = await to_thread(psutil.wait_procs, children, timeout)
+    for p in alive:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+async def run_ffmpeg(cmd, outfile, placement=None):
+    proc_ffmpeg = await asyncio.create_subprocess_exec(*cmd)
+    apply_placement(placement, proc_ffmpeg.pid)
+    try:
+        returncode = await proc_ffmpeg.wait()
+    except BaseException:
+        # Cancelled: don't leave ffmpeg writing a file that's about to be removed
+        try:
+            proc_ffmpeg.kill()
+        except ProcessLookupError:
+            pass
+        await proc_ffmpeg.wait()
+        raise
+    if returncode != 0:
+        raise RuntimeError(f'ffmpeg exited with {returncode} writing {outfile}')
+
+async def mux(ffmpeg_runner, video_files, audio_file, outfile):
+    """
+    FfmpegRunner.run without blocking the event loop
+    """
+    start = time.monotonic()
+    events.emit('stage', job=ffmpeg_runner.metrics.job, stage='muxing')
+    concat_file = write_concat_file(video_files)
+    try:
+        with atomic_output(outfile) as tmp:
+            cmd = ffmpeg_runner.mux_command(concat_file, audio_file) + [tmp]
+            print(' '.join(cmd))
+            await run_ffmpeg(cmd, outfile, ffmpeg_runner.placement)
+    finally:
+        os.unlink(concat_file)
+    return ffmpeg_runner.mux_done(outfile, start)
+
+async def run_dolphin(runner, slp_file, num_frames, emulation_speed=None):
+    """
+    DolphinRunner.run without blocking the event loop, including its stall retries
+    Returns [video_segment, ...], path_of_audio_file
+    """
+    for attempt in range(runner.conf.render_retries + 1):
+        try:
+            return await run_dolphin_once(runner, slp_file, num_frames, emulation_speed)
+        except DolphinStallError as e:
+            await to_thread(runner.retry_after_stall, e, attempt)
+
+async def run_dolphin_once(runner, slp_file, num_frames, emulation_speed=None):
+    """
+    DolphinRunner.run_once, but awaiting inotify instead of blocking on it
+    """
+    cmd, watch = runner.begin(emulation_speed)
+
+    with CommFile(runner.comm_file, slp_file, runner.job_id):
+        proc_dolphin = await asyncio.create_subprocess_exec(*cmd, env=environment(runner.placement))
+        audio_encoder = None
+        try:
+            audio_encoder = runner.launched(proc_dolphin.pid)
+            with RenderProgress(runner.render_time_file, num_frames) as progress:
+                while not watch.done(progress, proc_dolphin.returncode is not None):
+                    await wait_for_change(progress.watcher, PROGRESS_INTERVAL)
+                watch.finish(progress)
+        except BaseException:
+            # Includes cancellation: nothing is left running
+            await terminate_process_tree(proc_dolphin)
+            if audio_encoder is not None:
+                audio_encoder.abort()
+            raise
+
+        await terminate_process_tree(proc_dolphin)
+        return await to_thread(runner.end, watch, audio_encoder, emulation_speed)
+
+async def run_jobs(jobs, func, slots, controller=None):
+    """
+    scheduler.Scheduler for coroutines: runs `func(slot, *job)` for each job
+    with at most `slots` in flight, yielding a JobResult as each one completes
+
+    `slot` is a small integer no other running job has, for per-slot
+    resources like Dolphin User dirs. `jobs` can be any iterable and is only
+    read as slots free up, and no new job starts while the consumer is busy
+    with a result. Closing the generator (or cancelling the task iterating
+    it) cancels every job in flight.
+    """
+    jobs = iter(jobs)
+    next_job = next(jobs, _END)
+    running = {}  # {task: (job, slot, start)}
+    try:
+        while True:
+            while next_job is not _END and len(running) < slots:
+                used = {slot for _, slot, _ in running.values()}
+                slot = min(set(range(len(running) + 1)) - used)
+                task = asyncio.ensure_future(func(slot, *next_job))
+                running[task] = (next_job, slot, time.monotonic())
+                next_job = next(jobs, _END)
+            if not running:
+                return
+
+            timeout = None if controller is None else controller.interval
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if controller is not None:
+                # Shrinking only lets in-flight jobs finish; nothing is interrupted
+                slots = controller.update(slots, next_job is not _END and len(running) >= slots)
+            for task in done:
+                job, _, start = running.pop(task)
+                error = task.exception()
+                yield JobResult(job, None if error is not None else task.result(), error, time.monotonic() - start)
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+def iterate(agen):
+    """
+    Drives an async generator from synchronous code
+
+    The event loop only runs while waiting for the next item; subprocesses
+    keep running while the caller handles one. Breaking out of the loop (or
+    Ctrl-C) closes the generator.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
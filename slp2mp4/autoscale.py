@@ -0,0 +1,166 @@
+import os
+import glob
+import time
+
+import psutil
+
+from metrics import Metrics
+
+REALTIME_FPS = 60
+# A throttled Dolphin below this is dropping frames
+HEALTHY_FPS = 0.95 * REALTIME_FPS
+START_SLOTS = 2
+INTERVAL = 10.0         # Seconds between decisions
+SETTLE_INTERVALS = 1    # Intervals ignored after a change while Dolphins start up
+CPU_HEADROOM = 85.0     # Don't add workers above this CPU %
+MEMORY_LIMIT = 90.0     # Remove a worker above this memory %
+IOWAIT_LIMIT = 20.0     # Remove a worker above this % of CPU time waiting on disk
+MIN_GAIN = 0.05         # Unthrottled: an added worker has to raise total fps this much
+IDLE_SECONDS = 2.0      # A render_time.txt untouched this long belongs to a finished (or hung) game
+SLOW_INTERVALS = 3      # Intervals in a row a worker has to be below realtime before one is removed
+RECOVER_INTERVALS = 30  # Intervals without backing off before a slot count backed off from is tried again
+
+class FrameCounter:
+    """
+    Counts frames rendered since the last sample across every file matching a glob
+
+    Each worker's `render_time.txt` is recreated per job; a new inode or a
+    shrinking file starts that file's count over, and its frames are flagged
+    as not covering the whole sample. So are a file's frames if it stopped
+    growing before the sample: its game finished (the file stays until the
+    worker's next job) or Dolphin hung.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.files = {}  # {path: (inode, offset)}
+
+    def sample(self):
+        """
+        Returns {path: (new frames, whether the file was rendering the whole time)}
+        for files that grew since the last call
+        """
+        counts = {}
+        now = time.time()
+        for path in glob.glob(self.pattern):
+            try:
+                with open(path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    inode, offset = self.files.get(path, (None, 0))
+                    continuing = inode == st.st_ino and st.st_size >= offset
+                    if not continuing:
+                        offset = 0
+                    f.seek(offset)
+                    appended = f.read(st.st_size - offset)
+            except FileNotFoundError:
+                self.files.pop(path, None)
+                continue
+
+            # Only count complete lines
+            last_newline = appended.rfind(b'\n')
+            if last_newline >= 0:
+                rendering = continuing and now - st.st_mtime < IDLE_SECONDS
+                counts[path] = (appended.count(b'\n', 0, last_newline + 1), rendering)
+                offset += last_newline + 1
+            self.files[path] = (st.st_ino, offset)
+        return counts
+
+class ParallelismController:
+    """
+    Picks how many games render at once (`parallel_games: "auto"`)
+
+    Starts with a few workers and, every INTERVAL seconds, looks at the fps each
+    busy worker rendered (the slowest one counts) plus CPU, memory and disk pressure. Workers are removed
+    under pressure or when throttled Dolphins stay below realtime for
+    SLOW_INTERVALS, and added while there's headroom; unthrottled, a worker is
+    only kept if it raised the total fps. A slot count that had to be backed
+    off from is only tried again after RECOVER_INTERVALS without backing off.
+    """
+
+    def __init__(self, worker_glob, max_slots, realtime=True, start=START_SLOTS, interval=INTERVAL, metrics=None):
+        self.counter = FrameCounter(worker_glob)
+        self.max_slots = max(1, max_slots)
+        self.ceiling = self.max_slots
+        self.start = min(start, self.max_slots)
+        self.realtime = realtime
+        self.interval = interval
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.settling = SETTLE_INTERVALS
+        self.slow = 0            # Intervals in a row with a worker below realtime
+        self.since_backoff = 0   # Intervals since the ceiling was last lowered
+        self.last_change = None  # (slots before, total fps before)
+        self.last_sample = time.monotonic()
+        self.counter.sample()
+        psutil.cpu_percent()
+        psutil.cpu_times_percent()
+
+    def update(self, slots, saturated):
+        """
+        Returns the new slot count; `saturated` is whether every slot has a job
+        """
+        now = time.monotonic()
+        if now - self.last_sample < self.interval:
+            return slots
+        elapsed = now - self.last_sample
+        self.last_sample = now
+
+        counts = self.counter.sample().values()
+        total_fps = sum(frames for frames, _ in counts) / elapsed
+        # Games that started or finished during the sample would look slow
+        per_worker = [frames / elapsed for frames, rendering in counts if rendering]
+        # The slowest Dolphin decides: one dropping frames is hidden in an average
+        worker_fps = min(per_worker) if per_worker else 0.0
+        cpu = psutil.cpu_percent()
+        iowait = getattr(psutil.cpu_times_percent(), 'iowait', 0.0)
+        memory = psutil.virtual_memory().percent
+
+        if self.settling > 0:
+            self.settling -= 1
+            return slots
+
+        self.slow = self.slow + 1 if self.realtime and per_worker and worker_fps < HEALTHY_FPS else 0
+        self.since_backoff += 1
+        if self.ceiling < self.max_slots and self.since_backoff >= RECOVER_INTERVALS:
+            self.ceiling += 1
+            self.since_backoff = 0
+
+        new_slots = slots
+        reason = None
+        if memory > MEMORY_LIMIT or iowait > IOWAIT_LIMIT:
+            reason = f'memory {memory:.0f}%, iowait {iowait:.0f}%'
+            new_slots = slots - 1
+        elif self.slow >= SLOW_INTERVALS:
+            reason = f'slowest worker below {HEALTHY_FPS:.0f} fps for {self.slow} intervals, at {worker_fps:.1f} fps'
+            new_slots = slots - 1
+        elif not self.realtime and self.last_change is not None \
+                and total_fps < self.last_change[1] * (1 + MIN_GAIN):
+            reason = f'{total_fps:.0f} fps total vs {self.last_change[1]:.0f} fps with {self.last_change[0]} workers'
+            new_slots = self.last_change[0]
+        elif saturated and cpu < CPU_HEADROOM and slots < self.ceiling:
+            reason = f'CPU at {cpu:.0f}%'
+            new_slots = slots + 1
+
+        self.last_change = None
+        if new_slots < slots:
+            self.ceiling = max(1, new_slots)
+            self.since_backoff = 0
+            self.slow = 0
+            new_slots = self.ceiling
+        elif new_slots > slots:
+            self.last_change = (slots, total_fps)
+        if new_slots != slots:
+            self.settling = SETTLE_INTERVALS
+            print(f'Auto parallelism: {slots} -> {new_slots} workers ({reason})', flush=True)
+
+        self.metrics.emit(
+            'autoscale',
+            slots=slots,
+            new_slots=new_slots,
+            total_fps=total_fps,
+            worker_fps=worker_fps,
+            cpu=cpu,
+            iowait=iowait,
+            memory=memory,
+        )
+        return new_slots
@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+class CombinePipeline:
+    """
+    Combines each group of mp4s as soon as its last game is done
+
+    Games are marked finished one outfile at a time from the render loop; once
+    every outfile of a group is accounted for, the group is combined on a
+    thread pool while other games keep rendering. With `cleanup`, a group's
+    per-game mp4s (and its output directory, if it was created for it and is
+    now empty) are removed once its combined mp4 exists.
+
+    Groups can also be added while games are running (see `add_group`), e.g.
+    when watching a folder and a set turns out to be over.
+
+    With `update`, `update(mp4s, outname)` is also called as a group's
+    leading games finish, with those games in order, for outputs that can be
+    viewed before the group is complete.
+    """
+
+    def __init__(self, groups, combine, workers=2, cleanup=True, update=None):
+        self.combine = combine
+        self.cleanup = cleanup
+        self.update = update
+        self.updated = {}  # {outname: mp4s last passed to update}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='combine')
+        self.futures = []
+
+        self.groups = []
+        self.remaining = []
+        self.failed = []
+        self.group_of = {}
+        self.finished = {}  # {outfile: ok} for games not yet in a group
+        for group in groups:
+            self.add_group(group)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+        # Re-raise any exception that occurred in the with block
+        if tb is not None:
+            return False
+
+    def add_group(self, group):
+        """
+        Adds a group; games already marked done count towards it
+        """
+        i = len(self.groups)
+        self.groups.append(group)
+        self.remaining.append({vid for vid in group.vids if vid not in self.finished})
+        self.failed.append(not all([self.finished.pop(vid, True) for vid in group.vids]))
+        for vid in group.vids:
+            self.group_of[vid] = i
+        if len(self.remaining[i]) == 0:
+            self._submit(i)
+
+    def done(self, outfile, ok=True):
+        """
+        Marks `outfile` as finished; a failed game keeps its group from being combined
+        """
+        i = self.group_of.get(outfile)
+        if i is None:
+            self.finished[outfile] = ok
+            return
+        self.remaining[i].discard(outfile)
+        self.failed[i] = self.failed[i] or not ok
+        if len(self.remaining[i]) == 0:
+            self._submit(i)
+        elif self.update is not None and not self.failed[i]:
+            self._update(self.groups[i], lambda vid: vid not in self.remaining[i])
+
+    def preview(self, group):
+        """
+        Calls `update` for a group that hasn't been added yet, e.g. a set that's still being played
+        """
+        if self.update is None or not all(self.finished.get(vid, True) for vid in group.vids):
+            return
+        self._update(group, lambda vid: vid in self.finished)
+
+    def close(self):
+        """
+        Waits for every combine and returns the exceptions they raised
+        """
+        self.executor.shutdown(wait=True)
+        return [f.exception() for f in self.futures if f.exception() is not None]
+
+    def _update(self, group, is_done):
+        vids = []
+        for vid in group.vids:
+            if not is_done(vid):
+                break
+            vids.append(vid)
+        # Skipped games have no mp4
+        vids = [vid for vid in vids if os.path.exists(vid)]
+        if vids and vids != self.updated.get(group.outname):
+            self.updated[group.outname] = vids
+            self.update(vids, group.outname)
+
+    def _submit(self, i):
+        group = self.groups[i]
+        if self.failed[i]:
+            print(f'Warning: not creating {group.outname} because some of its games failed', flush=True)
+            return
+        # Skipped games (too short, unreadable) have no mp4
+        vids = [vid for vid in group.vids if os.path.exists(vid)]
+        if len(vids) == 0:
+            return
+        self.futures.append(self.executor.submit(self._combine, group, vids))
+
+    def _combine(self, group, vids):
+        self.combine(vids, group.outname)
+        print(f'Created {group.outname}', flush=True)
+        if not self.cleanup:
+            return
+        for vid in vids:
+            try:
+                os.remove(vid)
+            except FileNotFoundError:
+                pass
+        if group.outdir is not None:
+            try:
+                os.rmdir(group.outdir)
+            except OSError:
+                # Not empty yet: holds the output of a group that's still rendering
+                pass
@@ -1,10 +1,16 @@
 import os, json, sys
 import shutil
 from paths import Paths
+from metrics import Metrics
+from journal import JobJournal
+from placement import PlacementPolicy
 
 class Config:
-    def __init__(self, check_paths=True):
+    def __init__(self, check_paths=True, config_json=None):
         self.paths = Paths()
+        # Benchmarks and tests point this at their own config
+        if config_json is not None:
+            self.paths.config_json = config_json
         with open(self.paths.config_json, 'r') as f:
             j = json.loads(f.read())
             self.melee_iso = os.path.expanduser(j['melee_iso'])
@@ -21,10 +27,40 @@ class Config:
             self.parallel_games = j['parallel_games']
             self.remove_short = j['remove_short']
             self.combine = j['combine']
+            self.combine_workers = int(j.get('combine_workers', 2))
+            self.combine_format = j.get('combine_format', 'mp4')
             self.remove_slps = j['remove_slps']
+            self.engine = j.get('engine', 'process')
+            self.unthrottled = j.get('unthrottled', False)
+            self.av_sync_tolerance_frames = int(j.get('av_sync_tolerance_frames', 30))
+            self.stall_timeout = float(j.get('stall_timeout', 120))
+            self.render_retries = int(j.get('render_retries', 2))
+            self.stream_audio = j.get('stream_audio', False)
+            self.metrics_file = os.path.expanduser(j.get('metrics_file', ''))
+            self.upload_concurrency = int(j.get('upload_concurrency', 1))
+            self.upload_retries = int(j.get('upload_retries', 3))
+            self.cache = j.get('cache', False)
+            self.cache_dir = os.path.expanduser(j.get('cache_dir', '~/.cache/slp2mp4'))
+            self.cache_size_gb = float(j.get('cache_size_gb', 50))
+            self.watch_stable_seconds = float(j.get('watch_stable_seconds', 30))
+            self.watch_set_idle_seconds = float(j.get('watch_set_idle_seconds', 300))
+            self.placement_policy = j.get('placement', 'none')
+            self.render_devices = j.get('render_devices', 'auto')
 
         self.dolphin_bin = self.paths.dolphin_bin
 
+        # Set per batch by record_files (see usertemplate.UserDirTemplate)
+        self.user_dir_template = None
+
+        # Stage timings; a no-op unless metrics_file is set
+        self.metrics = Metrics(os.path.abspath(self.metrics_file) if self.metrics_file else None)
+
+        # Set per batch by record_files; a no-op otherwise
+        self.journal = JobJournal()
+
+        # Set per batch once the number of slots is known (see placement.PlacementPolicy)
+        self.placement = PlacementPolicy()
+
         # TODO: add more checking here
         if check_paths:
             self.check_path(self.melee_iso, 'Melee ISO')
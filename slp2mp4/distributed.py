@@ -0,0 +1,503 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import shutil
+import socket
+import posixpath
+import tempfile
+import ipaddress
+import threading
+import urllib.parse
+from collections import deque, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import events
+from ffmpegrunner import atomic_output
+from scheduler import JobResult
+from journal import RENDERING
+from zipsource import ZipSlp, open_slp
+
+DEFAULT_PORT = 8765
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 30.0
+HEARTBEAT_POLL = 0.5
+MAX_ATTEMPTS = 3            # A game whose worker died this many times is reported as failed
+POLL_INTERVAL = 2.0         # Idle workers ask for a job this often
+CONNECT_TIMEOUT = 60.0      # Workers wait this long for the coordinator to come up
+REQUEST_TIMEOUT = 60.0
+REPORT_ATTEMPTS = 3         # Tries at telling the coordinator a game failed or was skipped
+COPY_CHUNK_SIZE = 1024 * 1024
+TOKEN_HEADER = 'X-Slp2mp4-Token'
+DOLPHIN_HEADER = 'X-Slp2mp4-Dolphin'
+
+class LeaseLost(Exception):
+    pass
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def replay_name(slp_file):
+    if isinstance(slp_file, ZipSlp):
+        return posixpath.basename(slp_file.member)
+    return os.path.basename(slp_file)
+
+class Coordinator:
+    """
+    Hands render jobs out to `slp2mp4 worker`s over HTTP and collects their mp4s
+
+    Workers lease one game at a time, download its replay, and PUT the
+    rendered mp4 back; combining, uploading and the journal stay with the
+    coordinator. While rendering, a worker sends heartbeats for the games it
+    holds, and a game whose worker goes quiet for `heartbeat_timeout` seconds
+    is handed to someone else. Requests carry TOKEN_HEADER if a `token` is set,
+    and mp4s the worker's Dolphin build in DOLPHIN_HEADER. Anything but a
+    loopback `host` needs a `token`, since anyone who can connect can take
+    games and send back mp4s.
+
+        POST /lease {"worker"}              200 {"job", "name", "duration", "heartbeat" (interval), "options"};
+                                            204 if all games are leased out; 410 once the batch is done
+        GET  /jobs/<job>/replay             the replay's bytes
+        POST /heartbeat {"worker", "jobs"}  200 {"lost": [jobs no longer leased to the worker]}
+        PUT  /jobs/<job>/mp4?worker=        the mp4's bytes; 409 if the lease was lost
+        POST /jobs/<job>/skipped?worker=    too short or unreadable
+        POST /jobs/<job>/failed?worker=     {"error"}
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, token=None, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        if not token and not is_loopback(host):
+            raise RuntimeError(f'Refusing to listen on {host} without a token; set one, or listen on 127.0.0.1')
+        self.token = token
+        self.heartbeat_timeout = heartbeat_timeout
+        self.heartbeat_interval = min(HEARTBEAT_INTERVAL, heartbeat_timeout / 3)
+        self.lock = threading.Lock()
+        self.events = queue.Queue()  # (job, error, rendered, worker's Dolphin build)
+        self.jobs = []
+        self.pending = deque()
+        self.leases = {}  # {job: [worker, last heartbeat]}
+        self.started = {}
+        self.attempts = defaultdict(int)
+        self.finished = set()
+        self.options = {}
+        self.server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        self.serving = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        if host in ('0.0.0.0', '::'):
+            host = socket.gethostname()
+        return f'http://{host}:{port}'
+
+    def close(self):
+        """
+        Stops answering workers; idle ones see the coordinator is gone and exit
+        """
+        if self.serving is not None:
+            self.server.shutdown()
+            self.serving.join()
+            self.serving = None
+        self.server.server_close()
+
+    def run(self, jobs, finish, options=None):
+        """
+        Serves `jobs` (record_file_slp arguments, in the order to hand them
+        out) until all are done, yielding a JobResult as each completes
+
+        `finish(job, rendered, dolphin_build)` is called here, not on the
+        server's threads, once a job's mp4 is in place (or it was skipped) and
+        returns its result; `dolphin_build` is what the worker reported.
+        `options` is passed to every worker's `render` with each lease.
+        """
+        with self.lock:
+            self.options = options or {}
+            self.jobs = list(jobs)
+            self.pending = deque(range(len(self.jobs)))
+        self.serving = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.serving.start()
+        print(f'Serving {len(self.jobs)} games at {self.url}; start workers with '
+              f'`slp2mp4 worker {self.url}`', flush=True)
+
+        remaining = len(self.jobs)
+        try:
+            while remaining:
+                try:
+                    done = [self.events.get(timeout=self.heartbeat_interval)]
+                except queue.Empty:
+                    done = []
+                done += self.reap()
+                for job_id, error, rendered, dolphin_build in done:
+                    remaining -= 1
+                    job = self.jobs[job_id]
+                    elapsed = time.monotonic() - self.started.get(job_id, time.monotonic())
+                    result = None
+                    if error is None:
+                        try:
+                            result = finish(job, rendered, dolphin_build)
+                        except Exception as e:
+                            error = e
+                    yield JobResult(job, result, error, elapsed)
+        finally:
+            self.close()
+
+    def reap(self):
+        """
+        Re-queues games whose worker stopped sending heartbeats
+        Returns [(job, error, False, None)] for games that ran out of attempts
+        """
+        now = time.monotonic()
+        failed = []
+        with self.lock:
+            for job_id, (worker, last) in list(self.leases.items()):
+                if now - last <= self.heartbeat_timeout:
+                    continue
+                del self.leases[job_id]
+                name = self.jobs[job_id][0]
+                if self.attempts[job_id] >= MAX_ATTEMPTS:
+                    self.finished.add(job_id)
+                    failed.append((job_id, RuntimeError(f'workers stopped responding {MAX_ATTEMPTS} times'), False, None))
+                else:
+                    print(f'Re-queueing {name}: worker {worker} stopped responding', flush=True)
+                    # It was among the longest games left when it was handed out
+                    self.pending.appendleft(job_id)
+        return failed
+
+    def lease(self, worker):
+        """
+        Returns the lease for the next game, None if there's none right now, or False once the batch is done
+        """
+        with self.lock:
+            if not self.pending:
+                return False if len(self.finished) == len(self.jobs) else None
+            job_id = self.pending.popleft()
+            self.leases[job_id] = [worker, time.monotonic()]
+            self.attempts[job_id] += 1
+            self.started.setdefault(job_id, time.monotonic())
+        slp_file, outfile, conf = self.jobs[job_id][:3]
+        conf.journal.set_state(outfile, RENDERING)
+        print(f'{worker} is recording {slp_file}', flush=True)
+        events.emit('job_started', job=f'{worker}/{job_id}', slp=str(slp_file), outfile=outfile, worker=worker)
+        return {
+            'job': job_id,
+            'name': replay_name(slp_file),
+            'duration': self.jobs[job_id][-1],
+            'heartbeat': self.heartbeat_interval,
+            'options': self.options,
+        }
+
+    def heartbeat(self, worker, job_ids):
+        lost = []
+        with self.lock:
+            for job_id in job_ids:
+                lease = self.leases.get(job_id)
+                if lease is not None and lease[0] == worker:
+                    lease[1] = time.monotonic()
+                else:
+                    lost.append(job_id)
+        return lost
+
+    def _end_lease(self, job_id, worker):
+        with self.lock:
+            if self.leases.get(job_id, [None])[0] != worker:
+                raise LeaseLost()
+            del self.leases[job_id]
+            self.finished.add(job_id)
+
+    def receive_mp4(self, job_id, worker, rfile, length, dolphin_build=None):
+        with self.lock:
+            if self.leases.get(job_id, [None])[0] != worker:
+                raise LeaseLost()
+        outfile = self.jobs[job_id][1]
+        # The lease is checked again once the upload is in; the partial file is dropped if it was lost
+        with atomic_output(outfile) as tmp:
+            with open(tmp, 'wb') as f:
+                while length > 0:
+                    chunk = rfile.read(min(COPY_CHUNK_SIZE, length))
+                    if not chunk:
+                        raise ConnectionError(f'upload of {outfile} was cut short')
+                    f.write(chunk)
+                    length -= len(chunk)
+            self._end_lease(job_id, worker)
+        self.events.put((job_id, None, True, dolphin_build))
+
+    def skipped(self, job_id, worker):
+        self._end_lease(job_id, worker)
+        self.events.put((job_id, None, False, None))
+
+    def failed(self, job_id, worker, error):
+        self._end_lease(job_id, worker)
+        self.events.put((job_id, RuntimeError(f'{worker}: {error}'), False, None))
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        # Idle workers poll constantly
+        pass
+
+    def _send(self, code, payload=None):
+        body = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _route(self):
+        """
+        Returns (path parts, worker from the query string, job id or None), or None if already answered
+        """
+        coordinator = self.server.coordinator
+        if coordinator.token and self.headers.get(TOKEN_HEADER) != coordinator.token:
+            self._send(403)
+            return None
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        worker = urllib.parse.parse_qs(url.query).get('worker', [None])[0]
+        job_id = None
+        if parts[0] == 'jobs':
+            try:
+                job_id = int(parts[1])
+                coordinator.jobs[job_id]
+            except (IndexError, ValueError):
+                self._send(404)
+                return None
+        return parts, worker, job_id
+
+    def do_GET(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, _, job_id = route
+        if parts[2:] != ['replay']:
+            return self._send(404)
+        with open_slp(self.server.coordinator.jobs[job_id][0]) as (f, size):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, COPY_CHUNK_SIZE)
+
+    def do_POST(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, worker, job_id = route
+        coordinator = self.server.coordinator
+        if parts == ['lease']:
+            lease = coordinator.lease(self._read_json()['worker'])
+            if lease is None:
+                return self._send(204)
+            if lease is False:
+                return self._send(410)
+            return self._send(200, lease)
+        if parts == ['heartbeat']:
+            body = self._read_json()
+            return self._send(200, {'lost': coordinator.heartbeat(body['worker'], body['jobs'])})
+        try:
+            if parts[2:] == ['skipped']:
+                coordinator.skipped(job_id, worker)
+            elif parts[2:] == ['failed']:
+                coordinator.failed(job_id, worker, self._read_json().get('error'))
+            else:
+                return self._send(404)
+        except LeaseLost:
+            return self._send(409)
+        self._send(204)
+
+    def do_PUT(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, worker, job_id = route
+        if parts[2:] != ['mp4']:
+            return self._send(404)
+        try:
+            self.server.coordinator.receive_mp4(
+                job_id, worker, self.rfile, int(self.headers['Content-Length']), self.headers.get(DOLPHIN_HEADER),
+            )
+        except LeaseLost:
+            self.close_connection = True
+            return self._send(409)
+        self._send(204)
+
+class Worker:
+    """
+    Renders games leased from a Coordinator, `slots` at a time
+
+    `render(slot, slp_path, outfile, duration, options)` records one replay
+    and returns False if it was skipped; `slot` is the thread's index, for
+    per-thread resources like Dolphin User dirs. `dolphin_build` (see
+    RenderCache.dolphin_build) is sent along with each mp4. The worker stops
+    once the coordinator has nothing left or goes away.
+    """
+
+    def __init__(self, url, render, slots=1, token=None, dolphin_build=None):
+        self.url = url.rstrip('/')
+        self.render = render
+        self.slots = max(1, slots)
+        self.token = token
+        self.dolphin_build = dolphin_build
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.lock = threading.Lock()
+        self.held = set()
+        self.connected = False
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.stopping = threading.Event()
+
+    def run(self):
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        threads = [threading.Thread(target=self._work, args=(slot,)) for slot in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.stopping.set()
+        heartbeat.join()
+
+    def _request(self, method, path, payload=None, data=None, headers=None):
+        """
+        Returns (status, body); HTTP errors are returned rather than raised
+        """
+        # urllib.request pulls in ssl and email, which only workers need
+        import urllib.error
+        import urllib.request
+        headers = dict(headers or {})
+        if payload is not None:
+            data = json.dumps(payload).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                self.connected = True
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            self.connected = True
+            return e.code, e.read()
+
+    def _job_path(self, job_id, action):
+        return f'/jobs/{job_id}/{action}?worker={urllib.parse.quote(self.worker_id)}'
+
+    def _work(self, slot):
+        waited = 0
+        while True:
+            try:
+                status, body = self._request('POST', '/lease', {'worker': self.worker_id})
+            except OSError as e:
+                # URLError, or the connection dropping as the coordinator shuts down
+                if self.connected or waited >= CONNECT_TIMEOUT:
+                    print(f'Coordinator at {self.url} is gone ({getattr(e, "reason", e)}); stopping', flush=True)
+                    return
+                time.sleep(POLL_INTERVAL)
+                waited += POLL_INTERVAL
+                continue
+            if status == 410:
+                return
+            if status == 204:
+                time.sleep(POLL_INTERVAL)
+                continue
+            if status != 200:
+                raise RuntimeError(f'Coordinator refused a lease: HTTP {status}')
+            self._run_job(slot, json.loads(body))
+
+    def _run_job(self, slot, lease):
+        import urllib.request
+        job_id = lease['job']
+        self.heartbeat_interval = lease.get('heartbeat', HEARTBEAT_INTERVAL)
+        # Only the file name is used; it's just for Dolphin's and the logs' sake
+        name = os.path.basename(posixpath.basename(lease['name'])) or 'replay.slp'
+        with self.lock:
+            self.held.add(job_id)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                slp_path = os.path.join(tmpdir, name)
+                request = urllib.request.Request(self.url + f'/jobs/{job_id}/replay', headers=(
+                    {TOKEN_HEADER: self.token} if self.token else {}
+                ))
+                try:
+                    with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response, open(slp_path, 'wb') as f:
+                        shutil.copyfileobj(response, f, COPY_CHUNK_SIZE)
+                except OSError as e:
+                    # The lease runs out and the game goes to another worker
+                    print(f'Error: failed to download {name}: {e}', file=sys.stderr)
+                    return
+
+                outfile = os.path.splitext(slp_path)[0] + '.mp4'
+                try:
+                    rendered = self.render(slot, slp_path, outfile, lease['duration'], lease['options'])
+                except Exception as e:
+                    print(f'Error: failed to record {name}: {e}', file=sys.stderr)
+                    self._report(job_id, name, 'failed', {'error': str(e)})
+                    return
+                if not rendered:
+                    self._report(job_id, name, 'skipped', {})
+                    return
+
+                headers = {
+                    'Content-Type': 'video/mp4',
+                    'Content-Length': str(os.path.getsize(outfile)),
+                }
+                if self.dolphin_build is not None:
+                    headers[DOLPHIN_HEADER] = self.dolphin_build
+                try:
+                    with open(outfile, 'rb') as f:
+                        status, _ = self._request('PUT', self._job_path(job_id, 'mp4'), data=f, headers=headers)
+                except OSError as e:
+                    # A lost lease is refused before the upload is read
+                    print(f'Error: failed to send {name}: {e}', file=sys.stderr)
+                    return
+                if status == 409:
+                    print(f'Warning: {name} was handed to another worker; dropping this copy', flush=True)
+                elif status != 204:
+                    print(f'Error: coordinator rejected {name}: HTTP {status}', file=sys.stderr)
+                else:
+                    print(f'Sent {name}', flush=True)
+        finally:
+            with self.lock:
+                self.held.discard(job_id)
+
+    def _report(self, job_id, name, action, payload):
+        """
+        Tells the coordinator a game failed or was skipped; if it can't be
+        reached, the game goes to another worker once its lease runs out
+        """
+        for attempt in range(REPORT_ATTEMPTS):
+            try:
+                self._request('POST', self._job_path(job_id, action), payload)
+                return
+            except OSError as e:
+                error = e
+                if attempt + 1 < REPORT_ATTEMPTS:
+                    time.sleep(POLL_INTERVAL)
+        print(f'Error: could not report {name} as {action}: {getattr(error, "reason", error)}', file=sys.stderr)
+
+    def _heartbeat(self):
+        # Checked often, since the interval only arrives with the first lease
+        last = 0
+        while not self.stopping.wait(HEARTBEAT_POLL):
+            with self.lock:
+                job_ids = list(self.held)
+            if not job_ids or time.monotonic() - last < self.heartbeat_interval:
+                continue
+            last = time.monotonic()
+            try:
+                _, body = self._request('POST', '/heartbeat', {'worker': self.worker_id, 'jobs': job_ids})
+                lost = json.loads(body or b'{}').get('lost', [])
+            except (OSError, ValueError):
+                continue
+            for job_id in lost:
+                print(f'Warning: job {job_id} was handed to another worker', flush=True)
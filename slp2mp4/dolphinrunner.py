@@ -1,9 +1,145 @@
 import os, sys, subprocess, time, shutil, uuid, json, configparser
+import copy
 import glob
 import pathlib
 
+import events
+from progress import RenderProgress
+from ffmpegrunner import AudioStreamEncoder, AUDIO_EXTENSIONS, audio_codec
+from placement import worker_slot, environment, apply as apply_placement
+
 RESOLUTION_DICT = {'480p': '2', '720p': '3', '1080p': '5', '1440p': '6', '2160p': '8'}
 
+def write_ini_settings(ini_settings):
+    """
+    Applies {ini_path: {section: [(option, value), ...]}} to Dolphin's INI files
+    """
+    for ini_path, opt_dict in ini_settings.items():
+        # need these args to ensure Gecko_Enabled options (GALE01.ini) are parsed correctly
+        ini_parser = configparser.ConfigParser(allow_no_value=True, delimiters=('=',), strict=False)
+
+        ini_parser.optionxform = str
+        ini_parser.read(ini_path)
+        sections = ini_parser.sections()
+        for section, opts in opt_dict.items():
+            if section  not in sections:
+                ini_parser.add_section(section)
+            for opt_tuple in opts:
+                ini_parser.set(section, *opt_tuple)
+
+        pathlib.Path(ini_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(ini_path, 'w') as ini_fp:
+            ini_parser.write(ini_fp)
+
+class DolphinStallError(RuntimeError):
+    """
+    Dolphin stopped before the game was over: it hung or exited; the render is retried
+    """
+    pass
+
+def kill_process_tree(proc, timeout=5):
+    """
+    Terminates `proc` and everything it started (the AppImage runs Dolphin as a child)
+    Anything still alive after `timeout` seconds is killed
+    """
+    import psutil
+    try:
+        procs = [psutil.Process(proc.pid)]
+        procs += procs[0].children(recursive=True)
+    except psutil.NoSuchProcess:
+        procs = []
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    _, alive = psutil.wait_procs(procs, timeout=timeout)
+    if alive:
+        print("Warning: timed out waiting for Dolphin to terminate")
+        for p in alive:
+            try:
+                p.kill()
+            except psutil.NoSuchProcess:
+                pass
+    # Reaps the direct child
+    proc.wait()
+
+class RenderWatch:
+    """
+    Bookkeeping while a Dolphin renders: startup and render timings, progress
+    reports and stall detection
+    """
+
+    def __init__(self, stall_timeout, metrics, **fields):
+        self.stall_timeout = stall_timeout
+        self.metrics = metrics
+        # Added to the render record, e.g. the settings its fps depends on
+        self.fields = fields
+        self.launched = time.monotonic()
+        self.first_frame = None
+        self.last_report = self.launched
+        self.last_progress = (self.launched, 0)
+        # Why the render was cut short, if it stalled or Dolphin exited early
+        self.stalled = None
+        events.emit('stage', job=metrics.job, stage='dolphin_startup')
+
+    def report(self, progress):
+        # With a progress stream the front end shows progress, not the log
+        if events.enabled():
+            events.emit(
+                'progress', job=self.metrics.job, frames=progress.frames_done,
+                total=progress.num_frames, fps=progress.fps, eta=progress.eta,
+            )
+        else:
+            print(progress)
+
+    def check(self, progress):
+        """
+        Called after each progress update; returns an error message if Dolphin has stalled
+        """
+        now = time.monotonic()
+        if self.first_frame is None and progress.frames_done > 0:
+            self.first_frame = now
+            self.metrics.emit('stage', stage='dolphin_startup', seconds=now - self.launched)
+            events.emit('stage', job=self.metrics.job, stage='rendering')
+        # A Dolphin stuck on the "waiting for game" screen (or hung) never finishes on its own
+        if progress.frames_done != self.last_progress[1]:
+            self.last_progress = (now, progress.frames_done)
+        elif self.stall_timeout > 0 and now - self.last_progress[0] > self.stall_timeout:
+            return (f'Dolphin made no progress for {self.stall_timeout:g}s '
+                    f'at frame {progress.frames_done}/{progress.num_frames}')
+        if now - self.last_report >= events.PROGRESS_INTERVAL:
+            self.report(progress)
+            self.last_report = now
+        return None
+
+    def done(self, progress, exited):
+        """
+        Called between waits for `progress`; True once every frame is in, Dolphin
+        has exited, or it stalled (see `stalled`)
+        """
+        # Since the Slippi doesn't quit on the "waiting for game" screen,
+        # we need to count frames to detect that we've finished
+        if progress.update() >= progress.num_frames:
+            return True
+        if exited:
+            # It may have written its last frames on the way out; a crash leaves a partial dump
+            if progress.update() < progress.num_frames:
+                self.stalled = f'Dolphin exited at frame {progress.frames_done}/{progress.num_frames}'
+            return True
+        self.stalled = self.check(progress)
+        return self.stalled is not None
+
+    def finish(self, progress):
+        self.report(progress)
+        if self.first_frame is not None:
+            render_seconds = time.monotonic() - self.first_frame
+            self.metrics.emit(
+                'stage', stage='render', seconds=render_seconds, frames=progress.frames_done,
+                fps=progress.frames_done / render_seconds if render_seconds > 0 else 0,
+                **self.fields,
+            )
+
 class CommFile:
     def __init__(self, comm_path, slp_file, job_id):
         self.comm_data = {
@@ -26,11 +162,17 @@ class CommFile:
 
 class DolphinRunner:
 
-    def __init__(self, conf, paths, working_dir, job_id):
+    def __init__(self, conf, paths, working_dir, job_id, template=None, slot=None):
         self.conf = conf
         self.job_id = job_id
-        self.paths = paths
-        self.user_dir = os.path.join(working_dir, 'User-{}'.format(job_id))
+        # Runners can share a process (see asyncengine), so don't point the caller's paths at this User dir
+        self.paths = copy.copy(paths)
+        # With a template, the worker's configured User dir is reused between jobs
+        self.template = template
+        if template is not None:
+            self.user_dir = template.worker_dir(slot)
+        else:
+            self.user_dir = os.path.join(working_dir, 'User-{}'.format(job_id))
         self.paths.user_dir = self.user_dir
 
         # Get all needed paths
@@ -39,29 +181,42 @@ class DolphinRunner:
         self.frames_dir = os.path.join(self.paths.user_dump_dir, 'Frames')
         self.audio_dir = os.path.join(self.paths.user_dump_dir, 'Audio')
         self.audio_file = os.path.join(self.audio_dir, 'dspdump.wav')
+        # With `stream_audio`, encoded while Dolphin is still running
+        self.audio_codec = audio_codec(conf.combine_format == 'hls')
+        self.encoded_audio_file = os.path.join(self.audio_dir, 'dspdump' + AUDIO_EXTENSIONS[self.audio_codec])
         self.ffmpeg = conf.ffmpeg
+        self.metrics = conf.metrics.for_job(job_id)
+
+        # Pool workers get their slot when they start (see placement.claim_worker_slot)
+        self.placement = conf.placement.dolphin(slot if slot is not None else worker_slot())
+        self.encoder_placement = conf.placement.encoder()
 
     def __enter__(self):
-        # Create a new user dir for this job
-        self.paths.copy_inis()
+        with self.metrics.stage('user_dir_setup', template=self.template is not None):
+            self.setup_user_dir()
         return self
 
-    def __exit__(self, type, value, tb):
+    def setup_user_dir(self):
+        if self.template is not None:
+            self.template.clone_to(self.user_dir)
+        else:
+            # Create a new user dir for this job
+            self.paths.copy_inis()
+
+    def reset_user_dir(self):
+        """
+        Replaces the User dir with a fresh one, in case a hang left it in a bad state
+        """
         shutil.rmtree(self.user_dir, ignore_errors=True)
+        self.setup_user_dir()
+
+    def __exit__(self, type, value, tb):
+        if self.template is None:
+            shutil.rmtree(self.user_dir, ignore_errors=True)
         # Re-raise any exception that occurred in the with block
         if tb is not None:
             return False
 
-    def count_frames_completed(self):
-        num_completed = 0
-
-        if os.path.exists(self.render_time_file):
-            with open(self.render_time_file, 'r') as f:
-                num_completed = len(list(f))
-
-        print("Rendered ",num_completed," frames")
-        return num_completed
-
     def prep_dolphin_settings(self):
 
         # TODO should we do this?
@@ -129,7 +284,9 @@ class DolphinRunner:
                     ('AdapterRumble0', 'False'),
                     ('AdapterRumble1', 'False'),
                     ('AdapterRumble2', 'False'),
-                    ('AdapterRumble3', 'False')
+                    ('AdapterRumble3', 'False'),
+                    # 0.0 is unlimited; frame dump timestamps still follow emulated time
+                    ('EmulationSpeed', '0.0' if self.conf.unthrottled else '1.0')
                 ],
                 'Movie': [
                     ('DumpFrames', 'True'),
@@ -178,22 +335,17 @@ class DolphinRunner:
             }
 
 
-        for ini_path, opt_dict in ini_settings.items():
-            # need these args to ensure Gecko_Enabled options (GALE01.ini) are parsed correctly
-            ini_parser = configparser.ConfigParser(allow_no_value=True, delimiters=('=',), strict=False)
+        write_ini_settings(ini_settings)
 
-            ini_parser.optionxform = str
-            ini_parser.read(ini_path)
-            sections = ini_parser.sections()
-            for section, opts in opt_dict.items():
-                if section  not in sections:
-                    ini_parser.add_section(section)
-                for opt_tuple in opts:
-                    ini_parser.set(section, *opt_tuple)
-
-            pathlib.Path(ini_path).parent.mkdir(parents=True, exist_ok=True)
-            with open(ini_path, 'w') as ini_fp:
-                ini_parser.write(ini_fp)
+    def set_emulation_speed(self, speed):
+        """
+        Overrides the emulation speed for the next run (0.0 is unlimited)
+        """
+        write_ini_settings({
+            self.paths.user_dolphin_ini: {
+                'Core': [('EmulationSpeed', f'{speed:.1f}')]
+            }
+        })
 
     def prep_user_dir(self):
         # We need to remove the render time file because we read it to figure out when dolphin is done
@@ -210,65 +362,170 @@ class DolphinRunner:
         os.makedirs(self.frames_dir, exist_ok=True)
         os.makedirs(self.audio_dir, exist_ok=True)
 
+        # Needs to exist before Dolphin starts so we can watch it for render_time.txt
+        os.makedirs(os.path.dirname(self.render_time_file), exist_ok=True)
+
     def get_dump_files(self):
         """
         Find correct audio and video files after Dolphin has dumped them
+        Returns [video_segment, ...], audio_file
         """
-        if not os.path.exists(self.audio_file):
+        audio_file = self.encoded_audio_file if self.conf.stream_audio else self.audio_file
+        if not os.path.exists(audio_file):
             raise RuntimeError("Audio dump missing!")
 
-        # Sort framedumps by last modified time, then merge
+        # Sort framedumps by last modified time
         # Using glob because it gives full relative directory
         framedumps = glob.glob(os.path.join(self.frames_dir, '*'))
         framedumps.sort(key=os.path.getmtime)
+        if len(framedumps) == 0:
+            raise RuntimeError("Frame dump missing!")
 
-        # Merges avi files
-        ffmpeg_pat = 'concat:' + '|'.join(framedumps)
-        video_file = os.path.join(self.frames_dir, 'framedump.avi')
-        subprocess.run([self.ffmpeg, '-i', ffmpeg_pat, '-c', 'copy', video_file])
+        if self.conf.stream_audio:
+            # Only the encoded copy is needed from here on
+            os.remove(self.audio_file)
+        return framedumps, audio_file
 
-        return video_file, self.audio_file
-
-    def run(self, slp_file, num_frames):
+    def run(self, slp_file, num_frames, emulation_speed=None):
         """
         Run Dolphin, dumping frames and audio and returning when done
-        Returns path_of_video_file, path_of_audio_file
+        `emulation_speed` overrides the configured speed for this run only
+        A Dolphin that stops rendering for `stall_timeout` seconds is killed and
+        retried on a fresh User dir up to `render_retries` times
+        Returns [video_segment, ...], path_of_audio_file
         """
+        for attempt in range(self.conf.render_retries + 1):
+            try:
+                return self.run_once(slp_file, num_frames, emulation_speed)
+            except DolphinStallError as e:
+                self.retry_after_stall(e, attempt)
 
-        self.prep_dolphin_settings()
-        self.prep_user_dir()
+    def retry_after_stall(self, error, attempt):
+        """
+        Resets the User dir after a stalled attempt; re-raises `error` if that was the last one
+        """
+        retries = self.conf.render_retries
+        self.metrics.emit('stall', attempt=attempt + 1, error=str(error))
+        # Workers keep their User dir, so don't leave a bad one for the next job either
+        self.reset_user_dir()
+        if attempt == retries:
+            raise error
+        print(f'Warning: {error}; retrying on a fresh User dir ({attempt + 1}/{retries})', flush=True)
+
+    def prepare(self, emulation_speed=None):
+        with self.metrics.stage('user_dir_prep'):
+            if self.template is None:
+                self.prep_dolphin_settings()
+            self.prep_user_dir()
+            if emulation_speed is not None:
+                self.set_emulation_speed(emulation_speed)
+
+    # A run, whichever engine waits on it (see run_once and asyncengine.run_dolphin_once):
+    # begin, start Dolphin, launched, wait until RenderWatch.done, stop Dolphin, end
+    def begin(self, emulation_speed=None):
+        """
+        Gets the User dir ready; returns Dolphin's command line and the RenderWatch for the run
+        """
+        self.prepare(emulation_speed)
+        cmd = self.command()
+        print(' '.join(cmd))
+        return cmd, self.render_watch()
 
-        # Create a slippi 'comm' file to tell dolphin which file to play
-        with CommFile(self.comm_file, slp_file, self.job_id):
+    def launched(self, pid):
+        """
+        Called once Dolphin is running; returns its audio encoder, if any
+        """
+        # The GPU is picked through the environment; CPUs once it's running
+        self.place(pid)
+        return self.start_audio_encoder()
 
-            # Construct command string and run dolphin
-            cmd = [
-                self.conf.dolphin_bin,
-                '-i', self.comm_file,          # The comm file tells dolphin which slippi file to play (see above)
-                '-b',                          # Exit dolphin when emulation ends
-                '-e', self.conf.melee_iso,     # ISO to use
-                '-u', self.user_dir,           # specify User dir
-                '-v', self.conf.video_backend, # Specify graphics backend
-                ]
-            print(' '.join(cmd))
-            # TODO run faster than realtime if possible
-            proc_dolphin = subprocess.Popen(args=cmd)
-
-            # Poll file until done
-            # Since the Slippi doesn't quit on the "waiting for game" screen,
-            # we need to poll to detect that we've finished
-            while self.count_frames_completed() < num_frames:
-                # Check if process has been killed early
-                if proc_dolphin.poll() is not None:
-                    break
-                time.sleep(1)
+    def end(self, watch, audio_encoder, emulation_speed=None):
+        """
+        Called once Dolphin is gone; raises DolphinStallError if it stalled or
+        exited before rendering every frame, so a partial dump is never muxed
+        Returns [video_segment, ...], path_of_audio_file
+        """
+        if watch.stalled is not None:
+            if audio_encoder is not None:
+                audio_encoder.abort()
+            raise DolphinStallError(watch.stalled)
+        if audio_encoder is not None:
+            audio_encoder.finish()
+        self.restore_emulation_speed(emulation_speed)
+        return self.get_dump_files()
+
+    def command(self):
+        return [
+            self.conf.dolphin_bin,
+            '-i', self.comm_file,          # The comm file tells dolphin which slippi file to play (see above)
+            '-b',                          # Exit dolphin when emulation ends
+            '-e', self.conf.melee_iso,     # ISO to use
+            '-u', self.user_dir,           # specify User dir
+            '-v', self.conf.video_backend, # Specify graphics backend
+        ]
+
+    def render_watch(self):
+        return RenderWatch(
+            self.conf.stall_timeout,
+            self.metrics,
+            resolution=self.conf.resolution,
+            unthrottled=self.conf.unthrottled,
+        )
+
+    def start_audio_encoder(self):
+        """
+        Starts encoding the audio dump as it's written if `stream_audio` is set
+        """
+        if not self.conf.stream_audio:
+            return None
+        return AudioStreamEncoder(
+            self.ffmpeg, self.audio_file, self.encoded_audio_file, self.metrics, self.encoder_placement,
+            codec=self.audio_codec,
+        ).start()
+
+    def place(self, pid):
+        """
+        Moves a Dolphin that just started to this slot's CPUs, and records where it ran
+        """
+        if self.placement is None:
+            return
+        apply_placement(self.placement, pid)
+        self.metrics.emit(
+            'placement',
+            process='dolphin',
+            slot=self.placement.slot,
+            cpus=self.placement.cpus,
+            gpu=self.placement.gpu,
+        )
+
+    def restore_emulation_speed(self, emulation_speed):
+        # The worker's User dir outlives this run, so put the configured speed back
+        if emulation_speed is not None and self.template is not None:
+            self.set_emulation_speed(0.0 if self.conf.unthrottled else 1.0)
+
+    def run_once(self, slp_file, num_frames, emulation_speed=None):
+        # Runs faster than realtime when `unthrottled` is set (see prep_dolphin_settings)
+        cmd, watch = self.begin(emulation_speed)
 
-            # Kill dolphin
-            proc_dolphin.terminate()
+        # Create a slippi 'comm' file to tell dolphin which file to play
+        with CommFile(self.comm_file, slp_file, self.job_id):
+            proc_dolphin = subprocess.Popen(args=cmd, env=environment(self.placement))
+            audio_encoder = None
             try:
-                proc_dolphin.wait(timeout=5)
-            except subprocess.TimeoutExpired as t:
-                print ("Warning: timed out waiting for Dolphin to terminate")
-                proc_dolphin.kill()
+                audio_encoder = self.launched(proc_dolphin.pid)
+
+                # Watch render_time.txt until done
+                with RenderProgress(self.render_time_file, num_frames) as progress:
+                    while not watch.done(progress, proc_dolphin.poll() is not None):
+                        progress.wait(1)
+                    watch.finish(progress)
+            except BaseException:
+                # Includes Ctrl-C: nothing is left running
+                kill_process_tree(proc_dolphin)
+                if audio_encoder is not None:
+                    audio_encoder.abort()
+                raise
 
-        return self.get_dump_files()
\ No newline at end of file
+            # Kill dolphin
+            kill_process_tree(proc_dolphin)
+            return self.end(watch, audio_encoder, emulation_speed)
@@ -0,0 +1,159 @@
+import json
+import time
+import queue
+import threading
+import multiprocessing
+
+# Per-job progress and the batch summary are written at most this often
+PROGRESS_INTERVAL = 1.0
+
+# Where emit() sends events in this process; None when nobody is listening
+_queue = None
+_STOP = 'stop'
+
+def emit(event_type, **fields):
+    """
+    Sends an event to the EventStream of this batch, if there is one
+
+    Works from the main process, its threads and pool workers (see init_worker).
+    """
+    if _queue is None:
+        return
+    fields = {'event': event_type, 'time': time.time(), **fields}
+    try:
+        _queue.put(fields)
+    except (OSError, ValueError):
+        # The stream already closed
+        pass
+
+def enabled():
+    return _queue is not None
+
+def current_queue():
+    return _queue
+
+def init_worker(event_queue):
+    """
+    Pool initializer: sends this worker's events to the main process's EventStream
+    """
+    global _queue
+    _queue = event_queue
+
+class EventStream:
+    """
+    Writes progress events from every worker to `out` as JSON lines, for front ends
+
+    Events arrive on one multiprocessing queue, from this process's threads
+    and from pool workers, and are written by a single thread. Events are
+    passed through as they come, except `progress`: only each job's latest is
+    kept and written every `interval` seconds, followed by a `batch` event
+    with the frames done across every job, the combined fps and the batch's
+    ETA. Workers' own rate of progress events therefore doesn't matter.
+
+    Event types (every event also has `event` and `time`):
+        batch_started  {games, frames, workers}
+        job_queued     {slp, outfile, frames}
+        job_started    {job, slp, outfile, [worker]}: worker when served
+        stage          {job, stage}: dolphin_startup, rendering or muxing;
+                       combining has no job but the combined file's outfile
+        progress       {job, frames, total, fps, eta}
+        output_ready   {path, kind}: "game" or "combined"
+        job_finished   {outfile, seconds, ok}: seconds is null in watch mode
+        error          {message, [outfile]}
+        batch          {frames_done, frames_total, fps, eta}
+        batch_finished {games, seconds, errors}
+    """
+
+    def __init__(self, out, interval=PROGRESS_INTERVAL):
+        self.out = out
+        self.interval = interval
+        self.queue = multiprocessing.Queue()
+        self.thread = None
+
+        self.queued_frames = {}  # {outfile: frames}
+        self.outfiles = {}       # {job: outfile}
+        self.latest = {}         # {job: progress event}
+        self.changed = set()
+        self.frames_finished = 0
+
+    def __enter__(self):
+        global _queue
+        _queue = self.queue
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        global _queue
+        if value is not None and not isinstance(value, KeyboardInterrupt):
+            emit('error', message=str(value))
+        self.queue.put(_STOP)
+        self.thread.join()
+        _queue = None
+        # Re-raise any exception that occurred in the with block
+        if tb is not None:
+            return False
+
+    def _write(self, event):
+        self.out.write(json.dumps(event, default=str) + '\n')
+
+    def _run(self):
+        next_flush = time.monotonic() + self.interval
+        while True:
+            try:
+                event = self.queue.get(timeout=max(0, next_flush - time.monotonic()))
+            except queue.Empty:
+                event = None
+            if event == _STOP:
+                self._flush()
+                return
+            if event is not None:
+                self._handle(event)
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.interval
+
+    def _handle(self, event):
+        kind = event['event']
+        if kind == 'progress':
+            self.latest[event['job']] = event
+            self.changed.add(event['job'])
+            return
+
+        if kind == 'job_queued':
+            self.queued_frames[event['outfile']] = event.get('frames') or 0
+        elif kind == 'job_started':
+            self.outfiles[event['job']] = event['outfile']
+        elif kind == 'job_finished':
+            frames = self.queued_frames.pop(event['outfile'], 0)
+            if event.get('ok', True):
+                self.frames_finished += frames
+            for job, outfile in list(self.outfiles.items()):
+                if outfile == event['outfile']:
+                    del self.outfiles[job]
+                    self.latest.pop(job, None)
+                    self.changed.discard(job)
+        self._write(event)
+        self.out.flush()
+
+    def _flush(self):
+        if not self.changed:
+            return
+        for job in sorted(self.changed):
+            self._write(self.latest[job])
+        self.changed.clear()
+
+        running = [event for job, event in self.latest.items() if job in self.outfiles]
+        frames_done = self.frames_finished + sum(event['frames'] for event in running)
+        frames_total = self.frames_finished + sum(self.queued_frames.values())
+        fps = sum(event['fps'] for event in running)
+        eta = max(0, frames_total - frames_done) / fps if fps > 0 else None
+        self._write({
+            'event': 'batch',
+            'time': time.time(),
+            'frames_done': frames_done,
+            'frames_total': frames_total,
+            'fps': fps,
+            'eta': eta,
+        })
+        self.out.flush()
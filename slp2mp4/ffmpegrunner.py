@@ -1,38 +1,317 @@
+import os
+import json
+import shutil
+import struct
 import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import contextlib
+from collections import namedtuple
 
-class FfmpegRunner:
-    def __init__(self, ffmpeg_bin):
+import events
+from metrics import Metrics
+from placement import apply as apply_placement
+
+MuxStats = namedtuple('MuxStats', ['bytes_written', 'elapsed'])
+AVInfo = namedtuple('AVInfo', ['video_frames', 'audio_seconds'])
+WavFormat = namedtuple('WavFormat', ['channels', 'sample_rate', 'block_align', 'bits', 'data_offset'])
+
+# How often a growing audio dump is checked for new samples
+AUDIO_TAIL_INTERVAL = 0.2
+
+# Output options for an mp4 an HLS playlist can reference in place (see
+# hls.py): the moov comes first and holds no samples, and every fragment
+# starts on a keyframe
+FRAGMENTED_MP4_FLAGS = ['-movflags', '+frag_keyframe+empty_moov+default_base_moof']
+# Extension of audio encoded ahead of the mux in each codec (see AudioStreamEncoder)
+AUDIO_EXTENSIONS = {'mp3': '.mp3', 'aac': '.m4a'}
+
+def audio_codec(fragmented):
+    """
+    Codec games' audio is encoded in; HLS doesn't allow MP3 in fragmented mp4s
+    """
+    return 'aac' if fragmented else 'mp3'
+
+def find_ffprobe(ffmpeg_bin):
+    """
+    Looks for ffprobe next to ffmpeg, then on the PATH
+    """
+    if ffmpeg_bin:
+        d, name = os.path.split(ffmpeg_bin)
+        candidate = os.path.join(d, name.replace('ffmpeg', 'ffprobe'))
+        if candidate != ffmpeg_bin and os.path.exists(candidate):
+            return candidate
+    return shutil.which('ffprobe')
+
+def write_concat_file(files):
+    """
+    Writes an ffmpeg concat demuxer file listing `files`; caller removes it
+    """
+    tmp = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt')
+    for f in files:
+        f = os.path.abspath(f).replace("'", "'\\''")
+        tmp.write(f"file '{f}'\n")
+    tmp.close()
+    return tmp.name
+
+@contextlib.contextmanager
+def atomic_output(outfile):
+    """
+    Yields a temporary name next to `outfile` that's renamed over it once the
+    with block succeeds, so a crash never leaves a partial `outfile` behind
+    """
+    d, name = os.path.split(os.path.abspath(outfile))
+    stem, ext = os.path.splitext(name)
+    # Keeps the extension so ffmpeg still picks the right muxer
+    tmp = os.path.join(d, f'.{stem}.{uuid.uuid4().hex[:8]}.partial{ext}')
+    try:
+        yield tmp
+        os.replace(tmp, outfile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def parse_wav_header(data):
+    """
+    Finds the format and start of the samples in the beginning of a WAV file
+    Returns None until the header has been written in full; chunk sizes aren't
+    used because Dolphin only fills them in when it stops dumping
+    """
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    pos = 12
+    fmt = None
+    while pos + 8 <= len(data):
+        chunk_id, size = data[pos:pos + 4], struct.unpack('<I', data[pos + 4:pos + 8])[0]
+        if chunk_id == b'data':
+            if fmt is None:
+                return None
+            return WavFormat(*fmt, pos + 8)
+        if chunk_id == b'fmt ':
+            if pos + 8 + 16 > len(data):
+                return None
+            _, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', data[pos + 8:pos + 24])
+            fmt = (channels, sample_rate, block_align, bits)
+        pos += 8 + size + (size & 1)
+    return None
+
+class AudioStreamEncoder:
+    """
+    Encodes Dolphin's audio dump to `codec` while Dolphin is still writing it
+
+    A thread tails the growing WAV and pipes whole sample frames into ffmpeg,
+    so once Dolphin is stopped only the last fraction of a second is left to
+    encode and the mux can copy the audio. The WAV is tailed rather than
+    replaced with a FIFO because Dolphin seeks back to fill in the header
+    when it stops dumping.
+    """
+
+    def __init__(self, ffmpeg_bin, wav_file, outfile, metrics=None, placement=None, codec='mp3'):
         self.ffmpeg_bin = ffmpeg_bin
+        self.wav_file = wav_file
+        self.outfile = outfile
+        self.codec = codec
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.placement = placement
+        self.stopping = threading.Event()
+        self.thread = None
+        self.proc = None
+        self.error = None
 
-    def combine(self, concat_file, outfile):
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if tb is not None:
+            self.abort()
+            # Re-raise any exception that occurred in the with block
+            return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self._tail, daemon=True)
+        self.thread.start()
+        return self
+
+    def finish(self):
+        """
+        Encodes what's left once Dolphin has stopped; returns the encoded file
+        """
+        start = time.monotonic()
+        self.stopping.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.proc is None:
+            raise RuntimeError('Audio dump missing!')
+        self.metrics.emit('stage', stage='audio_encode_tail', seconds=time.monotonic() - start)
+        return self.outfile
+
+    def abort(self):
+        self.stopping.set()
+        if self.proc is not None:
+            self.proc.kill()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _start_ffmpeg(self, fmt):
         cmd = [
             self.ffmpeg_bin,
-            '-y',                       # Always overwrite without asking
-            '-safe', '0',               # Sane file names
-            '-f', 'concat',             # Set input stream to concatenate
-            '-i', concat_file,          # use a concatenation demuxer file which contains a list of files to combine
-            '-c', 'copy',               # copy audio and video
-            outfile
+            '-y',                               # overwrite output file without asking
+            '-f', f's{fmt.bits}le',             # raw little-endian PCM from the WAV's data chunk
+            '-ar', str(fmt.sample_rate),
+            '-ac', str(fmt.channels),
+            '-i', 'pipe:0',
+            '-c:a', self.codec,
+            self.outfile,
         ]
         print(' '.join(cmd))
-        proc_ffmpeg = subprocess.Popen(args=cmd)
-        proc_ffmpeg.wait()
+        proc = subprocess.Popen(args=cmd, stdin=subprocess.PIPE)
+        apply_placement(self.placement, proc.pid)
+        return proc
+
+    def _tail(self):
+        try:
+            self._tail_wav()
+        except Exception as e:
+            self.error = e
+
+    def _tail_wav(self):
+        # Wait for Dolphin to create the dump and write its header
+        fmt = None
+        while fmt is None:
+            stopping = self.stopping.is_set()
+            try:
+                with open(self.wav_file, 'rb') as f:
+                    fmt = parse_wav_header(f.read(4096))
+            except FileNotFoundError:
+                pass
+            if fmt is None:
+                if stopping:
+                    return
+                time.sleep(AUDIO_TAIL_INTERVAL)
+
+        self.proc = self._start_ffmpeg(fmt)
+        with open(self.wav_file, 'rb') as f:
+            f.seek(fmt.data_offset)
+            pending = b''
+            while True:
+                # Checked before reading so the last read gets everything Dolphin wrote
+                stopping = self.stopping.is_set()
+                data = pending + f.read()
+                usable = len(data) - len(data) % fmt.block_align
+                if usable:
+                    self.proc.stdin.write(data[:usable])
+                pending = data[usable:]
+                if stopping:
+                    break
+                time.sleep(AUDIO_TAIL_INTERVAL)
 
-    def run(self, video_file, audio_file, outfile):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f'ffmpeg exited with {self.proc.returncode} encoding {self.outfile}')
+
+def run_ffmpeg(cmd, outfile, placement=None):
+    proc_ffmpeg = subprocess.Popen(args=cmd)
+    apply_placement(placement, proc_ffmpeg.pid)
+    if proc_ffmpeg.wait() != 0:
+        raise RuntimeError(f'ffmpeg exited with {proc_ffmpeg.returncode} writing {outfile}')
+
+class FfmpegRunner:
+    def __init__(self, ffmpeg_bin, metrics=None, fragmented=False, placement=None):
+        self.ffmpeg_bin = ffmpeg_bin
+        self.fragmented = fragmented
+        # Where muxes and combines run (see placement.PlacementPolicy.encoder)
+        self.placement = placement
+        self.ffprobe_bin = find_ffprobe(ffmpeg_bin)
+        self.metrics = metrics if metrics is not None else Metrics()
 
+    def probe_av(self, media_file):
+        """
+        Counts video frames and measures audio duration; returns None without ffprobe
+        """
+        if self.ffprobe_bin is None:
+            return None
         cmd = [
+            self.ffprobe_bin,
+            '-v', 'error',
+            '-count_packets',           # count frames without decoding them
+            '-show_entries', 'stream=codec_type,nb_read_packets,duration',
+            '-of', 'json',
+            media_file
+        ]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return None
+        video_frames, audio_seconds = None, None
+        for stream in json.loads(proc.stdout).get('streams', []):
+            if stream.get('codec_type') == 'video':
+                video_frames = int(stream.get('nb_read_packets', 0))
+            elif stream.get('codec_type') == 'audio':
+                audio_seconds = float(stream.get('duration', 0))
+        return AVInfo(video_frames, audio_seconds)
+
+    def combine(self, concat_file, outfile):
+        with self.metrics.stage('combine', outfile=outfile), atomic_output(outfile) as tmp:
+            cmd = [
+                self.ffmpeg_bin,
+                '-y',                       # Always overwrite without asking
+                '-safe', '0',               # Sane file names
+                '-f', 'concat',             # Set input stream to concatenate
+                '-i', concat_file,          # use a concatenation demuxer file which contains a list of files to combine
+                '-c', 'copy',               # copy audio and video
+                tmp
+            ]
+            print(' '.join(cmd))
+            run_ffmpeg(cmd, outfile, self.placement)
+
+    def mux_command(self, concat_file, audio_file):
+        """
+        ffmpeg arguments muxing the dump segments listed in `concat_file` with
+        `audio_file`; the output file goes at the end
+        """
+        # Audio AudioStreamEncoder already encoded in the right codec is copied
+        codec = audio_codec(self.fragmented)
+        if audio_file.endswith(AUDIO_EXTENSIONS[codec]):
+            codec = 'copy'
+
+        return [
             self.ffmpeg_bin,
             '-y',                   # overwrite output file without asking
-            '-i', audio_file,       # 0th input stream: audio
+            '-safe', '0',           # Sane file names
+            '-f', 'concat',         # 0th input stream: video, concatenated from the dump segments
+            '-i', concat_file,
             # offset no longer needed!
             #'-itsoffset', '1.55',   # offset (delay) the audio by 1.55s
-            '-i', video_file,  # 1st input stream: video
-            '-map', '1:v',          # map 1st input to video output
-            '-map', '0:a',          # map 0th input to audio output
-            '-c:a', 'mp3',          # convert audio encoding to mp3 for output
+            '-i', audio_file,       # 1st input stream: audio
+            '-map', '0:v',          # map 0th input to video output
+            '-map', '1:a',          # map 1st input to audio output
+            '-c:a', codec,          # convert audio encoding to mp3 (aac for HLS) for output
             '-c:v', 'copy',         # use the same encoding (avi) for video output
-            outfile
+            *(FRAGMENTED_MP4_FLAGS if self.fragmented else []),
         ]
-        print(' '.join(cmd))
-        proc_ffmpeg = subprocess.Popen(args=cmd)
-        proc_ffmpeg.wait()
+
+    def mux_done(self, outfile, start):
+        stats = MuxStats(os.path.getsize(outfile) if os.path.exists(outfile) else 0, time.monotonic() - start)
+        print(f'Muxed {outfile}: {stats.bytes_written / 1024 ** 2:.1f} MiB in {stats.elapsed:.1f}s')
+        self.metrics.emit('stage', stage='mux', seconds=stats.elapsed, bytes=stats.bytes_written)
+        return stats
+
+    def run(self, video_files, audio_file, outfile):
+        """
+        Muxes Dolphin's frame dump segments and audio dump straight into `outfile`
+        Audio already encoded by AudioStreamEncoder is copied rather than re-encoded
+        """
+        start = time.monotonic()
+        events.emit('stage', job=self.metrics.job, stage='muxing')
+        concat_file = write_concat_file(video_files)
+        try:
+            with atomic_output(outfile) as tmp:
+                cmd = self.mux_command(concat_file, audio_file) + [tmp]
+                print(' '.join(cmd))
+                run_ffmpeg(cmd, outfile, self.placement)
+        finally:
+            os.unlink(concat_file)
+        return self.mux_done(outfile, start)
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+class DirWatcher:
+    """
+    Waits for files in a directory to change
+
+    Uses inotify on Linux; elsewhere (or if inotify is unavailable) `wait`
+    just sleeps for `poll_interval` and callers rescan what they care about.
+    """
+
+    def __init__(self, directory, mask=IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE, poll_interval=0.05):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.fd = None
+        if _libc is not None:
+            fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                if _libc.inotify_add_watch(fd, os.fsencode(directory), mask) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+    @property
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+        # Re-raise any exception that occurred in the with block
+        if tb is not None:
+            return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout):
+        """
+        Blocks until something changes or `timeout` seconds pass
+        Returns the names of changed files, or None if they're unknown (polling)
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return None
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(buf):
+            _, _, _, name_len = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            if name:
+                names.append(os.fsdecode(name))
+        return names
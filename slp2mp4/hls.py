@@ -0,0 +1,217 @@
+import os
+import math
+import struct
+from collections import namedtuple
+
+from ffmpegrunner import atomic_output
+
+# Shortest media segment a playlist entry covers; consecutive fragments are
+# merged up to this, since Dolphin's dumps can have a keyframe every frame
+SEGMENT_SECONDS = 4.0
+
+Segment = namedtuple('Segment', ['offset', 'size', 'duration'])
+FragmentedMp4 = namedtuple('FragmentedMp4', ['init_size', 'segments'])
+
+# tfhd flags
+BASE_DATA_OFFSET = 0x01
+SAMPLE_DESCRIPTION_INDEX = 0x02
+DEFAULT_SAMPLE_DURATION = 0x08
+# trun flags
+DATA_OFFSET = 0x01
+FIRST_SAMPLE_FLAGS = 0x04
+SAMPLE_DURATION = 0x100
+SAMPLE_SIZE = 0x200
+SAMPLE_FLAGS = 0x400
+SAMPLE_CTS_OFFSET = 0x800
+
+def iter_boxes(data, start=0, end=None):
+    """
+    Yields (type, payload start, box end) for the boxes in `data[start:end]`
+    """
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError(f'Bad {box_type!r} box at {pos}')
+        yield box_type.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def find_box(data, path, start=0, end=None):
+    """
+    (payload start, box end) of the first box at `path`, e.g. 'mdia/mdhd'; None if missing
+    """
+    name, _, rest = path.partition('/')
+    for box_type, payload, box_end in iter_boxes(data, start, end):
+        if box_type == name:
+            return (payload, box_end) if not rest else find_box(data, rest, payload, box_end)
+    return None
+
+def read_top_level_boxes(f):
+    """
+    Yields (type, offset, size) for each top-level box without reading their payloads
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        size, box_type = struct.unpack('>I4s', header[:8])
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+        elif size == 0:
+            size = file_size - pos
+        if size < 8 or pos + size > file_size:
+            raise ValueError(f'Truncated {box_type!r} box at {pos}')
+        yield box_type.decode('latin-1'), pos, size
+        pos += size
+
+def parse_moov(moov):
+    """
+    Returns (track id, timescale, default sample duration) for the video track
+    """
+    tracks = []
+    for box_type, payload, end in iter_boxes(moov):
+        if box_type != 'trak':
+            continue
+        tkhd = find_box(moov, 'tkhd', payload, end)
+        mdhd = find_box(moov, 'mdia/mdhd', payload, end)
+        hdlr = find_box(moov, 'mdia/hdlr', payload, end)
+        if tkhd is None or mdhd is None or hdlr is None:
+            continue
+        # Version 1 headers have 64-bit creation and modification times
+        version = moov[tkhd[0]]
+        track_id = struct.unpack('>I', moov[tkhd[0] + (20 if version else 12):][:4])[0]
+        version = moov[mdhd[0]]
+        timescale = struct.unpack('>I', moov[mdhd[0] + (20 if version else 12):][:4])[0]
+        handler = moov[hdlr[0] + 8:hdlr[0] + 12]
+        tracks.append((handler == b'vide', track_id, timescale))
+    if not tracks:
+        raise ValueError('No tracks')
+    _, track_id, timescale = max(tracks, key=lambda t: t[0])
+
+    default_duration = 0
+    mvex = find_box(moov, 'mvex')
+    if mvex is not None:
+        for box_type, payload, _ in iter_boxes(moov, *mvex):
+            if box_type == 'trex' and struct.unpack('>I', moov[payload + 4:payload + 8])[0] == track_id:
+                default_duration = struct.unpack('>I', moov[payload + 12:payload + 16])[0]
+    return track_id, timescale, default_duration
+
+def fragment_ticks(moof, track_id, default_duration):
+    """
+    Total sample duration of `track_id` in a moof, in its track's timescale
+    """
+    ticks = 0
+    for box_type, payload, end in iter_boxes(moof):
+        if box_type != 'traf':
+            continue
+        tfhd = find_box(moof, 'tfhd', payload, end)
+        if tfhd is None:
+            continue
+        flags = struct.unpack('>I', moof[tfhd[0]:tfhd[0] + 4])[0] & 0xffffff
+        if struct.unpack('>I', moof[tfhd[0] + 4:tfhd[0] + 8])[0] != track_id:
+            continue
+        pos = tfhd[0] + 8
+        pos += 8 if flags & BASE_DATA_OFFSET else 0
+        pos += 4 if flags & SAMPLE_DESCRIPTION_INDEX else 0
+        duration = default_duration
+        if flags & DEFAULT_SAMPLE_DURATION:
+            duration = struct.unpack('>I', moof[pos:pos + 4])[0]
+
+        for box_type, trun, _ in iter_boxes(moof, payload, end):
+            if box_type != 'trun':
+                continue
+            flags = struct.unpack('>I', moof[trun:trun + 4])[0] & 0xffffff
+            count = struct.unpack('>I', moof[trun + 4:trun + 8])[0]
+            if not flags & SAMPLE_DURATION:
+                ticks += count * duration
+                continue
+            pos = trun + 8
+            pos += 4 if flags & DATA_OFFSET else 0
+            pos += 4 if flags & FIRST_SAMPLE_FLAGS else 0
+            stride = 4 * bin(flags & (SAMPLE_DURATION | SAMPLE_SIZE | SAMPLE_FLAGS | SAMPLE_CTS_OFFSET)).count('1')
+            for i in range(count):
+                ticks += struct.unpack('>I', moof[pos + i * stride:pos + i * stride + 4])[0]
+    return ticks
+
+def parse_fragmented_mp4(path, segment_seconds=SEGMENT_SECONDS):
+    """
+    Splits an mp4 written with ffmpegrunner.FRAGMENTED_MP4_FLAGS into its init section and
+    keyframe-aligned media segments of at least `segment_seconds`
+
+    Only box headers, the moov and the moofs are read. Raises ValueError for
+    an mp4 that isn't fragmented.
+    """
+    with open(path, 'rb') as f:
+        init_size = None
+        track = None
+        segments = []
+        start, size, ticks = None, 0, 0
+        for box_type, offset, box_size in read_top_level_boxes(f):
+            if box_type == 'moov':
+                f.seek(offset)
+                moov = f.read(box_size)
+                track = parse_moov(moov[8:])
+                init_size = offset + box_size
+            elif box_type == 'moof':
+                if track is None:
+                    raise ValueError(f'{path}: moof before moov')
+                if start is not None and ticks >= segment_seconds * track[1]:
+                    segments.append(Segment(start, size, ticks / track[1]))
+                    start, size, ticks = None, 0, 0
+                f.seek(offset)
+                moof = f.read(box_size)
+                ticks += fragment_ticks(moof[8:], track[0], track[2])
+                start = offset if start is None else start
+                size = offset + box_size - start
+            elif box_type == 'mdat' and start is not None:
+                size = offset + box_size - start
+        if start is not None:
+            segments.append(Segment(start, size, ticks / track[1]))
+    if init_size is None or not segments:
+        raise ValueError(f'{path} is not a fragmented mp4')
+    return FragmentedMp4(init_size, segments)
+
+def write_playlist(outfile, mp4s, complete):
+    """
+    Writes an HLS playlist at `outfile` that plays `mp4s` back to back
+
+    Segments are byte ranges of the mp4s themselves, so nothing is copied.
+    Until `complete` (no end tag), players keep reloading it as games are added.
+    """
+    d = os.path.dirname(os.path.abspath(outfile))
+    entries = []
+    durations = []
+    for i, mp4 in enumerate(mp4s):
+        uri = os.path.relpath(os.path.abspath(mp4), d).replace(os.sep, '/')
+        fmp4 = parse_fragmented_mp4(mp4)
+        # Timestamps start over with every game
+        if i > 0:
+            entries.append('#EXT-X-DISCONTINUITY')
+        entries.append(f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{fmp4.init_size}@0"')
+        for segment in fmp4.segments:
+            entries.append(f'#EXTINF:{segment.duration:.3f},')
+            entries.append(f'#EXT-X-BYTERANGE:{segment.size}@{segment.offset}')
+            entries.append(uri)
+            durations.append(segment.duration)
+
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:7',
+        f'#EXT-X-TARGETDURATION:{max([1] + [math.ceil(s) for s in durations])}',
+        '#EXT-X-PLAYLIST-TYPE:EVENT',
+        '#EXT-X-INDEPENDENT-SEGMENTS',
+        *entries,
+    ]
+    if complete:
+        lines.append('#EXT-X-ENDLIST')
+    with atomic_output(outfile) as tmp:
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
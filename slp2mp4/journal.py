@@ -0,0 +1,89 @@
+import os
+import time
+import sqlite3
+import threading
+
+# A game's outfile moves through these in order; "skipped" games were too
+# short or unreadable and have no mp4
+QUEUED = 'queued'
+RENDERING = 'rendering'
+MUXED = 'muxed'
+COMBINED = 'combined'
+UPLOADED = 'uploaded'
+SKIPPED = 'skipped'
+
+# States a resumed run doesn't have to render again
+RENDERED_STATES = (MUXED, COMBINED, UPLOADED, SKIPPED)
+
+class JobJournal:
+    """
+    Records how far each output of a batch got, in a SQLite file
+
+    Rows are keyed by output path: per-game mp4s and combined mp4s. Every
+    process and thread (pool workers, combine and upload threads) opens its
+    own connection on first use;
+    writes are single autocommitted statements, so a crash loses at most the
+    transition in progress. With no path, everything is a no-op.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._connections = {}  # {(pid, thread id): connection}
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def __getstate__(self):
+        # Connections can't be pickled into pool workers
+        return {'path': self.path, '_connections': {}}
+
+    def _connection(self):
+        owner = (os.getpid(), threading.get_ident())
+        conn = self._connections.get(owner)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                'path TEXT PRIMARY KEY, slp_file TEXT, state TEXT NOT NULL, updated REAL NOT NULL)'
+            )
+            self._connections[owner] = conn
+        return conn
+
+    def set_state(self, path, state, slp_file=None):
+        """
+        An uploaded output stays uploaded: uploads and combines finish in either
+        order, and a game re-rendered for a resumed combine must not be
+        uploaded again by a later resume
+        """
+        if not self.enabled:
+            return
+        self._connection().execute(
+            'INSERT INTO outputs (path, slp_file, state, updated) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(path) DO UPDATE SET updated = excluded.updated, '
+            'slp_file = COALESCE(excluded.slp_file, outputs.slp_file), '
+            'state = CASE WHEN outputs.state = ? THEN outputs.state ELSE excluded.state END',
+            (os.path.abspath(path), None if slp_file is None else str(slp_file), state, time.time(), UPLOADED),
+        )
+
+    def state(self, path):
+        if not self.enabled:
+            return None
+        row = self._connection().execute(
+            'SELECT state FROM outputs WHERE path = ?', (os.path.abspath(path),)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def states(self):
+        """
+        {path: state} for every output
+        """
+        if not self.enabled:
+            return {}
+        return dict(self._connection().execute('SELECT path, state FROM outputs'))
+
+    def clear(self):
+        if not self.enabled:
+            return
+        self._connection().execute('DELETE FROM outputs')
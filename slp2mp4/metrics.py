@@ -0,0 +1,127 @@
+import os
+import math
+import json
+import time
+import uuid
+import contextlib
+from collections import defaultdict
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a non-empty list
+    """
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+class Metrics:
+    """
+    Appends per-job stage timings to a JSON-lines file
+
+    Every pool worker appends to the same file; each record is one short
+    write to a file opened with O_APPEND, so lines don't interleave. With no
+    path configured, everything is a no-op.
+    """
+
+    def __init__(self, path=None, batch=None, job=None):
+        self.path = path
+        self.batch = batch or uuid.uuid4().hex
+        self.job = job
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def for_job(self, job, **fields):
+        """
+        Returns a Metrics whose records are tagged with `job`
+        """
+        metrics = Metrics(self.path, self.batch, str(job))
+        if fields:
+            metrics.emit('job', **fields)
+        return metrics
+
+    def emit(self, record_type, **fields):
+        if not self.enabled:
+            return
+        record = {
+            'type': record_type,
+            'time': time.time(),
+            'batch': self.batch,
+            'pid': os.getpid(),
+        }
+        if self.job is not None:
+            record['job'] = self.job
+        record.update(fields)
+        line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Times the with block; extra fields can be added to the yielded dict
+        """
+        fields = dict(fields)
+        start = time.monotonic()
+        try:
+            yield fields
+        finally:
+            self.emit('stage', stage=name, seconds=time.monotonic() - start, **fields)
+
+    def records(self, all_batches=False):
+        """
+        This batch's records, or with `all_batches` every record in the file
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if all_batches or record.get('batch') == self.batch:
+                    yield record
+
+    def summarize(self, wall_seconds, workers):
+        """
+        Per-stage count/total/p50/p95 for this batch plus worker utilization
+        The summary is also written to the metrics file
+        """
+        if not self.enabled:
+            return None
+
+        by_stage = defaultdict(list)
+        for record in self.records():
+            if record['type'] == 'stage':
+                by_stage[record['stage']].append(record['seconds'])
+
+        stages = {
+            stage: {
+                'count': len(seconds),
+                'total': sum(seconds),
+                'p50': percentile(seconds, 50),
+                'p95': percentile(seconds, 95),
+            }
+            for stage, seconds in by_stage.items()
+        }
+        busy = sum(by_stage.get('job', []))
+        summary = {
+            'wall_seconds': wall_seconds,
+            'workers': workers,
+            'utilization': busy / (wall_seconds * workers) if wall_seconds > 0 and workers > 0 else 0,
+            'stages': stages,
+        }
+        self.emit('summary', **summary)
+        return summary
+
+def print_summary(summary):
+    print(f"Worker utilization: {summary['utilization'] * 100:.0f}% of {summary['workers']} workers "
+          f"over {summary['wall_seconds']:.0f}s")
+    print(f'{"stage":20} {"count":>6} {"total":>10} {"p50":>8} {"p95":>8}')
+    for stage, s in sorted(summary['stages'].items(), key=lambda s: -s[1]['total']):
+        print(f"{stage:20} {s['count']:>6} {s['total']:>9.1f}s {s['p50']:>7.2f}s {s['p95']:>7.2f}s")
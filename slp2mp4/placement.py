@@ -0,0 +1,200 @@
+import os
+import sys
+import glob
+import queue
+from collections import namedtuple
+
+POLICIES = ('none', 'spread', 'pinned')
+# Niceness of ffmpeg under the "pinned" policy; below normal priority on Windows
+ENCODER_NICE = 10
+# How long a new pool worker waits for a slot number (see claim_worker_slot)
+CLAIM_TIMEOUT = 1.0
+
+# `cpus` is None to leave affinity alone; `gpu` is a RenderDevice's PCI address
+Placement = namedtuple('Placement', ['slot', 'cpus', 'nice', 'gpu', 'env'])
+RenderDevice = namedtuple('RenderDevice', ['pci', 'vendor', 'device'])
+
+# Set in pool workers by claim_worker_slot
+_worker_slot = None
+
+def claim_worker_slot(free_slots):
+    """
+    multiprocessing.Pool initializer: takes a slot number no other worker
+    has from `free_slots` (a multiprocessing.Queue)
+
+    A worker that replaces one that crashed finds the queue empty and runs
+    without a slot, i.e. unplaced.
+    """
+    global _worker_slot
+    try:
+        _worker_slot = free_slots.get(timeout=CLAIM_TIMEOUT)
+    except queue.Empty:
+        _worker_slot = None
+
+def worker_slot():
+    return _worker_slot
+
+def physical_cores():
+    """
+    The logical CPUs this process may run on, grouped by physical core: [[cpu, ...], ...]
+    Hyperthreads share a core on Linux; elsewhere each logical CPU is its own core
+    """
+    import psutil
+    try:
+        allowed = sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        # No affinity on macOS
+        return []
+    cores = {}
+    for cpu in allowed:
+        topology = f'/sys/devices/system/cpu/cpu{cpu}/topology'
+        try:
+            with open(os.path.join(topology, 'physical_package_id')) as f:
+                package = f.read().strip()
+            with open(os.path.join(topology, 'core_id')) as f:
+                core = f.read().strip()
+            key = (package, core)
+        except OSError:
+            key = cpu
+        cores.setdefault(key, []).append(cpu)
+    return list(cores.values())
+
+def render_devices():
+    """
+    GPUs with a DRM render node, on Linux
+    """
+    devices = []
+    for node in sorted(glob.glob('/sys/class/drm/renderD*')):
+        device_dir = os.path.realpath(os.path.join(node, 'device'))
+        try:
+            with open(os.path.join(device_dir, 'vendor')) as f:
+                vendor = f.read().strip()
+            with open(os.path.join(device_dir, 'device')) as f:
+                device = f.read().strip()
+        except OSError:
+            continue
+        # e.g. 0x10de
+        devices.append(RenderDevice(os.path.basename(device_dir), vendor[2:], device[2:]))
+    return devices
+
+def gpu_env(device):
+    """
+    Environment selecting `device` for Mesa's OpenGL and Vulkan drivers
+
+    Mesa's Vulkan device-select layer honours DRI_PRIME's PCI tag too. Its
+    MESA_VK_DEVICE_SELECT is vendor:device, the same for identical cards,
+    and would win over DRI_PRIME, so environment() leaves it unset.
+    """
+    return {'DRI_PRIME': 'pci-' + device.pci.replace(':', '_').replace('.', '_')}
+
+class PlacementPolicy:
+    """
+    Decides which CPUs and GPU each Dolphin slot gets, and where ffmpeg runs
+
+    "none" leaves everything to the OS. "spread" hands render devices out to
+    slots round-robin when there's more than one. "pinned" also gives each
+    slot its own physical cores (an equal share of all but one, which is left
+    for everything else) and runs ffmpeg on the cores no slot got, at lower
+    priority, so muxes and combines don't take CPU time from a Dolphin that
+    has to keep up with realtime.
+    """
+
+    def __init__(self, policy='none', slots=1, cores=None, devices=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown placement {policy!r}; expected one of {", ".join(POLICIES)}')
+        self.policy = policy
+        self.slots = max(1, slots)
+        self.cores = []
+        self.devices = []
+        if policy == 'pinned':
+            self.cores = physical_cores() if cores is None else cores
+        if policy != 'none':
+            self.devices = render_devices() if devices is None else devices
+
+    @classmethod
+    def from_config(cls, conf, slots):
+        devices = None
+        if conf.render_devices != 'auto':
+            devices = [d for d in render_devices() if d.pci in conf.render_devices]
+        return cls(conf.placement_policy, slots, devices=devices)
+
+    def _slot_cores(self, slot):
+        reserved = 1 if len(self.cores) > self.slots else 0
+        per_slot = max(1, (len(self.cores) - reserved) // self.slots)
+        return [self.cores[(slot * per_slot + i) % len(self.cores)] for i in range(per_slot)]
+
+    def dolphin(self, slot):
+        """
+        Placement for the Dolphin of `slot`; None if it isn't placed
+        """
+        if self.policy == 'none' or slot is None:
+            return None
+        cpus = None
+        if self.cores:
+            cpus = sorted(cpu for core in self._slot_cores(slot) for cpu in core)
+        gpu, env = None, {}
+        # A single GPU is what Dolphin picks anyway
+        if len(self.devices) > 1:
+            device = self.devices[slot % len(self.devices)]
+            gpu, env = device.pci, gpu_env(device)
+        return Placement(slot, cpus, 0, gpu, env)
+
+    def encoder(self):
+        """
+        Placement for ffmpeg; None if it isn't placed
+        """
+        if self.policy != 'pinned':
+            return None
+        cpus = None
+        if self.cores:
+            used = {cpu for slot in range(self.slots) for core in self._slot_cores(slot) for cpu in core}
+            free = sorted(cpu for core in self.cores for cpu in core if cpu not in used)
+            cpus = free or sorted(cpu for core in self.cores for cpu in core)
+        return Placement(None, cpus, ENCODER_NICE, None, {})
+
+def environment(placement):
+    """
+    `env` for Popen: this process's environment plus the placement's, or None
+    """
+    if placement is None or not placement.env:
+        return None
+    env = {**os.environ, **placement.env}
+    if placement.gpu is not None:
+        env.pop('MESA_VK_DEVICE_SELECT', None)
+    return env
+
+def apply(placement, pid):
+    """
+    Moves `pid`, its threads and its children to `placement`'s CPUs and priority
+
+    Called right after starting a process; threads and processes it starts
+    later inherit both. Unsupported platforms and processes that already
+    exited are ignored.
+    """
+    if placement is None:
+        return
+    import psutil
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    for p in procs:
+        try:
+            if placement.cpus is not None and hasattr(p, 'cpu_affinity'):
+                p.cpu_affinity(placement.cpus)
+            if placement.nice:
+                p.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if sys.platform == 'win32' else placement.nice)
+            if sys.platform.startswith('linux'):
+                # Affinity and niceness are per thread on Linux
+                for thread in p.threads():
+                    if thread.id == p.pid:
+                        continue
+                    if placement.cpus is not None:
+                        os.sched_setaffinity(thread.id, placement.cpus)
+                    if placement.nice:
+                        os.setpriority(os.PRIO_PROCESS, thread.id, placement.nice)
+        except (psutil.NoSuchProcess, ProcessLookupError):
+            continue
+        except (psutil.AccessDenied, PermissionError) as e:
+            print(f'Warning: could not place process {p.pid}: {e}', flush=True)
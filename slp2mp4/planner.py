@@ -0,0 +1,72 @@
+import os
+import shutil
+import statistics
+from collections import namedtuple, defaultdict
+
+REALTIME_FPS = 60
+# Per-game time outside rendering that the estimate always includes
+OVERHEAD_STAGES = ('user_dir_prep', 'dolphin_startup', 'mux')
+# Assumed for that time when the metrics file has none
+DEFAULT_OVERHEAD = 10.0
+AUDIO_DUMP_BYTES_PER_SECOND = 32000 * 2 * 2  # Dolphin's DSP dump: 32 kHz 16-bit stereo WAV
+MP3_BITRATE_KBPS = 128                       # ffmpeg's default when muxing the audio to mp3
+
+RenderRate = namedtuple('RenderRate', ['fps', 'overhead', 'samples'])
+Plan = namedtuple('Plan', ['games', 'skipped', 'frames', 'makespan', 'temp_bytes', 'output_bytes'])
+
+def historical_rate(metrics, resolution, unthrottled):
+    """
+    Median render fps and per-game overhead seen in the metrics file
+
+    Renders with the same `resolution` and throttling are used if there are
+    any, then any render; with no history at all Dolphin is assumed to run at
+    realtime. `samples` is how many renders the fps came from.
+    """
+    renders = []
+    overheads = defaultdict(list)
+    for record in metrics.records(all_batches=True):
+        if record.get('type') != 'stage':
+            continue
+        if record.get('stage') == 'render' and record.get('fps'):
+            renders.append(record)
+        elif record.get('stage') in OVERHEAD_STAGES:
+            overheads[record['stage']].append(record['seconds'])
+
+    matching = [
+        r for r in renders
+        if r.get('resolution') == resolution and r.get('unthrottled', False) == unthrottled
+    ]
+    renders = matching or renders
+    fps = statistics.median(r['fps'] for r in renders) if renders else REALTIME_FPS
+    overhead = sum(statistics.median(overheads[stage]) for stage in overheads) if overheads else DEFAULT_OVERHEAD
+    return RenderRate(fps, overhead, len(renders))
+
+def dump_bytes(seconds, bitrate_kbps):
+    """
+    Dolphin's dump of `seconds` of gameplay: H.264 frames at `bitrate_kbps` plus WAV audio
+
+    Dolphin encodes at a fixed bitrate, so `resolution` changes how fast a
+    game renders (see historical_rate) but not how big it is.
+    """
+    return seconds * (bitrate_kbps * 1000 / 8 + AUDIO_DUMP_BYTES_PER_SECOND)
+
+def mp4_bytes(seconds, bitrate_kbps):
+    """
+    A muxed mp4: the dumped video is copied as is and the audio encoded to mp3
+    """
+    return seconds * (bitrate_kbps + MP3_BITRATE_KBPS) * 1000 / 8
+
+def peak_temp_bytes(job_dump_bytes, slots):
+    """
+    Upper bound on scratch space: the `slots` biggest dumps on disk at once
+    """
+    return sum(sorted(job_dump_bytes, reverse=True)[:max(1, slots)])
+
+def free_bytes(path):
+    """
+    Free space on the filesystem `path` is (or would be created) on
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
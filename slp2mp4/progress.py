@@ -0,0 +1,89 @@
+import os
+import time
+from collections import deque
+
+from fswatch import DirWatcher
+
+# Render fps is averaged over this many seconds
+FPS_WINDOW = 2.0
+
+class RenderProgress:
+    """
+    Tracks frames Dolphin has rendered by tailing `render_time.txt`
+
+    Dolphin appends one line per rendered frame, so only bytes appended since
+    the last update are read.
+    """
+
+    def __init__(self, render_time_file, num_frames):
+        self.render_time_file = render_time_file
+        self.num_frames = num_frames
+        self.frames_done = 0
+        self.offset = 0
+        self.samples = deque()  # [(time, frames_done), ...]
+        self.watcher = DirWatcher(os.path.dirname(render_time_file))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.watcher.close()
+        # Re-raise any exception that occurred in the with block
+        if tb is not None:
+            return False
+
+    def update(self):
+        try:
+            with open(self.render_time_file, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < self.offset:
+                    # File was recreated
+                    self.offset = 0
+                    self.frames_done = 0
+                f.seek(self.offset)
+                appended = f.read(size - self.offset)
+        except FileNotFoundError:
+            appended = b''
+
+        # Only count complete lines
+        last_newline = appended.rfind(b'\n')
+        if last_newline >= 0:
+            self.frames_done += appended.count(b'\n', 0, last_newline + 1)
+            self.offset += last_newline + 1
+
+        now = time.monotonic()
+        self.samples.append((now, self.frames_done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > FPS_WINDOW:
+            self.samples.popleft()
+        return self.frames_done
+
+    def wait(self, timeout):
+        self.watcher.wait(timeout)
+
+    @property
+    def done(self):
+        return self.frames_done >= self.num_frames
+
+    @property
+    def fps(self):
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, f0), (t1, f1) = self.samples[0], self.samples[-1]
+        if t1 <= t0:
+            return 0.0
+        return (f1 - f0) / (t1 - t0)
+
+    @property
+    def eta(self):
+        """
+        Seconds left at the current fps, or None if nothing has rendered yet
+        """
+        fps = self.fps
+        if fps <= 0:
+            return None
+        return max(0, self.num_frames - self.frames_done) / fps
+
+    def __str__(self):
+        eta = self.eta
+        eta = '?' if eta is None else f'{eta:.0f}s'
+        return f'Rendered {self.frames_done}/{self.num_frames} frames ({self.fps:.1f} fps, ETA {eta})'
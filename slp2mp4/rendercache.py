@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import hashlib
+import uuid
+
+# Bump when a change to recording would make previously cached renders stale
+CACHE_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link_or_copy(src, dst):
+    """
+    Hardlinks `src` to `dst`, falling back to a copy across filesystems
+    `dst` is replaced atomically if it already exists
+    """
+    tmp = f'{dst}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+class RenderCache:
+    """
+    Content-addressed store of rendered mp4s
+
+    Entries are keyed by the replay's hash plus the config fields that affect
+    the render. Each entry has a `.used` sidecar whose mtime is bumped on
+    every hit, so pruning evicts least recently used entries first; the
+    entry itself is hardlinked to outputs, whose mtimes aren't ours to touch.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.max_bytes = max_bytes
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, conf):
+        if not conf.cache:
+            return None
+        return cls(conf.cache_dir, int(conf.cache_size_gb * 1024 ** 3))
+
+    @staticmethod
+    def dolphin_build(conf):
+        # Hashing the whole AppImage would cost more than most renders save
+        try:
+            st = os.stat(conf.dolphin_bin)
+            return f'{st.st_size}-{int(st.st_mtime)}'
+        except (OSError, TypeError):
+            return None
+
+    @classmethod
+    def key(cls, slp_hash, conf):
+        render_fields = {
+            'version': CACHE_VERSION,
+            'slp': slp_hash,
+            'resolution': conf.resolution,
+            'widescreen': conf.widescreen,
+            'bitrateKbps': conf.bitrateKbps,
+            'video_backend': conf.video_backend,
+            'dolphin': cls.dolphin_build(conf),
+        }
+        # Muxed differently; added only when set so existing keys stay valid
+        if conf.combine_format == 'hls':
+            render_fields['fragmented'] = True
+            render_fields['audio'] = 'aac'
+        return hashlib.sha256(json.dumps(render_fields, sort_keys=True).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.objects_dir, key + '.mp4')
+
+    @staticmethod
+    def used_path(entry):
+        return os.path.splitext(entry)[0] + '.used'
+
+    def touch(self, entry):
+        with open(self.used_path(entry), 'a'):
+            pass
+        os.utime(self.used_path(entry))
+
+    def fetch(self, key, outfile):
+        """
+        Materializes a cached render at `outfile`; returns False on a miss
+        """
+        entry = self.entry_path(key)
+        try:
+            link_or_copy(entry, outfile)
+        except FileNotFoundError:
+            return False
+        self.touch(entry)
+        return True
+
+    def store(self, key, mp4):
+        if os.path.exists(mp4):
+            link_or_copy(mp4, self.entry_path(key))
+            self.touch(self.entry_path(key))
+
+    def entries(self):
+        """
+        Returns [(path, size, last used), ...] sorted from least to most recently used
+        """
+        entries = []
+        for e in os.scandir(self.objects_dir):
+            if not e.name.endswith('.mp4'):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            try:
+                used = os.stat(self.used_path(e.path)).st_mtime
+            except FileNotFoundError:
+                # Stored before sidecars existed
+                used = st.st_mtime
+            entries.append((e.path, st.st_size, used))
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def stats(self):
+        entries = self.entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def prune(self, max_bytes=None):
+        """
+        Evicts least recently used entries until the cache fits in `max_bytes`
+        Returns (entries_removed, bytes_removed)
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed, removed_bytes = 0, 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            for f in (path, self.used_path(path)):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+            removed_bytes += size
+        return removed, removed_bytes
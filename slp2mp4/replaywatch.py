@@ -0,0 +1,146 @@
+import os
+import time
+from collections import namedtuple
+
+import slpprobe
+from fswatch import DirWatcher
+
+# Slippi appends to a replay every frame; don't rescan the tree more often than this
+MIN_SCAN_INTERVAL = 0.5
+
+ReplaySet = namedtuple('ReplaySet', ['folder', 'players', 'outfiles'])
+
+class ReplayWatcher:
+    """
+    Finds replays under a folder once Slippi has finished writing them
+
+    A replay is complete once its metadata block has been written, or if its
+    size hasn't changed for `stable_seconds` (e.g. Dolphin crashed mid-game).
+    inotify wakes the watcher as soon as the top folder changes; subfolders
+    are picked up by rescanning at least every `poll_interval` seconds.
+    """
+
+    def __init__(self, directory, stable_seconds=30, include_existing=False, poll_interval=1.0):
+        self.directory = directory
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.files = {}  # {path: [size, last change, complete]}
+        self.last_scan = 0
+        self.watcher = DirWatcher(directory, poll_interval=poll_interval)
+
+        # Finished replays already there are assumed to have been recorded by
+        # `run`; one Slippi is still writing goes through the usual checks
+        if not include_existing:
+            self.scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+        # Re-raise any exception that occurred in the with block
+        if tb is not None:
+            return False
+
+    def close(self):
+        self.watcher.close()
+
+    def poll(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for changes; returns newly completed replays
+        """
+        self.watcher.wait(self.poll_interval if timeout is None else timeout)
+        delay = self.last_scan + MIN_SCAN_INTERVAL - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return self.scan()
+
+    def scan(self):
+        now = time.monotonic()
+        self.last_scan = now
+        completed = []
+        for root, _, fs in os.walk(self.directory):
+            for f in fs:
+                if not f.endswith('.slp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+
+                entry = self.files.get(path)
+                if entry is None:
+                    entry = self.files[path] = [size, now, False]
+                elif entry[0] != size:
+                    entry[0] = size
+                    entry[1] = now
+                if entry[2]:
+                    continue
+                if slpprobe.has_metadata(path) or now - entry[1] >= self.stable_seconds:
+                    entry[2] = True
+                    completed.append(path)
+        return completed
+
+    def last_activity(self, folder):
+        """
+        When a replay in `folder` last appeared or grew
+        """
+        return max((entry[1] for path, entry in self.files.items() if os.path.dirname(path) == folder), default=0)
+
+    def in_progress(self, folder):
+        return any(not entry[2] for path, entry in self.files.items() if os.path.dirname(path) == folder)
+
+def player_key(players):
+    """
+    Identifies who played from probed metadata: connect codes or netplay names per port
+
+    Offline replays often have no names, in which case only the ports in use
+    are compared.
+    """
+    key = []
+    for port, player in sorted(players.items()):
+        names = player.get('names') or {}
+        key.append((port, names.get('code') or names.get('netplay') or ''))
+    return tuple(key)
+
+class SetTracker:
+    """
+    Groups completed replays into sets: consecutive games in a folder between the same players
+
+    A set is over when a game between different players finishes in its
+    folder, or when nothing in the folder has changed for `idle_seconds`.
+    """
+
+    def __init__(self, idle_seconds=300):
+        self.idle_seconds = idle_seconds
+        self.open_sets = {}  # {folder: ReplaySet}
+
+    def add(self, folder, players, outfile):
+        """
+        Adds a finished replay; returns the set it ended, if any
+        """
+        closed = None
+        current = self.open_sets.get(folder)
+        if current is not None and current.players != players:
+            closed = self.open_sets.pop(folder)
+        self.open_sets.setdefault(folder, ReplaySet(folder, players, [])).outfiles.append(outfile)
+        return closed
+
+    def close_idle(self, watcher):
+        """
+        Ends and returns sets whose folders have gone quiet
+        """
+        now = time.monotonic()
+        closed = []
+        for folder in list(self.open_sets):
+            if watcher.in_progress(folder):
+                continue
+            if now - watcher.last_activity(folder) >= self.idle_seconds:
+                closed.append(self.open_sets.pop(folder))
+        return closed
+
+    def close_all(self):
+        closed = list(self.open_sets.values())
+        self.open_sets = {}
+        return closed
@@ -0,0 +1,73 @@
+import heapq
+import queue
+import time
+from collections import namedtuple
+
+JobResult = namedtuple('JobResult', ['job', 'result', 'error', 'elapsed'])
+
+def lpt_order(jobs, costs):
+    """
+    Orders jobs longest-processing-time-first
+    """
+    return [job for _, job in sorted(zip(costs, jobs), key=lambda c: c[0], reverse=True)]
+
+def predict_makespan(costs, slots):
+    """
+    Simulates list scheduling of `costs` (in order) over `slots` workers
+    """
+    finish_times = [0] * max(1, slots)
+    for cost in costs:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + cost)
+    return max(finish_times)
+
+class Scheduler:
+    """
+    Feeds jobs to a multiprocessing pool with at most `slots` jobs in flight,
+    yielding each job's result as soon as it completes
+
+    With a `controller` (see autoscale.ParallelismController), `slots` is
+    re-evaluated every `controller.interval` seconds; the pool must have at
+    least `controller.max_slots` processes.
+    """
+
+    def __init__(self, pool, func, slots, controller=None):
+        self.pool = pool
+        self.func = func
+        self.slots = slots
+        self.controller = controller
+        self.completed = queue.Queue()
+
+    def _submit(self, job):
+        start = time.monotonic()
+
+        def done(result):
+            self.completed.put(JobResult(job, result, None, time.monotonic() - start))
+
+        def failed(error):
+            self.completed.put(JobResult(job, None, error, time.monotonic() - start))
+
+        self.pool.apply_async(self.func, job, callback=done, error_callback=failed)
+
+    def run(self, jobs):
+        pending = list(jobs)
+        pending.reverse()  # pop() from the end keeps the given order
+        in_flight = 0
+        while pending or in_flight:
+            while pending and in_flight < self.slots:
+                self._submit(pending.pop())
+                in_flight += 1
+            if self.controller is None:
+                yield self.completed.get()
+                in_flight -= 1
+                continue
+
+            try:
+                result = self.completed.get(timeout=self.controller.interval)
+            except queue.Empty:
+                result = None
+            else:
+                in_flight -= 1
+            # Shrinking only lets in-flight jobs finish; nothing is interrupted
+            self.slots = self.controller.update(self.slots, bool(pending) and in_flight >= self.slots)
+            if result is not None:
+                yield result
@@ -9,19 +9,30 @@ import uuid
 import multiprocessing
 import glob
 import argparse
+import posixpath
+import queue
+import signal
 import tempfile
+import threading
 from pathlib import Path
 from collections import namedtuple
-import zipfile
-
-from slippi import Game
-import psutil
-import natsort
-from youtube_uploader_selenium import YouTubeUploader
 
 from config import Config
 from dolphinrunner import DolphinRunner
-from ffmpegrunner import FfmpegRunner
+from ffmpegrunner import FfmpegRunner, write_concat_file
+import slpprobe
+from rendercache import RenderCache, link_or_copy
+from scheduler import Scheduler, JobResult, lpt_order, predict_makespan
+from usertemplate import UserDirTemplate
+from metrics import print_summary
+from uploadqueue import UploadQueue, StubUploader
+from replaywatch import ReplayWatcher, SetTracker, player_key
+from journal import JobJournal, QUEUED, RENDERING, MUXED, COMBINED, UPLOADED, SKIPPED, RENDERED_STATES
+from zipsource import ZipSlp, is_zip, index_zip, hash_slp, probe_slp, estimate_duration, read_sibling, extract_slp, remove_slp
+import planner
+import events
+import hls
+from placement import PlacementPolicy, claim_worker_slot
 
 FPS = 60
 MIN_GAME_LENGTH = 30 * FPS
@@ -34,11 +45,45 @@ def is_game_too_short(num_frames, remove_short):
     return num_frames < MIN_GAME_LENGTH and remove_short
 
 def get_num_processes(conf):
+    import psutil
     if conf.parallel_games == "recommended":
         return psutil.cpu_count(logical=False)
+    elif conf.parallel_games == "auto":
+        # Upper bound; ParallelismController picks how many are used
+        return psutil.cpu_count(logical=True)
     else:
         return int(conf.parallel_games)
 
+def place_slots(conf, slots):
+    """
+    Sets up `conf.placement` for `slots` Dolphins at once and records where ffmpeg runs
+    """
+    conf.placement = PlacementPolicy.from_config(conf, slots)
+    encoder = conf.placement.encoder()
+    if encoder is not None:
+        conf.metrics.emit('placement', process='ffmpeg', cpus=encoder.cpus, nice=encoder.nice)
+
+def init_pool_worker(free_slots, event_queue, ignore_sigint=False):
+    if ignore_sigint:
+        # The main process decides what Ctrl-C stops; Dolphin inherits this
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    claim_worker_slot(free_slots)
+    events.init_worker(event_queue)
+
+def make_pool(num_processes, ignore_sigint=False):
+    """
+    A pool whose workers each claim a slot number, for placement, and send
+    their progress events to this process's events.EventStream
+    """
+    free_slots = multiprocessing.Queue()
+    for slot in range(num_processes):
+        free_slots.put(slot)
+    return multiprocessing.Pool(
+        processes=num_processes,
+        initializer=init_pool_worker,
+        initargs=(free_slots, events.current_queue(), ignore_sigint),
+    )
+
 def safe_remove_file(f):
     try:
         os.remove(f)
@@ -46,15 +91,7 @@ def safe_remove_file(f):
         pass
 
 SlpMp4Obj = namedtuple('SlpMp4Obj', ['slp_file', 'outfile', 'conf'])
-ToCombineObj = namedtuple('ToCombineObj', ['vids', 'outname'])
-
-def extract_zip(zip_path, extract_to):
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
-    return extract_to
-
-def is_zip(file_path):
-    return file_path.lower().endswith('.zip')
+ToCombineObj = namedtuple('ToCombineObj', ['vids', 'outname', 'outdir'])
 
 def format_title(title_template, context):
     tournament = context['startgg']['tournament']['name']
@@ -66,6 +103,8 @@ def format_title(title_template, context):
 # YouTube upload
 ###############################################################################
 def upload_to_youtube(video_path, metadata_path):
+    # Selenium takes a while to import; most runs never upload
+    from youtube_uploader_selenium import YouTubeUploader
     uploader = YouTubeUploader(video_path, metadata_path)
     was_video_uploaded, video_id = uploader.upload()
     if was_video_uploaded:
@@ -74,69 +113,335 @@ def upload_to_youtube(video_path, metadata_path):
         print("Failed to upload video.")
     return was_video_uploaded, video_id
 
+def youtube_uploader(video_path, metadata):
+    """
+    UploadQueue uploader for YouTube
+    """
+    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.json') as tmp:
+        json.dump(metadata, tmp)
+        metadata_path = tmp.name
+    try:
+        return upload_to_youtube(video_path, metadata_path)
+    finally:
+        os.unlink(metadata_path)
+
+def make_upload_queue(outdir, conf, youtube_options):
+    if not (youtube_options and youtube_options['enabled']):
+        return None
+    if youtube_options.get('stub_dir'):
+        uploader = StubUploader(youtube_options['stub_dir'])
+    else:
+        uploader = youtube_uploader
+
+    def journaled_uploader(video_path, metadata):
+        uploaded, video_id = uploader(video_path, metadata)
+        if uploaded:
+            conf.journal.set_state(video_path, UPLOADED)
+        return uploaded, video_id
+
+    return UploadQueue(
+        os.path.join(outdir, '.slp2mp4-uploads'),
+        journaled_uploader,
+        concurrency=conf.upload_concurrency,
+        retries=conf.upload_retries,
+        metrics=conf.metrics,
+    )
+
 ###############################################################################
 # Run logic
 ###############################################################################
-def record_file_slp(slp_file, outfile, conf, youtube_options):
-    # Parse file with py-slippi to determine number of frames
-    slippi_game = Game(slp_file)
-    num_frames = slippi_game.metadata.duration + DURATION_BUFFER
+def get_num_frames(slp_file, conf, duration=None):
+    """
+    Returns the number of frames to record, or None if the game should be skipped
+    """
+    # Probe file to determine number of frames
+    if duration is None:
+        with conf.metrics.stage('probe'):
+            duration = probe_slp(slp_file).duration
+    if duration is None:
+        print(f"Warning: couldn't determine the length of {slp_file}; skipping")
+        return None
 
-    if is_game_too_short(slippi_game.metadata.duration, conf.remove_short):
+    if is_game_too_short(duration, conf.remove_short):
         print("Warning: Game is less than 30 seconds and won't be recorded. Override in config.")
-        return
+        return None
+
+    return duration + DURATION_BUFFER
+
+def av_in_sync(ffmpeg_runner, outfile, num_frames, conf):
+    """
+    Checks that an unthrottled render has the expected number of frames and length of audio
+    """
+    info = ffmpeg_runner.probe_av(outfile)
+    if info is None:
+        print('Warning: ffprobe not found; skipping A/V sync check')
+        return True
+
+    tolerance = conf.av_sync_tolerance_frames
+    video_ok = info.video_frames is not None and abs(info.video_frames - num_frames) <= tolerance
+    audio_ok = info.audio_seconds is not None and abs(info.audio_seconds * FPS - num_frames) <= tolerance
+    if not (video_ok and audio_ok):
+        print(f'Warning: {outfile} is out of sync: expected {num_frames} frames, '
+              f'got {info.video_frames} video frames and {info.audio_seconds}s of audio')
+    return video_ok and audio_ok
+
+# The steps of rendering and recording a game are shared by both engines;
+# render_slp and record_file_slp run them, and their _async versions await them
+def game_muxer(conf, dolphin_runner):
+    return FfmpegRunner(
+        conf.ffmpeg,
+        dolphin_runner.metrics,
+        fragmented=conf.combine_format == 'hls',
+        placement=dolphin_runner.encoder_placement,
+    )
+
+def needs_realtime(ffmpeg_runner, slp_file, outfile, num_frames, conf):
+    """
+    Unthrottled renders fall back to realtime if audio and video drifted
+    """
+    if not conf.unthrottled or av_in_sync(ffmpeg_runner, outfile, num_frames, conf):
+        return False
+    print(f'Re-recording {slp_file} in realtime')
+    return True
+
+def start_job(slp_file, outfile, conf):
+    """
+    Returns the job id and metrics of a game about to be recorded
+    """
+    job_id = uuid.uuid4()
+    metrics = conf.metrics.for_job(job_id, slp_file=str(slp_file), outfile=outfile)
+    events.emit('job_started', job=str(job_id), slp=str(slp_file), outfile=outfile)
+    return job_id, metrics
+
+def fetch_cached(slp_file, outfile, conf, cache_key, fields):
+    """
+    Fills `outfile` from the render cache if it has the game; otherwise marks it as rendering
+    """
+    cache = RenderCache.from_config(conf)
+    if cache is not None and cache_key is not None and cache.fetch(cache_key, outfile):
+        print(f'Using cached render for {slp_file}')
+        fields['cached'] = True
+        return True
+    conf.journal.set_state(outfile, RENDERING)
+    return False
+
+def finish_job(slp_file, outfile, conf, youtube_options, cache_key, rendered, fields):
+    """
+    The rest of record_file_slp once the game was rendered, found in the cache, or skipped (`rendered` is False)
+    """
+    if not rendered:
+        fields['skipped'] = True
+        conf.journal.set_state(outfile, SKIPPED)
+        return []
+    cache = RenderCache.from_config(conf)
+    if not fields.get('cached') and cache is not None and cache_key is not None:
+        cache.store(cache_key, outfile)
+
+    conf.journal.set_state(outfile, MUXED)
+    return finish_recording(slp_file, outfile, conf, youtube_options)
 
+def render_slp(slp_file, outfile, conf, duration=None, job_id=None, slot=None):
+    """
+    Renders a single replay to `outfile`; returns False if it was skipped
+    `slot` picks the User dir when one process renders several games at once
+    """
+    num_frames = get_num_frames(slp_file, conf, duration)
+    if num_frames is None:
+        return False
+
+    if job_id is None:
+        job_id = uuid.uuid4()
     with tempfile.TemporaryDirectory() as tmpdir:
-        with DolphinRunner(conf, conf.paths, tmpdir, uuid.uuid4()) as dolphin_runner:
-            video_file, audio_file = dolphin_runner.run(slp_file, num_frames)
+        # Replays in a zip are only extracted now, next to the job's other temp files
+        slp_file = extract_slp(slp_file, tmpdir)
+        with DolphinRunner(conf, conf.paths, tmpdir, job_id, conf.user_dir_template, slot) as dolphin_runner:
+            video_files, audio_file = dolphin_runner.run(slp_file, num_frames)
 
             # Encode
-            ffmpeg_runner = FfmpegRunner(conf.ffmpeg)
-            ffmpeg_runner.run(video_file, audio_file, outfile)
+            ffmpeg_runner = game_muxer(conf, dolphin_runner)
+            ffmpeg_runner.run(video_files, audio_file, outfile)
 
-            if conf.remove_slps:
-                safe_remove_file(slp_file)
+            if needs_realtime(ffmpeg_runner, slp_file, outfile, num_frames, conf):
+                video_files, audio_file = dolphin_runner.run(slp_file, num_frames, emulation_speed=1.0)
+                ffmpeg_runner.run(video_files, audio_file, outfile)
 
-            print('Created {}'.format(outfile))
+    return True
 
-    # YouTube upload
-    if youtube_options and youtube_options['enabled']:
-        context_file = os.path.join(os.path.dirname(slp_file), 'context.json')
-        if os.path.exists(context_file):
-            with open(context_file, 'r') as f:
-                context = json.load(f)
-            title = format_title(youtube_options['title_template'], context)
+def record_file_slp(slp_file, outfile, conf, youtube_options, cache_key=None, duration=None):
+    job_id, metrics = start_job(slp_file, outfile, conf)
+    with metrics.stage('job') as fields:
+        rendered = fetch_cached(slp_file, outfile, conf, cache_key, fields) \
+            or render_slp(slp_file, outfile, conf, duration, job_id)
+        return finish_job(slp_file, outfile, conf, youtube_options, cache_key, rendered, fields)
+
+async def render_slp_async(slot, slp_file, outfile, conf, duration=None, job_id=None):
+    """
+    render_slp for the async engine; `slot` picks the User dir
+    """
+    import asyncengine
+
+    num_frames = get_num_frames(slp_file, conf, duration)
+    if num_frames is None:
+        return False
+
+    if job_id is None:
+        job_id = uuid.uuid4()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        slp_file = await asyncengine.to_thread(extract_slp, slp_file, tmpdir)
+        with DolphinRunner(conf, conf.paths, tmpdir, job_id, conf.user_dir_template, slot) as dolphin_runner:
+            video_files, audio_file = await asyncengine.run_dolphin(dolphin_runner, slp_file, num_frames)
+
+            ffmpeg_runner = game_muxer(conf, dolphin_runner)
+            await asyncengine.mux(ffmpeg_runner, video_files, audio_file, outfile)
+
+            if await asyncengine.to_thread(needs_realtime, ffmpeg_runner, slp_file, outfile, num_frames, conf):
+                video_files, audio_file = await asyncengine.run_dolphin(
+                    dolphin_runner, slp_file, num_frames, emulation_speed=1.0,
+                )
+                await asyncengine.mux(ffmpeg_runner, video_files, audio_file, outfile)
+
+    return True
+
+async def record_file_slp_async(slot, slp_file, outfile, conf, youtube_options, cache_key=None, duration=None):
+    """
+    record_file_slp for the async engine
+    """
+    import asyncengine
+
+    job_id, metrics = start_job(slp_file, outfile, conf)
+    with metrics.stage('job') as fields:
+        rendered = await asyncengine.to_thread(fetch_cached, slp_file, outfile, conf, cache_key, fields) \
+            or await render_slp_async(slot, slp_file, outfile, conf, duration, job_id)
+        return await asyncengine.to_thread(
+            finish_job, slp_file, outfile, conf, youtube_options, cache_key, rendered, fields,
+        )
+
+async def render_batch(jobs, conf, concurrency=None, youtube_options=None, controller=None):
+    """
+    Renders replays from a single process, yielding a scheduler.JobResult per game as it finishes
+
+        async for result in render_batch([('game.slp', 'game.mp4')], Config()):
+            ...
+
+    Jobs are (slp_file, outfile) pairs or full `record_file_slp` arguments;
+    each result's `job` is the full form. Breaking out of the loop kills
+    the games still rendering.
+    """
+    import asyncengine
+
+    if concurrency is None:
+        concurrency = get_num_processes(conf) if controller is None else controller.start
+    jobs = (
+        job if len(job) > 2 else (job[0], job[1], conf, youtube_options, None, None)
+        for job in jobs
+    )
+
+    # Embedders don't have a batch-wide User dir template yet
+    template_root = None
+    if conf.user_dir_template is None:
+        template_root = tempfile.TemporaryDirectory(prefix='slp2mp4-')
+        with conf.metrics.stage('user_dir_template'):
+            conf.user_dir_template = UserDirTemplate(conf, template_root.name).build()
+    try:
+        async for result in asyncengine.run_jobs(jobs, record_file_slp_async, concurrency, controller):
+            yield result
+    finally:
+        if template_root is not None:
+            conf.user_dir_template = None
+            template_root.cleanup()
+
+# Settings a worker takes from the coordinator, so every game of a batch renders the same way
+RENDER_OPTIONS = ('resolution', 'widescreen', 'bitrateKbps', 'video_backend', 'unthrottled', 'remove_short', 'combine_format')
+
+def render_options(conf):
+    return {name: getattr(conf, name) for name in RENDER_OPTIONS}
+
+def finish_served_job(job, rendered, dolphin_build):
+    """
+    The rest of record_file_slp, on the coordinator, once a worker has sent back `job`'s mp4 or skipped it
+    """
+    slp_file, outfile, conf, youtube_options, cache_key, _ = job
+    if not rendered:
+        conf.journal.set_state(outfile, SKIPPED)
+        return []
+    cache = RenderCache.from_config(conf)
+    # The key is built for this machine's Dolphin; another build's render isn't what it promises
+    if cache is not None and cache_key is not None and dolphin_build == RenderCache.dolphin_build(conf):
+        cache.store(cache_key, outfile)
+    conf.journal.set_state(outfile, MUXED)
+    return finish_recording(slp_file, outfile, conf, youtube_options)
+
+def serve_jobs(coordinator, jobs, conf):
+    """
+    Like Scheduler.run, but games without a cached render are rendered by
+    `coordinator`'s workers; cached ones never leave this machine
+    """
+    cache = RenderCache.from_config(conf)
+    remote = []
+    for job in jobs:
+        slp_file, outfile, _, youtube_options, cache_key, _ = job
+        if cache is not None and cache_key is not None and cache.fetch(cache_key, outfile):
+            print(f'Using cached render for {slp_file}')
+            conf.journal.set_state(outfile, MUXED)
+            yield JobResult(job, finish_recording(slp_file, outfile, conf, youtube_options), None, 0)
         else:
-            title = os.path.basename(outfile)
-
-        metadata = {
-            "title": title,
-            "description": youtube_options['description'],
-            "tags": youtube_options['tags'],
-            "privacyStatus": youtube_options['privacy']
-        }
-        
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.json') as tmp:
-            json.dump(metadata, tmp)
-            metadata_path = tmp.name
-
-        upload_to_youtube(outfile, metadata_path)
-        os.unlink(metadata_path)
+            remote.append(job)
+    # Workers render and mux the way this machine's config says
+    yield from coordinator.run(remote, finish_served_job, render_options(conf))
+
+def finish_recording(slp_file, outfile, conf, youtube_options):
+    """
+    Returns [(mp4, upload_metadata)] for the parent's upload queue, if uploading
+    """
+    if conf.remove_slps:
+        remove_slp(slp_file)
+
+    print('Created {}'.format(outfile))
+    events.emit('output_ready', path=os.path.abspath(outfile), kind='game')
+
+    # YouTube upload happens in the parent so render workers don't wait on it
+    if youtube_options and youtube_options['enabled']:
+        return [(outfile, upload_metadata(slp_file, outfile, youtube_options))]
+
+    return []
+
+def upload_metadata(slp_file, outfile, youtube_options):
+    context = read_sibling(slp_file, 'context.json')
+    if context is not None:
+        title = format_title(youtube_options['title_template'], json.loads(context))
+    else:
+        title = os.path.basename(outfile)
+
+    return {
+        "title": title,
+        "description": youtube_options['description'],
+        "tags": youtube_options['tags'],
+        "privacyStatus": youtube_options['privacy']
+    }
 
 def combine(mp4s, out, conf):
-    # Creates concat file
-    tmp = tempfile.NamedTemporaryFile(mode='w+', delete=False)
     for mp4 in mp4s:
-        mp4 = os.path.abspath(mp4)
-        print(mp4)
-        tmp.write(f"file '{mp4}'\n")
-    tmp.close()
+        print(os.path.abspath(mp4))
     out = os.path.abspath(out)
+    events.emit('stage', job=None, stage='combining', outfile=out)
 
-    ffmpeg_runner = FfmpegRunner(conf.ffmpeg)
-    ffmpeg_runner.combine(tmp.name, out)
+    if conf.combine_format == 'hls':
+        # The playlist points into the per-game mp4s; nothing is copied
+        with conf.metrics.stage('combine', outfile=out):
+            hls.write_playlist(out, mp4s, complete=True)
+    else:
+        # Creates concat file
+        concat_file = write_concat_file(mp4s)
+        ffmpeg_runner = FfmpegRunner(conf.ffmpeg, conf.metrics, placement=conf.placement.encoder())
+        try:
+            ffmpeg_runner.combine(concat_file, out)
+        finally:
+            os.unlink(concat_file)
 
-    os.unlink(tmp.name)
+    for mp4 in mp4s:
+        conf.journal.set_state(mp4, COMBINED)
+    conf.journal.set_state(out, COMBINED)
+    events.emit('output_ready', path=out, kind='combined')
 
 def is_slp(slp):
     return slp.endswith('.slp')
@@ -144,24 +449,76 @@ def is_slp(slp):
 def get_mp4_name(slp):
     return '.'.join(os.path.splitext(slp)[:-1]) + '.mp4'
 
-def record_files(infiles, outdir, conf, youtube_options):
+def get_combined_name(name, conf):
+    # With `combine_format: "hls"`, a group is combined into a playlist
+    return name + ('.m3u8' if conf.combine_format == 'hls' else '.mp4')
+
+def write_partial_playlist(mp4s, out):
+    """
+    CombinePipeline's `update` for HLS: the games of a group finished so far
+    """
+    try:
+        hls.write_playlist(out, mp4s, complete=False)
+    except (OSError, ValueError) as e:
+        print(f'Warning: could not update {out}: {e}', flush=True)
+
+def map_inputs(infiles, outdir, conf):
+    """
+    Works out every replay's mp4 and how mp4s are grouped into combined mp4s
+    Returns [SlpMp4Obj, ...], [ToCombineObj, ...], [output directory to create, ...]
+    """
+    from natsort import natsorted
+
     file_mappings = [] # [SlpMp4Obj, ...]
     to_combine = []    # [ToCombineObj, ...]
     individual_mp4s = []
-    created_dirs = []
+    new_dirs = []
+
+    def add_group(slps, cur_outdir, final_mp4_name):
+        """
+        Maps a folder's replays (`slps`: [(slp, file name), ...]) to mp4s combined into `final_mp4_name`
+        """
+        cur_combine = []
+        created_outdir = None
+        for slp, f in slps:
+            if not is_slp(f):
+                continue
+            mp4_name = os.path.join(cur_outdir, get_mp4_name(f))
+            file_mappings.append(SlpMp4Obj(slp, mp4_name, conf))
+            cur_combine.append(mp4_name)
+
+        # Skips empty directories
+        if len(cur_combine) == 0:
+            return
+
+        if not Path(cur_outdir).is_dir():
+            new_dirs.append(cur_outdir)
+            created_outdir = cur_outdir
+        cur_combine = natsorted(cur_combine)
+
+        to_combine.append(ToCombineObj(cur_combine, os.path.join(outdir, final_mp4_name), created_outdir))
 
     # Determines groupings and output names
     for infile in infiles:
-        # Handle zip files
+        # Zip files are grouped like the directory they'd extract to; replays
+        # are read from the archive by the job that renders them
         if is_zip(infile):
             zip_name = os.path.splitext(os.path.basename(infile))[0]
-            extract_dir = os.path.join(os.path.dirname(infile), zip_name)
-            extracted_path = extract_zip(infile, extract_dir)
-            infile = extracted_path
-            created_dirs.append(extract_dir)
+            folders = {}
+            for slp in index_zip(infile):
+                folder, f = posixpath.split(slp.member)
+                folders.setdefault(folder, []).append((slp, f))
+            for folder, slps in folders.items():
+                # Archive paths can't be trusted to stay inside the output directory
+                parts = [part for part in folder.split('/') if part not in ('', '.', '..')]
+                add_group(
+                    slps,
+                    os.path.join(outdir, zip_name, *(parts or ['.'])),
+                    get_combined_name(parts[-1] if parts else zip_name, conf),
+                )
 
         # Individual files just become mp4s and, if combined, are named `out.mp4`
-        if os.path.isfile(infile):
+        elif os.path.isfile(infile):
             if not is_slp(infile):
                 continue
             outfile = get_mp4_name(os.path.join(outdir, Path(infile).parts[-1]))
@@ -177,40 +534,226 @@ def record_files(infiles, outdir, conf, youtube_options):
                     parent,
                     os.path.relpath(subdir, infile)
                 )
-                cur_combine = []
-                for f in fs:
-                    if not is_slp(f):
-                        continue
-                    mp4_name = os.path.join(cur_outdir, get_mp4_name(f))
-                    file_mappings.append(SlpMp4Obj(os.path.join(subdir, f), mp4_name, conf))
-                    cur_combine.append(mp4_name)
-
-                # Skips empty directories
-                if len(cur_combine) == 0:
-                    continue
-
-                if not Path(cur_outdir).is_dir():
-                    created_dirs.append(cur_outdir)
-                    os.makedirs(cur_outdir)
-                cur_combine = natsort.natsorted(cur_combine)
-
-                final_mp4_name = Path(subdir).name + '.mp4'
-                to_combine.append(ToCombineObj(cur_combine, os.path.join(outdir, final_mp4_name)))
+                add_group(
+                    [(os.path.join(subdir, f), f) for f in fs],
+                    cur_outdir,
+                    get_combined_name(Path(subdir).name, conf),
+                )
 
     if len(individual_mp4s) > 0:
-        to_combine.append(ToCombineObj(individual_mp4s, os.path.join(outdir, 'out.mp4')))
+        to_combine.append(ToCombineObj(individual_mp4s, os.path.join(outdir, get_combined_name('out', conf)), None))
+
+    return file_mappings, to_combine, new_dirs
+
+def record_files(infiles, outdir, conf, youtube_options, resume=False, coordinator=None):
+    """
+    Records (and combines and uploads) everything in `infiles` into `outdir`
+
+    With a `coordinator` (see distributed.Coordinator), games are rendered by
+    remote workers instead of locally.
+    """
+    file_mappings, to_combine, created_dirs = map_inputs(infiles, outdir, conf)
+    for d in created_dirs:
+        os.makedirs(d, exist_ok=True)
+
+    # The journal lets a later `run --resume` skip whatever this run finishes
+    conf.journal = JobJournal(os.path.join(outdir, '.slp2mp4-journal.sqlite'))
+    if not resume:
+        conf.journal.clear()
+    states = conf.journal.states()
+
+    def already_done(path, done_states):
+        state = states.get(os.path.abspath(path))
+        return state in done_states and (state == SKIPPED or os.path.exists(path))
+
+    # Games whose mp4 (or whose folder's combined mp4) a previous run finished aren't recorded again
+    resumed = []
+    if resume:
+        combined = [group for group in to_combine if already_done(group.outname, (COMBINED,))]
+        to_combine = [group for group in to_combine if group not in combined]
+        combined_mp4s = {mp4 for group in combined for mp4 in group.vids}
+        remaining = []
+        for mapping in file_mappings:
+            if mapping.outfile in combined_mp4s:
+                continue
+            if already_done(mapping.outfile, RENDERED_STATES):
+                resumed.append(mapping)
+            else:
+                remaining.append(mapping)
+        file_mappings = remaining
+        print(f'Resuming: {len(combined)} combined mp4s and {len(resumed)} games already done')
+
+    # Identical replays are only rendered once per batch
+    cache = RenderCache.from_config(conf)
+    jobs = []
+    duplicates = {}  # {outfile_of_first_copy: [(slp, outfile), ...]}
+    rendered_by_key = {}
+    for slp, out, _ in file_mappings:
+        conf.journal.set_state(out, QUEUED, slp)
+        key = RenderCache.key(hash_slp(slp), conf)
+        if key in rendered_by_key:
+            duplicates.setdefault(rendered_by_key[key], []).append((slp, out))
+            continue
+        rendered_by_key[key] = out
+        jobs.append((slp, out, conf, youtube_options, key))
+
+    # Longest games go first so a long game doesn't run alone at the end.
+    # Probing a replay in an archive means inflating it, which would hold up
+    # the batch; their workers probe them and they're ordered by size instead
+    loose = [slp for slp, *_ in jobs if not isinstance(slp, ZipSlp)]
+    with conf.metrics.stage('probe_batch', games=len(loose)):
+        probes = dict(zip(loose, slpprobe.probe_many(loose, probe_func=probe_slp)))
+    jobs = [job + (probes[job[0]].duration if job[0] in probes else None,) for job in jobs]
+
+    def expected_duration(job):
+        slp, duration = job[0], job[-1]
+        if duration is None and isinstance(slp, ZipSlp):
+            return estimate_duration(slp)
+        return duration
+
+    costs = [(expected_duration(job) or 0) / FPS for job in jobs]
+    jobs = lpt_order(jobs, costs)
+    costs.sort(reverse=True)
+    games = jobs
+    num_games = len(jobs)
 
     # Records mp4s
     num_processes = get_num_processes(conf)
-    pool = multiprocessing.Pool(processes=num_processes)
-    pool.starmap(record_file_slp, [(slp, out, conf, youtube_options) for slp, out, conf in file_mappings])
-    pool.close()
+    predicted = predict_makespan(costs, num_processes)
+    up_to = 'up to ' if conf.parallel_games == 'auto' else ''
+    if coordinator is None:
+        print(f'Rendering {num_games} games on {up_to}{num_processes} workers, predicted makespan {predicted:.0f}s '
+              f'(lower bound {sum(costs) / num_processes:.0f}s)')
 
-    # Combines mp4s
+    # Front ends work out the batch's ETA from the frames each game has to render
+    queued_frames = [(expected_duration(job) or 0) + DURATION_BUFFER for job in games]
+    events.emit('batch_started', games=num_games, frames=sum(queued_frames), workers=num_processes)
+    for (slp, out, *_), frames in zip(games, queued_frames):
+        events.emit('job_queued', slp=str(slp), outfile=out, frames=frames)
+
+    # Dolphin's User dir is configured once here and cloned by each worker;
+    # a coordinator may not have Dolphin at all
+    template_root = None
+    if coordinator is None:
+        place_slots(conf, num_processes)
+        template_root = tempfile.TemporaryDirectory(prefix='slp2mp4-')
+        with conf.metrics.stage('user_dir_template'):
+            conf.user_dir_template = UserDirTemplate(conf, template_root.name).build()
+
+    upload_queue = make_upload_queue(outdir, conf, youtube_options)
+    if upload_queue is not None:
+        upload_queue.start()
+
+    # Each group is combined as soon as its last game is done; per-game mp4s
+    # waiting to be uploaded are cleaned up at the end instead
+    combine_pipeline = None
     if conf.combine:
-        for files in to_combine:
-            combine(files.vids, files.outname, conf)
+        from combinepipeline import CombinePipeline
+        combine_pipeline = CombinePipeline(
+            to_combine,
+            lambda mp4s, out: combine(mp4s, out, conf),
+            workers=conf.combine_workers,
+            # A playlist needs its games' mp4s
+            cleanup=upload_queue is None and conf.combine_format != 'hls',
+            update=write_partial_playlist if conf.combine_format == 'hls' else None,
+        )
 
+    # Resumed games still count towards their folder's combine and may still need uploading
+    pending_uploads = upload_queue.pending_videos() if upload_queue is not None else set()
+    for slp, out, _ in resumed:
+        if combine_pipeline is not None:
+            combine_pipeline.done(out)
+        state = states.get(os.path.abspath(out))
+        if upload_queue is not None and state not in (UPLOADED, SKIPPED) \
+                and os.path.abspath(out) not in pending_uploads and os.path.exists(out):
+            upload_queue.put(out, upload_metadata(slp, out, youtube_options))
+
+    # "auto" grows and shrinks the number of games in flight as the batch runs
+    controller = None
+    slots = num_processes
+    if conf.parallel_games == 'auto' and coordinator is None:
+        from autoscale import ParallelismController
+        controller = ParallelismController(
+            conf.user_dir_template.worker_render_times(),
+            num_processes,
+            realtime=not conf.unthrottled,
+            metrics=conf.metrics,
+        )
+        slots = controller.start
+
+    start = time.monotonic()
+    errors = []
+    pool = None
+    if coordinator is not None:
+        results = serve_jobs(coordinator, jobs, conf)
+    elif conf.engine == 'async':
+        import asyncengine
+        # Every game's Dolphin and ffmpeg are driven from this process
+        results = asyncengine.iterate(render_batch(jobs, conf, slots, controller=controller))
+    else:
+        pool = make_pool(num_processes)
+        results = Scheduler(pool, record_file_slp, slots, controller).run(jobs)
+    for i, done in enumerate(results, 1):
+        name, first = str(done.job[0]), done.job[1]
+        if done.error is not None:
+            events.emit('error', message=str(done.error), outfile=first)
+        events.emit('job_finished', outfile=first, seconds=done.elapsed, ok=done.error is None)
+        if done.error is not None:
+            print(f'Error: failed to record {name}: {done.error}', file=sys.stderr)
+            errors.append(done.error)
+        else:
+            print(f'[{i}/{len(jobs)}] Finished {name} in {done.elapsed:.0f}s')
+            if upload_queue is not None:
+                for mp4, metadata in done.result:
+                    # Re-rendered for a resumed combine after it was uploaded
+                    if states.get(os.path.abspath(mp4)) != UPLOADED:
+                        upload_queue.put(mp4, metadata)
+
+        outs = [first]
+        for slp, out in duplicates.get(first, []):
+            if done.error is None and os.path.exists(first):
+                link_or_copy(first, out)
+                conf.journal.set_state(out, MUXED)
+                if conf.remove_slps:
+                    remove_slp(slp)
+                print('Created {}'.format(out))
+                events.emit('output_ready', path=os.path.abspath(out), kind='game')
+            outs.append(out)
+        if combine_pipeline is not None:
+            for out in outs:
+                combine_pipeline.done(out, done.error is None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if template_root is not None:
+        conf.user_dir_template = None
+        template_root.cleanup()
+    render_seconds = time.monotonic() - start
+    if coordinator is None:
+        print(f'Rendered {num_games} games in {render_seconds:.0f}s (predicted {predicted:.0f}s)')
+    else:
+        print(f'Rendered {num_games} games in {render_seconds:.0f}s')
+
+    if cache is not None:
+        cache.prune()
+
+    if combine_pipeline is not None:
+        combine_errors = combine_pipeline.close()
+        for error in combine_errors:
+            events.emit('error', message=f'combine failed: {error}')
+        errors += combine_errors
+
+    # Per-game mp4s have to stay around until they're uploaded
+    if upload_queue is not None:
+        print('Waiting for uploads to finish...')
+        upload_queue.close()
+    events.emit('batch_finished', games=num_games, seconds=time.monotonic() - start, errors=len(errors))
+
+    if errors:
+        raise errors[0]
+
+    # Combined playlists play the per-game mp4s in place
+    if conf.combine and conf.combine_format != 'hls':
         # Removes created directories
         for d in created_dirs:
             shutil.rmtree(d, ignore_errors=True)
@@ -219,6 +762,280 @@ def record_files(infiles, outdir, conf, youtube_options):
         for _, mp4, _ in file_mappings:
             safe_remove_file(mp4)
 
+    summary = conf.metrics.summarize(render_seconds, num_processes)
+    if summary is not None:
+        print_summary(summary)
+        print(f'Metrics written to {conf.metrics.path}')
+
+###############################################################################
+# Planning
+###############################################################################
+def plan_files(infiles, outdir, conf):
+    """
+    Estimates how long `record_files` would take and how much disk it needs, without rendering anything
+    """
+    file_mappings, to_combine, _ = map_inputs(infiles, outdir, conf)
+
+    # Same deduplication, probing and ordering as record_files
+    jobs = []
+    duplicates = {}  # {outfile: outfile_of_first_copy}
+    rendered_by_key = {}
+    for slp, out, _ in file_mappings:
+        key = RenderCache.key(hash_slp(slp), conf)
+        if key in rendered_by_key:
+            duplicates[out] = rendered_by_key[key]
+            continue
+        rendered_by_key[key] = out
+        jobs.append((slp, out, conf, None, key))
+    probes = slpprobe.probe_many([slp for slp, *_ in jobs], probe_func=probe_slp)
+
+    skipped = []
+    to_render = []
+    for job, p in zip(jobs, probes):
+        if p.duration is None or is_game_too_short(p.duration, conf.remove_short):
+            skipped.append((job[0], p.duration))
+        else:
+            to_render.append(job + (p.duration + DURATION_BUFFER,))
+    to_render = lpt_order(to_render, [job[-1] for job in to_render])
+    frames_of = {job[1]: job[-1] for job in to_render}
+    for out, first in duplicates.items():
+        if first in frames_of:
+            frames_of[out] = frames_of[first]
+
+    # Dolphin's overhead is paid once per game
+    rate = planner.historical_rate(conf.metrics, conf.resolution, conf.unthrottled)
+    game_seconds = [job[-1] / FPS for job in to_render]
+    costs = sorted((seconds * FPS / rate.fps + rate.overhead for seconds in game_seconds), reverse=True)
+    num_processes = get_num_processes(conf)
+    makespan = predict_makespan(costs, num_processes)
+
+    # Per-game mp4s are only removed once their folder is combined; HLS playlists take no space
+    total_frames = sum(job[-1] for job in to_render)
+    output_bytes = sum(planner.mp4_bytes(frames / FPS, conf.bitrateKbps) for frames in frames_of.values())
+    if conf.combine and conf.combine_format != 'hls':
+        output_bytes += sum(
+            planner.mp4_bytes(sum(frames_of.get(vid, 0) for vid in group.vids) / FPS, conf.bitrateKbps)
+            for group in to_combine
+        )
+    temp_bytes = planner.peak_temp_bytes(
+        [planner.dump_bytes(seconds, conf.bitrateKbps) for seconds in game_seconds],
+        num_processes,
+    )
+
+    print(f'{len(file_mappings)} replays in {len(to_combine)} groups')
+    if duplicates:
+        print(f'{len(duplicates)} duplicate replays are copied instead of rendered')
+    if skipped:
+        print(f'{len(skipped)} games will be skipped:')
+        for slp, duration in skipped:
+            reason = 'unreadable' if duration is None else f'{duration / FPS:.1f}s long'
+            print(f'    {slp} ({reason})')
+    print(f'{len(to_render)} games to render: {total_frames} frames ({total_frames / FPS / 60:.1f} minutes of gameplay)')
+
+    source = f'median of {rate.samples} past renders' if rate.samples else 'realtime, no past renders in metrics_file'
+    up_to = 'up to ' if conf.parallel_games == 'auto' else ''
+    print(f'Render speed: {rate.fps:.1f} fps ({source}) plus {rate.overhead:.1f}s per Dolphin')
+    print(f'Estimated makespan on {up_to}{num_processes} workers: {makespan:.0f}s '
+          f'(lower bound {sum(costs) / num_processes:.0f}s)')
+
+    gib = 1024 ** 3
+    temp_dir = tempfile.gettempdir()
+    for name, path, needed in (('Temp', temp_dir, temp_bytes), ('Output', outdir, output_bytes)):
+        free = planner.free_bytes(path)
+        print(f'{name} disk: up to {needed / gib:.2f} GB in {path} ({free / gib:.2f} GB free)')
+        if needed > free:
+            print(f'Warning: {path} may run out of space')
+
+    return planner.Plan(len(to_render), skipped, total_frames, makespan, temp_bytes, output_bytes)
+
+###############################################################################
+# Watch mode
+###############################################################################
+def watch_files(watch_dir, outdir, conf, youtube_options, include_existing=False, stop=None):
+    """
+    Records replays as they're finished in `watch_dir` until interrupted or `stop` is set
+
+    Sets (see replaywatch.SetTracker) are combined as soon as they're over.
+    The first Ctrl-C sets `stop`: queued games are finished and open sets
+    combined. A second one drops whatever is left.
+    """
+    import psutil
+    from natsort import natsorted
+
+    watch_dir = os.path.abspath(watch_dir)
+    parent = Path(watch_dir).name
+    num_processes = get_num_processes(conf)
+    if conf.parallel_games == 'auto':
+        # Games trickle in one at a time; there's no batch to tune against
+        num_processes = psutil.cpu_count(logical=False)
+
+    place_slots(conf, num_processes)
+    template_root = tempfile.TemporaryDirectory(prefix='slp2mp4-')
+    with conf.metrics.stage('user_dir_template'):
+        conf.user_dir_template = UserDirTemplate(conf, template_root.name).build()
+
+    upload_queue = make_upload_queue(outdir, conf, youtube_options)
+    if upload_queue is not None:
+        upload_queue.start()
+
+    combine_pipeline = None
+    if conf.combine:
+        from combinepipeline import CombinePipeline
+        combine_pipeline = CombinePipeline(
+            [],
+            lambda mp4s, out: combine(mp4s, out, conf),
+            workers=conf.combine_workers,
+            cleanup=upload_queue is None and conf.combine_format != 'hls',
+            update=write_partial_playlist if conf.combine_format == 'hls' else None,
+        )
+
+    def set_group(replay_set):
+        vids = natsorted(replay_set.outfiles)
+        out = os.path.join(outdir, get_combined_name(Path(vids[0]).stem + '-set', conf))
+        return ToCombineObj(vids, out, None)
+
+    def finish_sets(replay_sets):
+        if combine_pipeline is None:
+            return
+        for replay_set in replay_sets:
+            combine_pipeline.add_group(set_group(replay_set))
+
+    completed = queue.Queue()
+
+    def finish_job(job, result, error):
+        slp_file, outfile = job[0], job[1]
+        if error is not None:
+            events.emit('error', message=str(error), outfile=outfile)
+        events.emit('job_finished', outfile=outfile, seconds=None, ok=error is None)
+        if error is not None:
+            print(f'Error: failed to record {slp_file}: {error}', file=sys.stderr)
+        else:
+            print(f'Finished {slp_file}')
+            if upload_queue is not None:
+                for mp4, metadata in result:
+                    upload_queue.put(mp4, metadata)
+        if combine_pipeline is not None:
+            combine_pipeline.done(outfile, error is None)
+            # With HLS, a set's playlist grows while it's still being played
+            for replay_set in sets.open_sets.values():
+                if outfile in replay_set.outfiles:
+                    combine_pipeline.preview(set_group(replay_set))
+
+    if stop is None:
+        stop = threading.Event()
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        def request_stop(signum, frame):
+            print('Stopping after queued games (Ctrl-C again to drop them)', flush=True)
+            stop.set()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        previous_handler = signal.signal(signal.SIGINT, request_stop)
+
+    sets = SetTracker(conf.watch_set_idle_seconds)
+    # Workers and their User dirs stay up between games
+    pool = make_pool(num_processes, ignore_sigint=previous_handler is not None)
+    print(f'Watching {watch_dir} on {num_processes} workers (Ctrl-C to stop)', flush=True)
+    try:
+        with ReplayWatcher(watch_dir, conf.watch_stable_seconds, include_existing) as watcher:
+            while not stop.is_set():
+                for slp_file in watcher.poll():
+                    folder = os.path.dirname(slp_file)
+                    outfile = os.path.join(
+                        outdir,
+                        parent,
+                        os.path.relpath(folder, watch_dir),
+                        get_mp4_name(os.path.basename(slp_file)),
+                    )
+                    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+                    probe = probe_slp(slp_file)
+                    key = RenderCache.key(hash_slp(slp_file), conf)
+                    job = (slp_file, outfile, conf, youtube_options, key, probe.duration)
+                    pool.apply_async(
+                        record_file_slp,
+                        job,
+                        callback=lambda result, job=job: completed.put((job, result, None)),
+                        error_callback=lambda error, job=job: completed.put((job, None, error)),
+                    )
+                    print(f'Queued {slp_file}', flush=True)
+                    events.emit('job_queued', slp=slp_file, outfile=outfile, frames=(probe.duration or 0) + DURATION_BUFFER)
+                    ended = sets.add(folder, player_key(probe.players), outfile)
+                    finish_sets([ended] if ended is not None else [])
+
+                finish_sets(sets.close_idle(watcher))
+                while not completed.empty():
+                    finish_job(*completed.get())
+    except KeyboardInterrupt:
+        print('Stopping; unfinished games are dropped')
+        # Workers ignore Ctrl-C, and so do the Dolphins they started
+        for worker in psutil.Process().children():
+            try:
+                children = worker.children(recursive=True)
+            except psutil.NoSuchProcess:
+                continue
+            for child in children:
+                try:
+                    child.terminate()
+                except psutil.NoSuchProcess:
+                    pass
+        pool.terminate()
+    else:
+        # Stopped on request: finish what's queued and combine open sets
+        pool.close()
+        pool.join()
+        while not completed.empty():
+            finish_job(*completed.get())
+        finish_sets(sets.close_all())
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+        pool.join()
+        conf.user_dir_template = None
+        template_root.cleanup()
+        if combine_pipeline is not None:
+            for error in combine_pipeline.close():
+                events.emit('error', message=f'combine failed: {error}')
+                print(f'Error: combine failed: {error}', file=sys.stderr)
+        if upload_queue is not None:
+            print('Waiting for uploads to finish...')
+            upload_queue.close()
+
+###############################################################################
+# Distributed mode
+###############################################################################
+def run_worker(url, conf, token=None, slots=None):
+    """
+    Renders games for a `slp2mp4 serve` coordinator until it runs out
+    """
+    from distributed import Worker
+
+    if slots is None:
+        import psutil
+        slots = psutil.cpu_count(logical=False) if conf.parallel_games == 'auto' else get_num_processes(conf)
+
+    # Each slot is a thread here, with its own clone of the User dir
+    place_slots(conf, slots)
+    template_root = tempfile.TemporaryDirectory(prefix='slp2mp4-')
+    template_lock = threading.Lock()
+
+    def render(slot, slp_file, outfile, duration, options):
+        # Games are rendered and muxed the way the coordinator's config says;
+        # the User dir is set up for it with the first lease (options are the same for every lease)
+        with template_lock:
+            if conf.user_dir_template is None:
+                for name in RENDER_OPTIONS:
+                    if name in options:
+                        setattr(conf, name, options[name])
+                with conf.metrics.stage('user_dir_template'):
+                    conf.user_dir_template = UserDirTemplate(conf, template_root.name).build()
+        return render_slp(slp_file, outfile, conf, duration, slot=slot)
+
+    print(f'Rendering for {url} on {slots} slots', flush=True)
+    try:
+        Worker(url, render, slots, token, RenderCache.dolphin_build(conf)).run()
+    finally:
+        conf.user_dir_template = None
+        template_root.cleanup()
+
 ###############################################################################
 # Argument parsing
 ###############################################################################
@@ -236,6 +1053,27 @@ def config_script(_=None):
         json.dump(data, f, indent=4)
         f.truncate()
 
+def cache_script(args):
+    conf = Config(False)
+    cache = RenderCache(conf.cache_dir, int(conf.cache_size_gb * 1024 ** 3))
+    if args.action == 'stats':
+        entries, size = cache.stats()
+        print(f'{conf.cache_dir}: {entries} renders, {size / 1024 ** 3:.2f} GB of {conf.cache_size_gb:g} GB')
+    elif args.action == 'prune':
+        max_bytes = None if args.max_size_gb is None else int(args.max_size_gb * 1024 ** 3)
+        removed, size = cache.prune(max_bytes)
+        print(f'Removed {removed} renders ({size / 1024 ** 3:.2f} GB)')
+
+def get_youtube_options(args):
+    return {
+        'enabled': args.youtube,
+        'title_template': args.youtube_title,
+        'description': args.youtube_description,
+        'tags': args.youtube_tags.split(',') if args.youtube_tags else [],
+        'privacy': args.youtube_privacy,
+        'stub_dir': args.youtube_stub,
+    }
+
 def run(args):
     os.makedirs(args.output_directory, exist_ok=True)
     while True:
@@ -245,16 +1083,34 @@ def run(args):
         except RuntimeError as e:
             print(e, file=sys.stderr)
             config_script()
-    
-    youtube_options = {
-        'enabled': args.youtube,
-        'title_template': args.youtube_title,
-        'description': args.youtube_description,
-        'tags': args.youtube_tags.split(',') if args.youtube_tags else [],
-        'privacy': args.youtube_privacy
-    }
-    
-    record_files(args.path, args.output_directory, conf, youtube_options)
+
+    record_files(args.path, args.output_directory, conf, get_youtube_options(args), args.resume)
+
+def plan(args):
+    conf = Config()
+    plan_files(args.path, args.output_directory, conf)
+
+def serve(args):
+    os.makedirs(args.output_directory, exist_ok=True)
+    conf = Config(False)
+    # http.server pulls in ssl and email, so only serve imports it
+    from distributed import Coordinator, DEFAULT_PORT, HEARTBEAT_TIMEOUT
+    coordinator = Coordinator(
+        args.host,
+        DEFAULT_PORT if args.port is None else args.port,
+        args.token,
+        HEARTBEAT_TIMEOUT if args.heartbeat_timeout is None else args.heartbeat_timeout,
+    )
+    record_files(args.path, args.output_directory, conf, get_youtube_options(args), args.resume, coordinator)
+
+def worker(args):
+    conf = Config()
+    run_worker(args.url, conf, args.token, args.slots)
+
+def watch(args):
+    os.makedirs(args.output_directory, exist_ok=True)
+    conf = Config()
+    watch_files(args.directory, args.output_directory, conf, get_youtube_options(args), args.include_existing)
 
 # Parser configuration
 def attempt_data_conversion(val):
@@ -274,10 +1130,30 @@ def parser_is_file_or_dir(path):
     else:
         raise argparse.ArgumentTypeError(f"'{path}' is not a valid file or directory")
 
+def parser_is_dir(path):
+    if os.path.isdir(path):
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"'{path}' is not a directory")
+
+def add_youtube_arguments(p):
+    p.add_argument('--youtube', action='store_true', help='Enable YouTube upload')
+    p.add_argument('--youtube-title', help='YouTube video title template')
+    p.add_argument('--youtube-description', help='YouTube video description')
+    p.add_argument('--youtube-tags', help='YouTube video tags (comma-separated)')
+    p.add_argument('--youtube-privacy', choices=['public', 'unlisted', 'private'], default='unlisted', help='YouTube video privacy setting')
+    p.add_argument('--youtube-stub', metavar='dir', help='Copy videos and their metadata to this directory instead of uploading (for testing)')
+
 parser = argparse.ArgumentParser(
     prog='slp2mp4',
     description='Convert slippi replay files for Super Smash Bros Melee to videos and optionally upload to YouTube',
 )
+parser.add_argument(
+    '--progress-format',
+    choices=['text', 'jsonl'],
+    default='text',
+    help='jsonl writes typed progress events (see events.py) to stdout as JSON lines, and everything else to stderr',
+)
 subparser = parser.add_subparsers(
     title='mode',
     help='Choose which action to execute',
@@ -287,6 +1163,16 @@ subparser = parser.add_subparsers(
 config_parser = subparser.add_parser('config', help='Run configuration helper')
 config_parser.set_defaults(func=config_script)
 
+cache_parser = subparser.add_parser('cache', help='Inspect or prune the render cache')
+cache_parser.set_defaults(func=cache_script)
+cache_parser.add_argument('action', choices=['stats', 'prune'], help='Show cache usage or evict least recently used renders')
+cache_parser.add_argument(
+    '--max-size-gb',
+    metavar='N',
+    help='Prune down to this size instead of cache_size_gb from the config',
+    type=float,
+)
+
 run_parser = subparser.add_parser('run', help='Convert slps to mp4s and optionally upload to YouTube')
 run_parser.set_defaults(func=run)
 run_parser.add_argument(
@@ -303,16 +1189,86 @@ run_parser.add_argument(
     nargs='+',
     type=parser_is_file_or_dir,
 )
-run_parser.add_argument('--youtube', action='store_true', help='Enable YouTube upload')
-run_parser.add_argument('--youtube-title', help='YouTube video title template')
-run_parser.add_argument('--youtube-description', help='YouTube video description')
-run_parser.add_argument('--youtube-tags', help='YouTube video tags (comma-separated)')
-run_parser.add_argument('--youtube-privacy', choices=['public', 'unlisted', 'private'], default='unlisted', help='YouTube video privacy setting')
+run_parser.add_argument('--resume', action='store_true', help='Skip games and combines an interrupted run into the same output directory already finished')
+add_youtube_arguments(run_parser)
+
+plan_parser = subparser.add_parser('plan', help='Estimate how long a run would take and how much disk it needs, without recording')
+plan_parser.set_defaults(func=plan)
+plan_parser.add_argument(
+    '-o', '--output_directory',
+    metavar='dir',
+    help='Directory the mp4s would go to',
+    type=str,
+    default='.',
+)
+plan_parser.add_argument(
+    'path',
+    help='Slippi files/directories containing slippi files to convert',
+    default='.',
+    nargs='+',
+    type=parser_is_file_or_dir,
+)
+
+serve_parser = subparser.add_parser('serve', help='Like run, but hand games out to `slp2mp4 worker`s on other machines')
+serve_parser.set_defaults(func=serve)
+serve_parser.add_argument(
+    '-o', '--output_directory',
+    metavar='dir',
+    help='Directory to put created mp4s',
+    type=str,
+    default='.',
+)
+serve_parser.add_argument(
+    'path',
+    help='Slippi files/directories containing slippi files to convert',
+    default='.',
+    nargs='+',
+    type=parser_is_file_or_dir,
+)
+serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on; anything but loopback needs --token (default: 127.0.0.1)')
+serve_parser.add_argument('--port', type=int, help='Port to listen on (default: 8765)')
+serve_parser.add_argument('--token', help='Shared secret workers have to send')
+serve_parser.add_argument(
+    '--heartbeat-timeout',
+    metavar='seconds',
+    type=float,
+    help='Give a game to another worker if its worker is silent this long (default: 30)',
+)
+serve_parser.add_argument('--resume', action='store_true', help='Skip games and combines an interrupted run into the same output directory already finished')
+add_youtube_arguments(serve_parser)
+
+worker_parser = subparser.add_parser('worker', help='Render games for a `slp2mp4 serve` coordinator')
+worker_parser.set_defaults(func=worker)
+worker_parser.add_argument('url', help='Coordinator URL, e.g. http://render-host:8765')
+worker_parser.add_argument('--token', help='Shared secret the coordinator expects')
+worker_parser.add_argument('--slots', type=int, help='Games to render at once (default: parallel_games)')
+
+watch_parser = subparser.add_parser('watch', help='Record replays as they are saved to a folder (e.g. during an event)')
+watch_parser.set_defaults(func=watch)
+watch_parser.add_argument(
+    '-o', '--output_directory',
+    metavar='dir',
+    help='Directory to put created mp4s',
+    type=str,
+    default='.',
+)
+watch_parser.add_argument('directory', help='Folder Slippi saves replays to', type=parser_is_dir)
+watch_parser.add_argument('--include-existing', action='store_true', help='Also record replays already in the folder')
+add_youtube_arguments(watch_parser)
 
 def main():
     # Parse arguments
     args = parser.parse_args()
-    args.func(args)
+    if args.progress_format != 'jsonl':
+        args.func(args)
+        return
+
+    # Events get stdout to themselves; prints, Dolphin and ffmpeg go to stderr
+    sys.stdout.flush()
+    events_out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    with events_out, events.EventStream(events_out):
+        args.func(args)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,282 @@
+import os
+import struct
+import functools
+import multiprocessing
+from collections import namedtuple
+
+# Frame index of the first frame in a replay; py-slippi computes duration the same way
+FIRST_FRAME_INDEX = -123
+
+# Slippi event command bytes (see the .slp spec in project-slippi/slippi-wiki)
+EVENT_PAYLOADS = 0x35
+EVENT_GAME_START = 0x36
+EVENT_POST_FRAME = 0x38
+EVENT_GAME_END = 0x39
+
+# Trailing metadata is small, so read this much from the end before trying harder
+METADATA_TAIL_SIZE = 64 * 1024
+
+SlpProbe = namedtuple('SlpProbe', ['slp_file', 'duration', 'players', 'start_at', 'source'])
+
+class SlpProbeError(RuntimeError):
+    pass
+
+###############################################################################
+# Minimal UBJSON decoding (just enough for .slp files)
+###############################################################################
+_INT_TYPES = {
+    b'i': ('>b', 1),
+    b'U': ('>B', 1),
+    b'I': ('>h', 2),
+    b'l': ('>i', 4),
+    b'L': ('>q', 8),
+    b'd': ('>f', 4),
+    b'D': ('>d', 8),
+}
+
+class _UbjsonReader:
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def read(self, n):
+        if self.pos + n > len(self.data):
+            raise SlpProbeError('Truncated UBJSON')
+        b = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return b
+
+    def read_type(self):
+        t = self.read(1)
+        while t == b'N':   # no-op marker
+            t = self.read(1)
+        return t
+
+    def read_number(self, t):
+        fmt, size = _INT_TYPES[t]
+        return struct.unpack(fmt, self.read(size))[0]
+
+    def read_length(self):
+        return self.read_number(self.read_type())
+
+    def read_key(self):
+        return self.read(self.read_length()).decode('utf-8', errors='replace')
+
+    def read_value(self, t=None):
+        if t is None:
+            t = self.read_type()
+        if t in _INT_TYPES:
+            return self.read_number(t)
+        if t == b'S' or t == b'H':
+            return self.read(self.read_length()).decode('utf-8', errors='replace')
+        if t == b'C':
+            return self.read(1).decode('utf-8', errors='replace')
+        if t == b'T':
+            return True
+        if t == b'F':
+            return False
+        if t == b'Z':
+            return None
+        if t == b'{':
+            return self.read_object()
+        if t == b'[':
+            return self.read_array()
+        raise SlpProbeError(f'Unknown UBJSON type {t!r}')
+
+    def read_container_header(self):
+        """
+        Returns (value_type, count) for optimized containers, (None, None) otherwise
+        """
+        value_type, count = None, None
+        if self.data[self.pos:self.pos + 1] == b'$':
+            self.pos += 1
+            value_type = self.read(1)
+        if self.data[self.pos:self.pos + 1] == b'#':
+            self.pos += 1
+            count = self.read_length()
+        return value_type, count
+
+    def read_object(self):
+        value_type, count = self.read_container_header()
+        obj = {}
+        if count is not None:
+            for _ in range(count):
+                key = self.read_key()
+                obj[key] = self.read_value(value_type)
+            return obj
+        while True:
+            if self.data[self.pos:self.pos + 1] == b'}':
+                self.pos += 1
+                return obj
+            key = self.read_key()
+            obj[key] = self.read_value()
+
+    def read_array(self):
+        value_type, count = self.read_container_header()
+        if value_type == b'U' and count is not None:
+            return self.read(count)
+        arr = []
+        if count is not None:
+            for _ in range(count):
+                arr.append(self.read_value(value_type))
+            return arr
+        while True:
+            if self.data[self.pos:self.pos + 1] == b']':
+                self.pos += 1
+                return arr
+            arr.append(self.read_value())
+
+###############################################################################
+# Probing
+###############################################################################
+def _read_raw_header(f):
+    """
+    Reads the `{U\x03raw[$U#l<len>` header; returns (raw_start, raw_length)
+    raw_length is 0 for replays that are still being written
+    """
+    header = f.read(15)
+    if len(header) < 15 or header[:11] != b'{U\x03raw[$U#l':
+        raise SlpProbeError('Not a .slp file')
+    return 15, struct.unpack('>i', header[11:15])[0]
+
+def _parse_metadata(data):
+    """
+    Finds the `U\x08metadata` key in the tail of a file and decodes its object
+    """
+    idx = data.rfind(b'U\x08metadata{')
+    if idx < 0:
+        return None
+    reader = _UbjsonReader(data, idx + len(b'U\x08metadata'))
+    reader.read_type()
+    return reader.read_object()
+
+def _read_metadata(f, raw_start, raw_length, file_size):
+    if raw_length <= 0:
+        return None
+    metadata_start = raw_start + raw_length
+    if metadata_start >= file_size:
+        return None
+    f.seek(metadata_start)
+    tail = f.read(min(METADATA_TAIL_SIZE, file_size - metadata_start))
+    try:
+        metadata = _parse_metadata(tail)
+    except SlpProbeError:
+        # Metadata larger than the tail window
+        f.seek(metadata_start)
+        try:
+            metadata = _parse_metadata(f.read())
+        except SlpProbeError:
+            # Cut off mid-write; the frames are still there to count
+            return None
+    return metadata
+
+def _scan_events(f, raw_start, raw_length, file_size):
+    """
+    Walks the raw event stream without decoding frames
+    Returns (last_frame, players) where players are taken from the Game Start event
+    """
+    f.seek(raw_start)
+    end = raw_start + raw_length if raw_length > 0 else file_size
+    data = f.read(end - raw_start)
+
+    if len(data) < 2 or data[0] != EVENT_PAYLOADS:
+        raise SlpProbeError('Missing Event Payloads event')
+    payloads_size = data[1]
+    sizes = {EVENT_PAYLOADS: payloads_size}
+    for i in range(2, payloads_size + 1, 3):
+        cmd = data[i]
+        sizes[cmd] = struct.unpack('>H', data[i + 1:i + 3])[0]
+
+    last_frame = None
+    players = {}
+    pos = payloads_size + 1
+    n = len(data)
+    while pos < n:
+        cmd = data[pos]
+        size = sizes.get(cmd)
+        if size is None:
+            raise SlpProbeError(f'Unknown event 0x{cmd:02x} at {raw_start + pos}')
+        if pos + 1 + size > n:
+            break   # partially written event
+        if cmd == EVENT_POST_FRAME:
+            frame = struct.unpack('>i', data[pos + 1:pos + 5])[0]
+            if last_frame is None or frame > last_frame:
+                last_frame = frame
+        elif cmd == EVENT_GAME_START:
+            for port in range(4):
+                # Player type 3 is an empty slot
+                char_off = pos + 1 + 0x64 + 0x24 * port
+                if char_off + 2 > pos + 1 + size:
+                    break
+                # Keyed by external character ID here, unlike the internal IDs in metadata
+                if data[char_off + 1] != 3:
+                    players[str(port)] = {'characters': {str(data[char_off]): None}}
+        pos += 1 + size
+
+    return last_frame, players
+
+def probe(slp_file):
+    """
+    Reads duration, players and start time from a .slp file without parsing frames
+    Uses the trailing metadata block when present and otherwise counts frame events
+    """
+    with open(slp_file, 'rb') as f:
+        return probe_file(f, os.fstat(f.fileno()).st_size, slp_file)
+
+def probe_file(f, file_size, slp_file):
+    """
+    Same as `probe` for an open binary file (e.g. a zip member) of `file_size` bytes
+    """
+    raw_start, raw_length = _read_raw_header(f)
+
+    metadata = _read_metadata(f, raw_start, raw_length, file_size) or {}
+    start_at = metadata.get('startAt')
+    if start_at is not None:
+        start_at = start_at.rstrip('\x00')   # Nintendont/Slippi<1.5 bug
+    players = metadata.get('players', {})
+
+    if 'lastFrame' in metadata:
+        duration = 1 + metadata['lastFrame'] - FIRST_FRAME_INDEX
+        return SlpProbe(slp_file, duration, players, start_at, 'metadata')
+
+    last_frame, event_players = _scan_events(f, raw_start, raw_length, file_size)
+    duration = None if last_frame is None else 1 + last_frame - FIRST_FRAME_INDEX
+    return SlpProbe(slp_file, duration, players or event_players, start_at, 'events')
+
+def has_metadata(slp_file):
+    """
+    True once Slippi has finished writing the replay (raw length and metadata are written last)
+    """
+    try:
+        with open(slp_file, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            raw_start, raw_length = _read_raw_header(f)
+            return _read_metadata(f, raw_start, raw_length, file_size) is not None
+    except (OSError, SlpProbeError):
+        return False
+
+def _probe_or_none(probe_func, slp_file):
+    try:
+        return probe_func(slp_file)
+    except (OSError, SlpProbeError) as e:
+        print(f'Warning: could not probe {slp_file}: {e}')
+        return SlpProbe(slp_file, None, {}, None, 'error')
+
+def probe_many(slp_files, processes=None, probe_func=probe):
+    """
+    Probes many replays across cores; results are in the same order as `slp_files`
+    `probe_func` must be picklable (a module-level function)
+    """
+    probe_one = functools.partial(_probe_or_none, probe_func)
+    slp_files = list(slp_files)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(slp_files)))
+
+    # Forking a pool isn't worth it for a handful of files
+    if processes == 1 or len(slp_files) < 32:
+        return [probe_one(f) for f in slp_files]
+
+    chunksize = max(1, len(slp_files) // (processes * 4))
+    with multiprocessing.Pool(processes=processes) as pool:
+        return pool.map(probe_one, slp_files, chunksize=chunksize)
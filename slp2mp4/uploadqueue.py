@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+import queue
+
+from metrics import Metrics
+
+class StubUploader:
+    """
+    Offline stand-in for YouTube: copies videos and their metadata into a directory
+    """
+
+    def __init__(self, dest_dir, delay=0):
+        self.dest_dir = dest_dir
+        self.delay = delay
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def __call__(self, video_path, metadata):
+        time.sleep(self.delay)
+        video_id = uuid.uuid4().hex[:11]
+        shutil.copy2(video_path, os.path.join(self.dest_dir, f'{video_id}.mp4'))
+        with open(os.path.join(self.dest_dir, f'{video_id}.json'), 'w') as f:
+            json.dump(dict(metadata, video=video_path), f, indent=4)
+        print(f'Stub upload of {video_path} as {video_id}')
+        return True, video_id
+
+class UploadQueue:
+    """
+    Uploads finished mp4s on background threads, separately from rendering
+
+    Each pending upload is a JSON file in `queue_dir`, removed once the upload
+    succeeds, so uploads left over from an interrupted run are picked up by the
+    next one. Failed uploads are retried with exponential backoff and moved to
+    `queue_dir/failed` when out of retries.
+    """
+
+    def __init__(self, queue_dir, uploader, concurrency=1, retries=3, backoff=30, metrics=None):
+        self.queue_dir = queue_dir
+        self.failed_dir = os.path.join(queue_dir, 'failed')
+        self.uploader = uploader
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.pending = queue.Queue()
+        self.threads = []
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+        # Re-raise any exception that occurred in the with block
+        if tb is not None:
+            return False
+
+    def start(self):
+        # Resume uploads left over from a previous run
+        for name in sorted(os.listdir(self.queue_dir)):
+            if name.endswith('.json'):
+                self.pending.put(os.path.join(self.queue_dir, name))
+
+        for _ in range(self.concurrency):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def put(self, video_path, metadata):
+        entry = {'video': os.path.abspath(video_path), 'metadata': metadata, 'attempts': 0}
+        entry_path = os.path.join(self.queue_dir, f'{time.time():.6f}-{uuid.uuid4().hex}.json')
+        self._write_entry(entry_path, entry)
+        self.pending.put(entry_path)
+
+    def pending_videos(self):
+        """
+        Videos with an upload waiting in the queue directory (not failed ones)
+        """
+        videos = set()
+        for name in os.listdir(self.queue_dir):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.queue_dir, name)) as f:
+                        videos.add(json.load(f)['video'])
+                except (OSError, ValueError, KeyError):
+                    continue
+        return videos
+
+    def close(self):
+        """
+        Waits for every queued upload to finish or fail
+        """
+        for _ in self.threads:
+            self.pending.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _write_entry(self, entry_path, entry):
+        tmp = entry_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, entry_path)
+
+    def _worker(self):
+        while True:
+            entry_path = self.pending.get()
+            if entry_path is None:
+                return
+            self._upload(entry_path)
+
+    def _upload(self, entry_path):
+        with open(entry_path) as f:
+            entry = json.load(f)
+        video = entry['video']
+        if not os.path.exists(video):
+            print(f'Warning: {video} no longer exists; dropping its upload', flush=True)
+            os.remove(entry_path)
+            return
+
+        while True:
+            entry['attempts'] += 1
+            self._write_entry(entry_path, entry)
+            try:
+                with self.metrics.stage('upload', outfile=video, attempt=entry['attempts']) as fields:
+                    uploaded, video_id = self.uploader(video, entry['metadata'])
+                    fields['uploaded'] = uploaded
+            except Exception as e:
+                print(f'Warning: upload of {video} raised {e!r}', flush=True)
+                uploaded = False
+
+            if uploaded:
+                print(f'Uploaded {video} ({video_id})', flush=True)
+                os.remove(entry_path)
+                return
+            if entry['attempts'] > self.retries:
+                print(f'Error: giving up on uploading {video} after {entry["attempts"]} attempts', flush=True)
+                os.makedirs(self.failed_dir, exist_ok=True)
+                os.replace(entry_path, os.path.join(self.failed_dir, os.path.basename(entry_path)))
+                return
+            delay = self.backoff * 2 ** (entry['attempts'] - 1)
+            print(f'Retrying upload of {video} in {delay:.0f}s', flush=True)
+            time.sleep(delay)
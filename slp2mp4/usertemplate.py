@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import uuid
+
+from paths import Paths
+from dolphinrunner import DolphinRunner
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409  # from linux/fs.h
+
+def clone_file(src, dst):
+    """
+    Copies a file, using a copy-on-write reflink where the filesystem supports it
+    Hardlinks aren't safe here: Dolphin writes shader caches in place
+    """
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+class UserDirTemplate:
+    """
+    A Dolphin User dir configured once per batch and cloned into each worker
+
+    Workers keep their clone between jobs, so per-job setup is just clearing
+    the dump and log files and shader caches stay warm.
+    """
+
+    def __init__(self, conf, root):
+        self.conf = conf
+        self.root = root
+        self.fingerprint = self.config_fingerprint(conf)
+        self.template_dir = None
+
+    @staticmethod
+    def config_fingerprint(conf):
+        fields = {
+            'platform': sys.platform,
+            'dolphin_dir': conf.dolphin_dir,
+            'resolution': conf.resolution,
+            'widescreen': conf.widescreen,
+            'bitrateKbps': conf.bitrateKbps,
+            'unthrottled': conf.unthrottled,
+        }
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+
+    def build(self):
+        runner = DolphinRunner(self.conf, Paths(self.conf.dolphin_dir), self.root, f'template-{self.fingerprint}')
+        runner.paths.copy_inis()
+        runner.prep_dolphin_settings()
+        self.template_dir = runner.user_dir
+        return self
+
+    def worker_dir(self, slot=None):
+        """
+        User dir belonging to the current worker process, or to one of its
+        `slot`s when a process renders several games at once
+        """
+        if slot is None:
+            return os.path.join(self.root, f'User-{self.fingerprint}-worker-{os.getpid()}')
+        return os.path.join(self.root, f'User-{self.fingerprint}-worker-{os.getpid()}-{slot}')
+
+    def worker_render_times(self):
+        """
+        Glob matching every worker's render_time.txt
+        """
+        return os.path.join(self.root, f'User-{self.fingerprint}-worker-*', 'Logs', 'render_time.txt')
+
+    def clone_to(self, user_dir):
+        if os.path.isdir(user_dir):
+            return
+        tmp = f'{user_dir}.{uuid.uuid4().hex}.tmp'
+        shutil.copytree(self.template_dir, tmp, copy_function=clone_file)
+        os.rename(tmp, user_dir)
@@ -0,0 +1,112 @@
+import os
+import shutil
+import zipfile
+import posixpath
+import tempfile
+import contextlib
+from collections import namedtuple
+
+import slpprobe
+from rendercache import hash_file, HASH_CHUNK_SIZE
+
+# A two-player replay takes about this many bytes per frame
+BYTES_PER_FRAME = 320
+
+class ZipSlp(namedtuple('ZipSlp', ['zip_path', 'member', 'crc', 'size'])):
+    """
+    A replay inside a zip archive, read straight from the archive when needed
+
+    `crc` and `size` are the member's CRC-32 and uncompressed size, as listed
+    in the archive. Anywhere a replay path is accepted by the helpers below,
+    a ZipSlp works too.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'{self.zip_path}:{self.member}'
+
+def is_zip(file_path):
+    return file_path.lower().endswith('.zip')
+
+def index_zip(zip_path):
+    """
+    Lists the .slp members of an archive without extracting anything
+    """
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        return [
+            ZipSlp(os.path.abspath(zip_path), info.filename, info.CRC, info.file_size)
+            for info in z.infolist()
+            if not info.is_dir() and info.filename.endswith('.slp')
+        ]
+
+def hash_slp(slp_file):
+    if not isinstance(slp_file, ZipSlp):
+        return hash_file(slp_file)
+    # The archive already lists what it would take inflating the member to compute
+    return f'zip-crc32:{slp_file.crc:08x}:{slp_file.size}'
+
+def estimate_duration(slp_file):
+    """
+    Roughly how many frames a replay in an archive has, from its size alone
+    """
+    return slp_file.size // BYTES_PER_FRAME
+
+def probe_slp(slp_file):
+    if not isinstance(slp_file, ZipSlp):
+        return slpprobe.probe(slp_file)
+    with zipfile.ZipFile(slp_file.zip_path, 'r') as z:
+        size = z.getinfo(slp_file.member).file_size
+        with z.open(slp_file.member) as f:
+            return slpprobe.probe_file(f, size, slp_file)
+
+def read_sibling(slp_file, name):
+    """
+    Contents of the file called `name` next to the replay, or None
+    """
+    if not isinstance(slp_file, ZipSlp):
+        path = os.path.join(os.path.dirname(slp_file), name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    with zipfile.ZipFile(slp_file.zip_path, 'r') as z:
+        try:
+            return z.read(posixpath.join(posixpath.dirname(slp_file.member), name))
+        except KeyError:
+            return None
+
+@contextlib.contextmanager
+def open_slp(slp_file):
+    """
+    Yields the replay opened for reading and its size in bytes
+    """
+    if not isinstance(slp_file, ZipSlp):
+        with open(slp_file, 'rb') as f:
+            yield f, os.fstat(f.fileno()).st_size
+        return
+    with zipfile.ZipFile(slp_file.zip_path, 'r') as z, z.open(slp_file.member) as f:
+        yield f, z.getinfo(slp_file.member).file_size
+
+def extract_slp(slp_file, dest_dir):
+    """
+    Returns a path Dolphin can read the replay from, extracting it into `dest_dir` if it's in a zip
+    """
+    if not isinstance(slp_file, ZipSlp):
+        return slp_file
+    # Members in different folders of the archive can share a name
+    stem = os.path.splitext(posixpath.basename(slp_file.member))[0]
+    fd, path = tempfile.mkstemp(prefix=f'{stem}-', suffix='.slp', dir=dest_dir)
+    with os.fdopen(fd, 'wb') as out, \
+            zipfile.ZipFile(slp_file.zip_path, 'r') as z, \
+            z.open(slp_file.member) as f:
+        shutil.copyfileobj(f, out, HASH_CHUNK_SIZE)
+    return path
+
+def remove_slp(slp_file):
+    # Replays inside a zip stay in the archive
+    if isinstance(slp_file, ZipSlp):
+        return
+    try:
+        os.remove(slp_file)
+    except FileNotFoundError:
+        pass
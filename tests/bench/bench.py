@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the render pipeline
+
+Runs record_files, DolphinRunner and FfmpegRunner end to end against
+fake_dolphin.py and fake_ffmpeg.py, so orchestration changes can be measured
+without a GPU, a Melee ISO or a real Dolphin. Linux only (the fake Dolphin is
+installed where Paths expects the Playback AppImage).
+
+    python tests/bench/bench.py [--scenario NAME ...] [--quick] [--update-baseline]
+
+Results are compared against this host's entry in baseline.json (see
+host_id); anything more than REGRESSION_TOLERANCE slower is reported and the
+exit status is 1. Timings from another machine aren't compared at all.
+"""
+import os
+import sys
+import json
+import stat
+import time
+import uuid
+import socket
+import struct
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+import multiprocessing
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+REPO = os.path.abspath(os.path.join(HERE, '..', '..'))
+SRC = os.path.join(REPO, 'slp2mp4')
+sys.path.insert(0, SRC)
+
+import slpprobe
+from config import Config
+from dolphinrunner import DolphinRunner
+from ffmpegrunner import FfmpegRunner
+from usertemplate import UserDirTemplate
+
+TEST_SLP = os.path.join(REPO, 'tests', 'EvenMatchupGaming-Game_20190519T162734.slp')
+BASELINE = os.path.join(HERE, 'baseline.json')
+REGRESSION_TOLERANCE = 0.25
+# Sub-millisecond stages are all noise; only flag slowdowns bigger than this
+REGRESSION_MIN_SECONDS = 0.05
+
+FAKE_FPS = 600
+FAKE_STARTUP = 0.2
+
+# Only imported once they're used; the CLI, and every pool worker started
+# with spawn (Windows, macOS), import slp2mp4.py before doing anything
+LAZY_MODULES = [
+    'youtube_uploader_selenium',
+    'selenium',
+    'natsort',
+    'psutil',
+    'asyncio',
+    'concurrent.futures',
+    'http.server',
+    'urllib.request',
+]
+
+###############################################################################
+# Fixtures
+###############################################################################
+def make_slp(path, duration):
+    """
+    Writes a minimal replay: an empty event stream and metadata with `lastFrame`
+    """
+    raw = bytes([slpprobe.EVENT_PAYLOADS, 1])
+    last_frame = duration - 1 + slpprobe.FIRST_FRAME_INDEX
+    metadata = b'U\x08metadata{U\x09lastFramel' + struct.pack('>i', last_frame) + b'}'
+    with open(path, 'wb') as f:
+        f.write(b'{U\x03raw[$U#l' + struct.pack('>i', len(raw)) + raw + metadata + b'}')
+    return path
+
+def make_executable(path):
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+class BenchEnv:
+    """
+    A throwaway Dolphin install, ISO and config.json wired to the fake binaries
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.dolphin_dir = os.path.join(root, 'dolphin')
+        self.iso = os.path.join(root, 'melee.iso')
+        self.config_json = os.path.join(root, 'config.json')
+
+        playback = os.path.join(self.dolphin_dir, 'Slippi Launcher', 'playback')
+        os.makedirs(playback)
+        fake_dolphin = os.path.join(HERE, 'fake_dolphin.py')
+        make_executable(fake_dolphin)
+        os.symlink(fake_dolphin, os.path.join(playback, 'Slippi_Playback-x86_64.AppImage'))
+        self.fake_ffmpeg = os.path.join(HERE, 'fake_ffmpeg.py')
+        make_executable(self.fake_ffmpeg)
+
+        for ini in [
+            ('SlippiOnline', 'GameSettings', 'GALE01.ini'),
+            ('SlippiPlayback', 'Config', 'GFX.ini'),
+            ('SlippiPlayback', 'Config', 'Dolphin.ini'),
+        ]:
+            ini = os.path.join(self.dolphin_dir, *ini)
+            os.makedirs(os.path.dirname(ini), exist_ok=True)
+            open(ini, 'w').close()
+        open(self.iso, 'w').close()
+
+    def config(self, **overrides):
+        with open(os.path.join(SRC, 'data', 'config.json')) as f:
+            j = json.load(f)
+        j.update({
+            'melee_iso': self.iso,
+            'dolphin_dir': self.dolphin_dir,
+            'ffmpeg': self.fake_ffmpeg,
+            'parallel_games': 1,
+        })
+        j.update(overrides)
+        with open(self.config_json, 'w') as f:
+            json.dump(j, f)
+        return Config(config_json=self.config_json)
+
+    def replays(self, name, durations):
+        d = os.path.join(self.root, name)
+        os.makedirs(d, exist_ok=True)
+        return [make_slp(os.path.join(d, f'Game_{i}.slp'), n) for i, n in enumerate(durations)]
+
+@contextlib.contextmanager
+def timed(results, name):
+    start = time.monotonic()
+    yield
+    results[name] = time.monotonic() - start
+
+###############################################################################
+# Scenarios
+###############################################################################
+def bench_stages(env, quick):
+    """
+    Per-stage overhead of a single game, outside of the process pool
+    """
+    results = {}
+    slp = env.replays('stages', [600])[0] if quick else TEST_SLP
+    conf = env.config()
+
+    with timed(results, 'probe'):
+        num_frames = slpprobe.probe(slp).duration
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with timed(results, 'user_dir_template'):
+            template = UserDirTemplate(conf, tmpdir).build()
+        with timed(results, 'user_dir_setup'):
+            runner = DolphinRunner(conf, conf.paths, tmpdir, uuid.uuid4(), template).__enter__()
+        with timed(results, 'dolphin'):
+            video_files, audio_file = runner.run(slp, num_frames)
+        # Time Dolphin spends that isn't rendering the replay's frames
+        results['dolphin_overhead'] = results['dolphin'] - num_frames / FAKE_FPS
+        with timed(results, 'mux'):
+            FfmpegRunner(conf.ffmpeg).run(video_files, audio_file, os.path.join(tmpdir, 'out.mp4'))
+        runner.__exit__(None, None, None)
+
+    return results
+
+def bench_scaling(env, quick):
+    """
+    Whole batches through record_files at several `parallel_games` values
+    """
+    import slp2mp4 as cli
+
+    results = {}
+    durations = [600, 900, 1200, 1500] if quick else [1800, 2400, 3000, 3600, 4200, 4800, 5400, 6000]
+    total_frames = sum(durations)
+    for parallel_games in [1, 2, 4]:
+        replay_dir = os.path.dirname(env.replays(f'scaling-{parallel_games}', durations)[0])
+        outdir = os.path.join(env.root, f'out-{parallel_games}')
+        os.makedirs(outdir)
+        conf = env.config(parallel_games=parallel_games)
+        with timed(results, f'parallel_{parallel_games}'):
+            cli.record_files([replay_dir], outdir, conf, None)
+
+        # Perfect scaling would render total frames / workers at the fake's fps
+        ideal = total_frames / FAKE_FPS / min(parallel_games, len(durations))
+        results[f'parallel_{parallel_games}_efficiency'] = ideal / results[f'parallel_{parallel_games}']
+
+    return results
+
+def free_port():
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def distributed_worker(config_json, url):
+    import slp2mp4 as cli
+    cli.run_worker(url, Config(config_json=config_json), slots=1)
+
+def bench_distributed(env, quick):
+    """
+    A batch through `serve` with local worker processes instead of the pool
+    """
+    import slp2mp4 as cli
+    from distributed import Coordinator
+
+    results = {}
+    durations = [600, 900, 1200, 1500] if quick else [1800, 2400, 3000, 3600, 4200, 4800, 5400, 6000]
+    num_workers = 2
+    replay_dir = os.path.dirname(env.replays('distributed', durations)[0])
+    outdir = os.path.join(env.root, 'out')
+    os.makedirs(outdir)
+    conf = env.config(parallel_games=1)
+
+    # Workers are started before the coordinator binds its port so they don't
+    # inherit its socket; they retry until it's up
+    port = free_port()
+    workers = [
+        multiprocessing.Process(target=distributed_worker, args=(env.config_json, f'http://127.0.0.1:{port}'))
+        for _ in range(num_workers)
+    ]
+    for w in workers:
+        w.start()
+    try:
+        with timed(results, f'workers_{num_workers}'):
+            coordinator = Coordinator('127.0.0.1', port)
+            try:
+                cli.record_files([replay_dir], outdir, conf, None, coordinator=coordinator)
+            finally:
+                coordinator.close()
+    finally:
+        for w in workers:
+            w.join(30)
+            if w.is_alive():
+                w.terminate()
+
+    ideal = sum(durations) / FAKE_FPS / num_workers
+    results[f'workers_{num_workers}_efficiency'] = ideal / results[f'workers_{num_workers}']
+    return results
+
+def import_slp2mp4():
+    """
+    Imports slp2mp4 in a fresh interpreter; returns the seconds -X importtime
+    puts on it and the modules that were loaded
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import sys, slp2mp4; print(" ".join(sys.modules))'],
+        cwd=SRC, capture_output=True, text=True, check=True,
+    )
+    seconds = None
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2] == ' slp2mp4':
+            seconds = int(fields[1]) / 1e6
+    return seconds, set(proc.stdout.split())
+
+def bench_imports(env, quick):
+    """
+    Startup cost of the CLI and of spawned pool workers, which re-import slp2mp4.py
+    """
+    results = {}
+    runs = 3 if quick else 10
+
+    import_seconds = []
+    for _ in range(runs):
+        seconds, modules = import_slp2mp4()
+        eager = [m for m in LAZY_MODULES if m in modules]
+        if eager:
+            raise RuntimeError(f'Importing slp2mp4 also imports {", ".join(eager)}')
+        import_seconds.append(seconds)
+    results['import'] = statistics.median(import_seconds)
+
+    # What `slp2mp4 config` and the Electron app wait for before anything happens
+    startup_seconds = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run([sys.executable, os.path.join(SRC, 'slp2mp4.py'), '--help'], capture_output=True, check=True)
+        startup_seconds.append(time.monotonic() - start)
+    results['cli_startup'] = statistics.median(startup_seconds)
+
+    return results
+
+SCENARIOS = {
+    'stages': bench_stages,
+    'scaling': bench_scaling,
+    'distributed': bench_distributed,
+    'imports': bench_imports,
+}
+
+###############################################################################
+# Reporting
+###############################################################################
+def host_id():
+    """
+    What baselines are kept per: wall-clock times only compare on the same
+    CPU, core count and Python (imports in particular vary across versions)
+    """
+    model = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    python = f'{platform.python_implementation()} {sys.version_info[0]}.{sys.version_info[1]}'
+    return f'{model} x{os.cpu_count()}, {python}'
+
+def is_higher_better(metric):
+    return metric.endswith('_efficiency')
+
+def find_regressions(results, baseline):
+    regressions = []
+    for metric, value in results.items():
+        old = baseline.get(metric)
+        if old is None or old <= 0:
+            continue
+        ratio = value / old
+        if is_higher_better(metric):
+            ratio = 1 / ratio if ratio > 0 else float('inf')
+        elif value - old < REGRESSION_MIN_SECONDS:
+            continue
+        if ratio > 1 + REGRESSION_TOLERANCE:
+            regressions.append((metric, old, value))
+    return regressions
+
+def run_scenarios(names, quick=False):
+    results = {}
+    os.environ.setdefault('FAKE_DOLPHIN_FPS', str(FAKE_FPS))
+    os.environ.setdefault('FAKE_DOLPHIN_STARTUP', str(FAKE_STARTUP))
+    for name in names:
+        prefix = f'{name}.quick' if quick else name
+        with tempfile.TemporaryDirectory() as root:
+            env = BenchEnv(root)
+            for metric, value in SCENARIOS[name](env, quick).items():
+                results[f'{prefix}.{metric}'] = value
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline slp2mp4 benchmarks')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='Scenario to run (default: all)')
+    parser.add_argument('--quick', action='store_true', help='Use short synthetic replays')
+    parser.add_argument('--update-baseline', action='store_true', help=f'Write results to {BASELINE}')
+    args = parser.parse_args()
+
+    results = run_scenarios(args.scenario or list(SCENARIOS), args.quick)
+
+    baselines = {}  # {host_id: {metric: value}}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baselines = json.load(f)
+    host = host_id()
+    baseline = baselines.setdefault(host, {})
+
+    print()
+    print(f'Host: {host}')
+    print(f'{"metric":40} {"baseline":>10} {"current":>10}')
+    for metric, value in sorted(results.items()):
+        old = baseline.get(metric)
+        old = '-' if old is None else f'{old:.3f}'
+        print(f'{metric:40} {old:>10} {value:>10.3f}')
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+        print(f'Updated {BASELINE}')
+        return
+    if not baseline:
+        print('No baseline for this host yet; run with --update-baseline to record one')
+
+    regressions = find_regressions(results, baseline)
+    for metric, old, value in regressions:
+        print(f'REGRESSION: {metric} went from {old:.3f} to {value:.3f}', file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
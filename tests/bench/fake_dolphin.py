@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Stand-in for Slippi Playback Dolphin used by the benchmarks
+
+Reads the comm file, then "renders" the replay it names: one line per frame
+in Logs/render_time.txt plus AVI/WAV dump bytes, at FAKE_DOLPHIN_FPS frames
+per second after FAKE_DOLPHIN_STARTUP seconds. Like the real thing, it keeps
+going after the replay until it's killed. With FAKE_DOLPHIN_STALL_AT set,
+it hangs once it has rendered that many frames; with FAKE_DOLPHIN_EXIT_AT
+set, it exits there instead, like a crash.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import struct
+import argparse
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'slp2mp4'))
+import slpprobe
+
+VIDEO_BYTES_PER_FRAME = 4096
+AUDIO_BYTES_PER_FRAME = 32000 * 4 // 60  # 32kHz 16-bit stereo
+FRAMES_PER_WRITE = 10
+IDLE_FRAMES = 60 * 60  # "waiting for game" screen before giving up
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', dest='comm_file')
+    parser.add_argument('-u', dest='user_dir')
+    parser.add_argument('-e', dest='iso')
+    parser.add_argument('-v', dest='video_backend')
+    parser.add_argument('-b', action='store_true')
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    fps = float(os.environ.get('FAKE_DOLPHIN_FPS', '600'))
+    time.sleep(float(os.environ.get('FAKE_DOLPHIN_STARTUP', '0.2')))
+
+    with open(args.comm_file) as f:
+        comm = json.load(f)
+    total_frames = (slpprobe.probe(comm['replay']).duration or 0) + IDLE_FRAMES
+
+    logs_dir = os.path.join(args.user_dir, 'Logs')
+    frames_dir = os.path.join(args.user_dir, 'Dump', 'Frames')
+    audio_dir = os.path.join(args.user_dir, 'Dump', 'Audio')
+    for d in [logs_dir, frames_dir, audio_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    stall_at = int(os.environ.get('FAKE_DOLPHIN_STALL_AT', '-1'))
+    exit_at = int(os.environ.get('FAKE_DOLPHIN_EXIT_AT', '-1'))
+
+    start = time.monotonic()
+    with open(os.path.join(logs_dir, 'render_time.txt'), 'w') as render_time, \
+            open(os.path.join(frames_dir, 'framedump0.avi'), 'wb') as video, \
+            open(os.path.join(audio_dir, 'dspdump.wav'), 'wb') as audio:
+        # Sizes are left at 0 until the end, like Dolphin's WaveFileWriter
+        audio.write(b'RIFF\0\0\0\0WAVEfmt ' + struct.pack('<IHHIIHH', 16, 1, 2, 32000, 32000 * 4, 4, 16) + b'data\0\0\0\0')
+        for frame in range(0, total_frames, FRAMES_PER_WRITE):
+            if 0 <= stall_at <= frame:
+                while True:
+                    time.sleep(60)
+            if 0 <= exit_at <= frame:
+                return
+            n = min(FRAMES_PER_WRITE, total_frames - frame)
+            video.write(b'\0' * VIDEO_BYTES_PER_FRAME * n)
+            audio.write(b'\0' * AUDIO_BYTES_PER_FRAME * n)
+            render_time.write('16.6\n' * n)
+            render_time.flush()
+            audio.flush()
+            delay = start + (frame + n) / fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Stand-in for ffmpeg used by the benchmarks
+
+Writes the output file (the last argument) with as many bytes as its inputs,
+expanding concat demuxer lists or reading stdin for `-i pipe:0`, at
+FAKE_FFMPEG_MBPS megabytes per second.
+"""
+import os
+import sys
+import time
+
+def input_files(argv):
+    files = []
+    concat = False
+    for i, arg in enumerate(argv):
+        if arg == '-f' and argv[i + 1] == 'concat':
+            concat = True
+        elif arg == '-i':
+            path = argv[i + 1]
+            if concat:
+                with open(path) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith('file '):
+                            files.append(line[len('file '):].strip("'").replace("'\\''", "'"))
+                concat = False
+            else:
+                files.append(path)
+    return files
+
+def main():
+    argv = sys.argv[1:]
+    if len(argv) == 0:
+        return
+    size = sum(os.path.getsize(f) for f in input_files(argv) if os.path.exists(f))
+    # Streamed audio: consume everything piped in, like an encoder would
+    if 'pipe:0' in input_files(argv):
+        for chunk in iter(lambda: sys.stdin.buffer.read(64 * 1024), b''):
+            size += len(chunk)
+
+    time.sleep(size / (float(os.environ.get('FAKE_FFMPEG_MBPS', '500')) * 1024 ** 2))
+    with open(argv[-1], 'wb') as f:
+        f.truncate(size)
+
+if __name__ == '__main__':
+    main()
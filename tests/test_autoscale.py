@@ -0,0 +1,64 @@
+import os
+import time
+from collections import namedtuple
+
+import pytest
+
+import autoscale
+from autoscale import ParallelismController, SLOW_INTERVALS
+
+Memory = namedtuple('Memory', ['percent'])
+CpuTimes = namedtuple('CpuTimes', ['iowait'])
+
+@pytest.fixture(autouse=True)
+def idle_machine(monkeypatch):
+    monkeypatch.setattr(autoscale.psutil, 'cpu_percent', lambda *a, **k: 10.0)
+    monkeypatch.setattr(autoscale.psutil, 'cpu_times_percent', lambda *a, **k: CpuTimes(0.0))
+    monkeypatch.setattr(autoscale.psutil, 'virtual_memory', lambda: Memory(10.0))
+
+def append_frames(path, frames, age=0.0):
+    with open(path, 'a') as f:
+        f.write('16.6\n' * frames)
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+def sample(controller, slots, seconds=10.0):
+    # Pretend `seconds` went by since the last decision
+    controller.last_sample = time.monotonic() - seconds
+    return controller.update(slots, saturated=False)
+
+def make_controller(tmp_path, workers):
+    paths = [str(tmp_path / f'worker-{i}.txt') for i in range(workers)]
+    for path in paths:
+        append_frames(path, 1)
+    controller = ParallelismController(str(tmp_path / 'worker-*.txt'), 4, start=workers)
+    controller.settling = 0
+    return controller, paths
+
+def test_finished_game_does_not_shed_a_slot(tmp_path):
+    controller, (fast, done) = make_controller(tmp_path, 2)
+    for _ in range(SLOW_INTERVALS + 1):
+        append_frames(fast, 600)
+        # A game that ended 2s into the interval; its file stays until the next job
+        append_frames(done, 120, age=8.0)
+        assert sample(controller, 3) == 3
+    assert controller.ceiling == 4
+
+def test_slow_worker_has_to_stay_slow(tmp_path):
+    controller, (fast, slow) = make_controller(tmp_path, 2)
+    for interval in range(1, SLOW_INTERVALS + 1):
+        append_frames(fast, 600)
+        append_frames(slow, 120)
+        slots = sample(controller, 3)
+        assert slots == (2 if interval == SLOW_INTERVALS else 3)
+    assert controller.ceiling == 2
+
+def test_ceiling_recovers(tmp_path, monkeypatch):
+    monkeypatch.setattr(autoscale, 'RECOVER_INTERVALS', 2)
+    controller, (worker,) = make_controller(tmp_path, 1)
+    controller.ceiling = 2
+    for _ in range(2):
+        append_frames(worker, 600)
+        sample(controller, 1)
+    assert controller.ceiling == 3
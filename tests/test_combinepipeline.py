@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+import pytest
+
+from combinepipeline import CombinePipeline
+
+# Same fields as slp2mp4.ToCombineObj
+Group = namedtuple('Group', ['vids', 'outname', 'outdir'])
+
+class Recorder:
+    def __init__(self):
+        self.combined = []
+        self.updated = []
+
+    def combine(self, vids, outname):
+        self.combined.append((vids, outname))
+
+    def update(self, vids, outname):
+        self.updated.append((vids, outname))
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+def game(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(b'mp4')
+    return str(path)
+
+def group(tmp_path, name, count, outdir=None):
+    vids = [game(tmp_path, f'{name}-{i}.mp4') for i in range(count)]
+    return Group(vids, str(tmp_path / f'{name}.mp4'), outdir)
+
+def test_combines_once_every_game_is_done(tmp_path, recorder):
+    a, b = group(tmp_path, 'a', 3), group(tmp_path, 'b', 2)
+    with CombinePipeline([a, b], recorder.combine, cleanup=False) as pipeline:
+        # Out of order, interleaved between groups
+        for vid in [a.vids[2], b.vids[0], a.vids[0]]:
+            pipeline.done(vid)
+        assert pipeline.futures == []
+        pipeline.done(a.vids[1])
+    assert recorder.combined == [(a.vids, a.outname)]
+
+def test_failed_game_blocks_its_group(tmp_path, recorder, capsys):
+    a, b = group(tmp_path, 'a', 2), group(tmp_path, 'b', 1)
+    with CombinePipeline([a, b], recorder.combine, cleanup=False) as pipeline:
+        pipeline.done(a.vids[0], ok=False)
+        pipeline.done(a.vids[1])
+        pipeline.done(b.vids[0])
+    assert recorder.combined == [(b.vids, b.outname)]
+    assert f'not creating {a.outname}' in capsys.readouterr().out
+
+def test_skipped_games_are_left_out(tmp_path, recorder):
+    a = group(tmp_path, 'a', 3)
+    (tmp_path / 'a-1.mp4').unlink()
+    with CombinePipeline([a], recorder.combine, cleanup=False) as pipeline:
+        for vid in a.vids:
+            pipeline.done(vid)
+    assert recorder.combined == [([a.vids[0], a.vids[2]], a.outname)]
+
+def test_group_added_after_its_games(tmp_path, recorder):
+    a, b = group(tmp_path, 'a', 2), group(tmp_path, 'b', 2)
+    with CombinePipeline([], recorder.combine, cleanup=False) as pipeline:
+        for vid in a.vids + b.vids[:1]:
+            pipeline.done(vid)
+        pipeline.add_group(a)
+        pipeline.add_group(b)
+        assert len(pipeline.futures) == 1
+        pipeline.done(b.vids[1])
+    assert sorted(recorder.combined) == [(a.vids, a.outname), (b.vids, b.outname)]
+
+def test_failure_before_group_is_added(tmp_path, recorder):
+    a = group(tmp_path, 'a', 2)
+    with CombinePipeline([], recorder.combine, cleanup=False) as pipeline:
+        pipeline.done(a.vids[0], ok=False)
+        pipeline.done(a.vids[1])
+        pipeline.add_group(a)
+    assert recorder.combined == []
+
+def test_cleanup(tmp_path, recorder):
+    outdir = tmp_path / 'set'
+    outdir.mkdir()
+    a = group(outdir, 'a', 2, outdir=str(outdir))
+    a = a._replace(outname=str(tmp_path / 'a.mp4'))
+    with CombinePipeline([a], recorder.combine) as pipeline:
+        for vid in a.vids:
+            pipeline.done(vid)
+    assert not outdir.exists()
+
+def test_combine_errors_are_returned(tmp_path):
+    def combine(vids, outname):
+        raise RuntimeError('ffmpeg failed')
+    a = group(tmp_path, 'a', 1)
+    pipeline = CombinePipeline([a], combine, cleanup=False)
+    pipeline.done(a.vids[0])
+    errors = pipeline.close()
+    assert [str(e) for e in errors] == ['ffmpeg failed']
+
+def test_update_with_leading_games(tmp_path, recorder):
+    a = group(tmp_path, 'a', 3)
+    with CombinePipeline([a], recorder.combine, cleanup=False, update=recorder.update) as pipeline:
+        pipeline.done(a.vids[1])
+        assert recorder.updated == []   # Game 0 isn't done yet
+        pipeline.done(a.vids[0])
+        pipeline.done(a.vids[2])
+    assert recorder.updated == [(a.vids[:2], a.outname)]
+    assert recorder.combined == [(a.vids, a.outname)]
@@ -0,0 +1,46 @@
+import io
+import urllib.request
+
+import pytest
+
+import distributed
+from distributed import Coordinator, Worker
+
+@pytest.mark.parametrize('host', ['0.0.0.0', '::', '192.168.1.10', 'coordinator.lan'])
+def test_public_bind_needs_token(host):
+    with pytest.raises(RuntimeError, match='without a token'):
+        Coordinator(host, 0)
+
+@pytest.mark.parametrize('host, token', [('127.0.0.1', None), ('localhost', None), ('0.0.0.0', 'sekrit')])
+def test_allowed_binds(host, token):
+    Coordinator(host, 0, token).close()
+
+def test_default_is_loopback():
+    coordinator = Coordinator(port=0)
+    try:
+        assert coordinator.server.server_address[0] == '127.0.0.1'
+    finally:
+        coordinator.close()
+
+@pytest.mark.parametrize('rendered', ['error', False])
+def test_unreachable_coordinator_keeps_the_slot(monkeypatch, rendered):
+    # The replay downloads, then the coordinator goes away before the result is reported
+    monkeypatch.setattr(distributed, 'POLL_INTERVAL', 0)
+    monkeypatch.setattr(urllib.request, 'urlopen', lambda *a, **k: io.BytesIO(b'slp'))
+    reports = []
+
+    def render(slot, slp_path, outfile, duration, options):
+        if rendered == 'error':
+            raise RuntimeError('Dolphin crashed')
+        return rendered
+
+    def request(method, path, payload=None, data=None, headers=None):
+        reports.append(path)
+        raise ConnectionRefusedError('refused')
+
+    worker = Worker('http://127.0.0.1:1', render)
+    monkeypatch.setattr(worker, '_request', request)
+    worker._run_job(0, {'job': 7, 'name': 'Game_1.slp', 'duration': 600, 'options': {}})
+    assert len(reports) == distributed.REPORT_ATTEMPTS
+    assert reports[0].startswith('/jobs/7/' + ('failed' if rendered == 'error' else 'skipped'))
+    assert worker.held == set()
@@ -0,0 +1,41 @@
+import struct
+
+import pytest
+
+from ffmpegrunner import WavFormat, parse_wav_header
+
+def chunk(chunk_id, payload):
+    # Odd-sized chunks are padded to an even length
+    return chunk_id + struct.pack('<I', len(payload)) + payload + b'\0' * (len(payload) & 1)
+
+FMT = chunk(b'fmt ', struct.pack('<HHIIHH', 1, 2, 32000, 32000 * 4, 4, 16))
+
+def wav(*chunks, size=0):
+    # Dolphin leaves the RIFF and data sizes at 0 until it stops dumping
+    return b'RIFF' + struct.pack('<I', size) + b'WAVE' + b''.join(chunks)
+
+def test_plain_header():
+    data = wav(FMT, b'data\0\0\0\0') + b'\1' * 64
+    assert parse_wav_header(data) == WavFormat(2, 32000, 4, 16, 44)
+
+def test_extra_chunks():
+    # A LIST chunk with an odd size before fmt, and a fact chunk between fmt and data
+    header = wav(chunk(b'LIST', b'INFOISFT\3\0\0\0ab\0'), FMT, chunk(b'fact', b'\0' * 4), b'data\0\0\0\0')
+    assert parse_wav_header(header + b'\1' * 64) == WavFormat(2, 32000, 4, 16, len(header))
+
+def test_extended_fmt():
+    fmt = chunk(b'fmt ', struct.pack('<HHIIHHH', 1, 1, 48000, 48000 * 2, 2, 16, 0))
+    header = wav(fmt, b'data\0\0\0\0')
+    assert parse_wav_header(header) == WavFormat(1, 48000, 2, 16, len(header))
+
+@pytest.mark.parametrize('size', [0, 4, 12, 20, 30, 36, 40])
+def test_truncated(size):
+    # Not enough of the header has been written yet
+    assert parse_wav_header(wav(FMT, b'data\0\0\0\0')[:size]) is None
+
+def test_data_before_fmt():
+    assert parse_wav_header(wav(b'data\0\0\0\0', FMT)) is None
+
+def test_not_a_wav():
+    assert parse_wav_header(b'RIFX' + b'\0' * 4 + b'WAVE' + FMT + b'data\0\0\0\0') is None
+    assert parse_wav_header(b'RIFF' + b'\0' * 4 + b'AVI ' + FMT + b'data\0\0\0\0') is None
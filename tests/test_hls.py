@@ -0,0 +1,115 @@
+import struct
+
+import pytest
+
+import hls
+from hls import Segment, fragment_ticks, parse_fragmented_mp4
+
+VIDEO_TRACK = 1
+AUDIO_TRACK = 2
+TIMESCALE = 15360
+FRAME_TICKS = 256   # 60 fps
+FRAMES_PER_FRAGMENT = 60
+
+def box(box_type, *payload):
+    payload = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(payload), box_type.encode()) + payload
+
+def full_box(box_type, flags, *payload, version=0):
+    return box(box_type, struct.pack('>I', version << 24 | flags), *payload)
+
+def trak(track_id, timescale, handler):
+    return box('trak',
+        full_box('tkhd', 0, struct.pack('>III', 0, 0, track_id), b'\0' * 68),
+        box('mdia',
+            full_box('mdhd', 0, struct.pack('>IIII', 0, 0, timescale, 0), b'\0' * 4),
+            full_box('hdlr', 0, b'\0' * 4, handler, b'\0' * 13)))
+
+def moov(default_duration=FRAME_TICKS):
+    # The audio track comes first so the video one has to be picked out
+    return box('moov',
+        full_box('mvhd', 0, b'\0' * 96),
+        trak(AUDIO_TRACK, 48000, b'soun'),
+        trak(VIDEO_TRACK, TIMESCALE, b'vide'),
+        box('mvex',
+            full_box('trex', 0, struct.pack('>IIIII', AUDIO_TRACK, 1, 1024, 0, 0)),
+            full_box('trex', 0, struct.pack('>IIIII', VIDEO_TRACK, 1, default_duration, 0, 0))))
+
+def traf(track_id, tfhd_flags=0, tfhd_fields=b'', trun_flags=0, count=FRAMES_PER_FRAGMENT, samples=b''):
+    return box('traf',
+        full_box('tfhd', tfhd_flags, struct.pack('>I', track_id), tfhd_fields),
+        full_box('trun', trun_flags, struct.pack('>I', count), samples))
+
+def moof(*trafs):
+    return box('moof', full_box('mfhd', 0, struct.pack('>I', 1)), *trafs)
+
+def fragment(kind='trex'):
+    """
+    One second of video as a moof and its mdat, with the sample duration given the way `kind` says
+    """
+    if kind == 'trex':
+        video = traf(VIDEO_TRACK, trun_flags=hls.DATA_OFFSET, samples=struct.pack('>i', 0))
+    elif kind == 'tfhd':
+        video = traf(VIDEO_TRACK, hls.BASE_DATA_OFFSET | hls.DEFAULT_SAMPLE_DURATION,
+                     struct.pack('>QI', 0, FRAME_TICKS))
+    else:
+        flags = hls.DATA_OFFSET | hls.FIRST_SAMPLE_FLAGS | hls.SAMPLE_DURATION | hls.SAMPLE_SIZE
+        samples = struct.pack('>iI', 0, 0) + struct.pack('>II', FRAME_TICKS, 100) * FRAMES_PER_FRAGMENT
+        video = traf(VIDEO_TRACK, trun_flags=flags, samples=samples)
+    audio = traf(AUDIO_TRACK, count=47)
+    return moof(audio, video) + box('mdat', b'\0' * 64)
+
+def write(tmp_path, *boxes):
+    path = tmp_path / 'game.mp4'
+    path.write_bytes(b''.join(boxes))
+    return str(path)
+
+@pytest.mark.parametrize('kind', ['trex', 'tfhd', 'trun'])
+def test_fragment_ticks(kind):
+    data = fragment(kind)
+    assert fragment_ticks(data[8:], VIDEO_TRACK, FRAME_TICKS) == FRAMES_PER_FRAGMENT * FRAME_TICKS
+
+def test_fragment_ticks_other_track():
+    assert fragment_ticks(fragment()[8:], 3, FRAME_TICKS) == 0
+
+def test_parse_fragmented_mp4(tmp_path):
+    ftyp = box('ftyp', b'iso5', b'\0' * 4)
+    init = ftyp + moov()
+    fragments = [fragment(['trex', 'tfhd', 'trun'][i % 3]) for i in range(10)]
+    path = write(tmp_path, init, *fragments)
+
+    mp4 = parse_fragmented_mp4(path)
+    assert mp4.init_size == len(init)
+    # Merged into segments of at least 4 seconds; the last one takes what's left
+    offsets = [len(init)]
+    for data in fragments:
+        offsets.append(offsets[-1] + len(data))
+    assert mp4.segments == [
+        Segment(offsets[0], offsets[4] - offsets[0], 4.0),
+        Segment(offsets[4], offsets[8] - offsets[4], 4.0),
+        Segment(offsets[8], offsets[10] - offsets[8], 2.0),
+    ]
+
+def test_parse_fragmented_mp4_large_mdat(tmp_path):
+    # 64-bit box sizes, as ffmpeg writes for big mdats
+    payload = b'\0' * 64
+    mdat = struct.pack('>I4sQ', 1, b'mdat', 16 + len(payload)) + payload
+    init = moov()
+    path = write(tmp_path, init, fragment()[:-len(box('mdat', payload))], mdat)
+    mp4 = parse_fragmented_mp4(path)
+    assert mp4.segments == [Segment(len(init), len(fragment()) + 8, 1.0)]
+
+def test_truncated_file(tmp_path):
+    path = write(tmp_path, moov(), fragment(), fragment()[:-10])
+    with pytest.raises(ValueError, match='Truncated'):
+        parse_fragmented_mp4(path)
+
+def test_not_fragmented(tmp_path):
+    path = write(tmp_path, box('ftyp', b'isom', b'\0' * 4), moov(), box('mdat', b'\0' * 64))
+    with pytest.raises(ValueError, match='not a fragmented mp4'):
+        parse_fragmented_mp4(path)
+
+def test_moof_before_moov(tmp_path):
+    path = write(tmp_path, fragment(), moov())
+    with pytest.raises(ValueError, match='moof before moov'):
+        parse_fragmented_mp4(path)
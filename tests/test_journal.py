@@ -0,0 +1,60 @@
+import os
+import threading
+
+import pytest
+
+from journal import JobJournal, QUEUED, RENDERING, MUXED, COMBINED, UPLOADED, SKIPPED
+
+@pytest.fixture
+def journal(tmp_path):
+    return JobJournal(str(tmp_path / 'journal.sqlite'))
+
+def test_transitions(journal, tmp_path):
+    outfile = str(tmp_path / 'Game_1.mp4')
+    assert journal.state(outfile) is None
+    for state in [QUEUED, RENDERING, MUXED, UPLOADED]:
+        journal.set_state(outfile, state, slp_file='Game_1.slp')
+        assert journal.state(outfile) == state
+    assert journal.states() == {os.path.abspath(outfile): UPLOADED}
+
+@pytest.mark.parametrize('state', [QUEUED, RENDERING, MUXED, COMBINED, SKIPPED])
+def test_uploaded_is_never_downgraded(journal, state):
+    journal.set_state('Game_1.mp4', UPLOADED)
+    journal.set_state('Game_1.mp4', state)
+    assert journal.state('Game_1.mp4') == UPLOADED
+
+def test_slp_file_is_kept(journal):
+    journal.set_state('Game_1.mp4', QUEUED, slp_file='Game_1.slp')
+    journal.set_state('Game_1.mp4', MUXED)
+    conn = journal._connection()
+    assert conn.execute('SELECT slp_file FROM outputs').fetchone() == ('Game_1.slp',)
+
+def test_relative_and_absolute_paths_match(journal, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    journal.set_state('Game_1.mp4', MUXED)
+    assert journal.state(str(tmp_path / 'Game_1.mp4')) == MUXED
+
+def test_survives_reopening(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    JobJournal(path).set_state('Game_1.mp4', MUXED)
+    assert JobJournal(path).state('Game_1.mp4') == MUXED
+
+def test_threads_share_the_file(journal):
+    threads = [threading.Thread(target=journal.set_state, args=(f'Game_{i}.mp4', MUXED)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(journal.states()) == 8
+
+def test_clear(journal):
+    journal.set_state('Game_1.mp4', MUXED)
+    journal.clear()
+    assert journal.states() == {}
+
+def test_disabled():
+    journal = JobJournal()
+    journal.set_state('Game_1.mp4', MUXED)
+    assert not journal.enabled
+    assert journal.state('Game_1.mp4') is None
+    assert journal.states() == {}
@@ -0,0 +1,79 @@
+import os
+import struct
+
+import pytest
+
+import slpprobe
+from slpprobe import SlpProbeError
+
+REPLAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'EvenMatchupGaming-Game_20190519T162734.slp')
+DURATION = 12445
+
+@pytest.fixture(scope='module')
+def replay_bytes():
+    with open(REPLAY, 'rb') as f:
+        return f.read()
+
+def raw_end(data):
+    # The raw element's length follows the 11-byte `{U\x03raw[$U#l` header
+    return 15 + struct.unpack('>i', data[11:15])[0]
+
+def write(tmp_path, data, name='Game.slp'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+def test_probe_reads_metadata():
+    probe = slpprobe.probe(REPLAY)
+    assert probe.duration == DURATION
+    assert probe.source == 'metadata'
+    assert probe.start_at == '2019-05-19T16:27:34'
+    # Internal character IDs, with frames played on each
+    assert probe.players == {'0': {'characters': {'12': DURATION}}, '1': {'characters': {'22': DURATION}}}
+    assert slpprobe.has_metadata(REPLAY)
+
+def test_no_metadata_counts_frames(tmp_path, replay_bytes):
+    path = write(tmp_path, replay_bytes[:raw_end(replay_bytes)])
+    probe = slpprobe.probe(path)
+    assert probe.duration == DURATION
+    assert probe.source == 'events'
+    assert probe.start_at is None
+    # External character IDs from Game Start
+    assert probe.players == {'0': {'characters': {'13': None}}, '1': {'characters': {'20': None}}}
+    assert not slpprobe.has_metadata(path)
+
+def test_replay_still_being_written(tmp_path, replay_bytes):
+    # Slippi writes a raw length of 0 until the game is over, and may stop mid-event
+    cut = raw_end(replay_bytes) // 2
+    path = write(tmp_path, replay_bytes[:11] + b'\0\0\0\0' + replay_bytes[15:cut])
+    probe = slpprobe.probe(path)
+    assert probe.source == 'events'
+    assert 0 < probe.duration < DURATION
+    assert set(probe.players) == {'0', '1'}
+    assert not slpprobe.has_metadata(path)
+
+def test_truncated_replay(tmp_path, replay_bytes):
+    # The raw length promises more than the file holds
+    path = write(tmp_path, replay_bytes[:raw_end(replay_bytes) // 2])
+    probe = slpprobe.probe(path)
+    assert probe.source == 'events'
+    assert 0 < probe.duration < DURATION
+    assert not slpprobe.has_metadata(path)
+
+def test_truncated_metadata(tmp_path, replay_bytes):
+    path = write(tmp_path, replay_bytes[:-20])
+    assert slpprobe.probe(path).source == 'events'
+    assert not slpprobe.has_metadata(path)
+
+@pytest.mark.parametrize('size', [0, 8, 15])
+def test_truncated_header(tmp_path, replay_bytes, size):
+    path = write(tmp_path, replay_bytes[:size])
+    with pytest.raises(SlpProbeError):
+        slpprobe.probe(path)
+    assert not slpprobe.has_metadata(path)
+
+def test_probe_many_reports_bad_files(tmp_path, replay_bytes):
+    bad = write(tmp_path, b'not a replay', 'Bad.slp')
+    good, error = slpprobe.probe_many([REPLAY, bad])
+    assert good.duration == DURATION
+    assert error == slpprobe.SlpProbe(bad, None, {}, None, 'error')